@@ -0,0 +1,368 @@
+import os, time
+import numpy as np
+import argparse
+
+def timeit(func,*args,**kwargs):
+    # run func, return (output, seconds)
+    start_time = time.time()
+    out = func(*args,**kwargs)
+    return out, time.time() - start_time
+
+
+def bench_query(db_path,band='g',field='SN-C3',pointing=0,repeat=3,cache_path=None):
+    # time every Query.get_* method against a SQLite stand-in (see sqlitedb.py)
+    import query, sqlitedb
+    from footprint import pointing_box
+    if not os.path.exists(db_path):
+        print('Creating synthetic database %s' % db_path)
+        sqlitedb.make_synthetic_db(db_path).close()
+    con = sqlitedb.SqliteConnection(db_path)
+    query_sci = query.Query(con=con,cache_path=cache_path)
+    dtype = [('tra',float),('tdec',float),('mjd_obs',float)]
+    top_dir = '/'.join(os.path.dirname(os.path.abspath(__file__)).split('/')[0:-1])
+    data = np.genfromtxt(os.path.join(top_dir,'etc/y6point.csv'),delimiter=',',skip_header=1,dtype=dtype)[pointing]
+    tra = np.mod(data['tra'],360.)
+    # template CCD footprints of the pointing drive the overlap queries
+    template = query_sci.get_image_info_pointing(tra,data['tdec'],data['mjd_obs'],band=band)
+    if template is None:
+        print('***No template images found at pointing %d***' % pointing)
+        return
+    t = template[0]
+    ra, dec = 0.5*(t['ramin']+t['ramax']), 0.5*(t['decmin']+t['decmax'])
+    # object query at a generated catalog object of the template CCD (the CCD center has none nearby)
+    objects = sqlitedb.object_positions(con,os.path.basename(t['path'].decode() if isinstance(t['path'],bytes) else t['path'])[:-3])
+    ra_obj, dec_obj = objects[0] if len(objects) > 0 else (ra,dec)
+    benches = [
+        ('get_filenames_from_object', query_sci.get_filenames_from_object, (ra_obj,dec_obj,band)),
+        ('get_pointing_coord', query_sci.get_pointing_coord, (ra,dec,band,6)),
+        ('get_image_info_pointing', query_sci.get_image_info_pointing, (tra,data['tdec'],data['mjd_obs'],band)),
+        ('get_image_info_overlap', query_sci.get_image_info_overlap, (t['ramin'],t['ramax'],t['decmin'],t['decmax'],band)),
+        ('get_image_info_overlap x%d' % len(template), lambda: [query_sci.get_image_info_overlap(s['ramin'],s['ramax'],s['decmin'],s['decmax'],band) for s in template], ()),
+        ('get_image_info_overlap_bulk', query_sci.get_image_info_overlap_bulk, pointing_box(template['ramin'],template['ramax'],template['decmin'],template['decmax'])+(band,)),
+        ('get_image_info_field', query_sci.get_image_info_field, (field,band)),
+    ]
+    print('%-32s %8s %10s' % ('method','rows','time [ms]'))
+    for name, func, args in benches:
+        times = []
+        for i in range(repeat):
+            out, dt = timeit(func,*args)
+            times.append(dt)
+        if isinstance(out,list):
+            rows = sum([len(o) for o in out if o is not None])
+        else:
+            rows = 0 if out is None else len(out)
+        print('%-32s %8d %10.2f' % (name,rows,1000.*np.min(times)))
+    return
+
+
+def bench_download(num_files=50,size_mb=8.,connections=(1,4,8),fail_every=0,wget=True):
+    # Downloader against a local archive server, compared to one wget process per file
+    import tempfile, shutil
+    from multiprocessing.dummy import Pool as ThreadPool
+    from download import Downloader, LocalArchiveServer
+    from misc import bash
+    root = tempfile.mkdtemp()
+    rng = np.random.RandomState(1)
+    names = []
+    for i in range(num_files):
+        names.append("D%08d_g_c01_r4000p01_immasked.fits.fz" % i)
+        with open(os.path.join(root,names[-1]),"wb") as f:
+            f.write(rng.bytes(int(size_mb*1e6)))
+    server = LocalArchiveServer(root,"usr","psw",fail_every=fail_every).start()
+    urls = [server.url + n for n in names]
+    print('%-24s %10s %10s' % ('method','time [s]','MB/s'))
+    for num in connections:
+        out_dir = tempfile.mkdtemp()
+        downloader = Downloader("usr","psw",max_connections=num,backoff=0.1)
+        pool = ThreadPool(max(connections))
+        out, dt = timeit(pool.map,lambda url: downloader.download(url,out_dir),urls)
+        pool.close()
+        print('%-24s %10.2f %10.1f' % ('Downloader (%d conn.)' % num,dt,num_files*size_mb/dt))
+        print('    ' + downloader.summary())
+        shutil.rmtree(out_dir)
+    if wget and bash('which wget',False) == 0:
+        out_dir = tempfile.mkdtemp()
+        pool = ThreadPool(max(connections))
+        command = 'wget -nc -q --user usr --password psw %s -P %s'
+        out, dt = timeit(pool.map,lambda url: bash(command % (url,out_dir),False),urls)
+        pool.close()
+        print('%-24s %10.2f %10.1f' % ('wget (%d proc.)' % max(connections),dt,num_files*size_mb/dt))
+        shutil.rmtree(out_dir)
+    server.stop()
+    shutil.rmtree(root)
+    return
+
+
+def make_immask(filename,shape=(4096,2048),seed=1):
+    # synthetic tile-compressed red_immask file (SCI, MSK, WGT)
+    from astropy.io import fits
+    rng = np.random.RandomState(seed)
+    sci = rng.normal(1000.,30.,shape).astype(np.float32)
+    msk = np.zeros(shape,dtype=np.int16)
+    msk[rng.randint(0,shape[0],2000),rng.randint(0,shape[1],2000)] = rng.choice([1,2,4,16,2048,8192],2000)
+    wgt = np.full(shape,1/900.,dtype=np.float32)
+    hdul = fits.HDUList([fits.PrimaryHDU(),fits.CompImageHDU(sci,name='SCI'),fits.CompImageHDU(msk,name='MSK'),fits.CompImageHDU(wgt,name='WGT')])
+    hdul.writeto(filename)
+    return filename
+
+
+def bench_weight(filename=None,border=20):
+    # native weight maps vs makeWeight + single_header, pixel-by-pixel
+    import tempfile, shutil
+    from astropy.io import fits
+    from misc import make_weight_map, single_header, bash
+    work_dir = tempfile.mkdtemp()
+    if filename is None:
+        filename = make_immask(os.path.join(work_dir,'D00000001_g_c01_r1p01_immasked.fits.fz'))
+    out_native = os.path.join(work_dir,'native')
+    out, dt = timeit(make_weight_map,filename,out_native,border)
+    print('%-24s %10.2f s' % ('native',dt))
+    if bash('which makeWeight',False) == 0:
+        out_ref = os.path.join(work_dir,'makeweight')
+        def run_makeweight():
+            bash('makeWeight -inFile_img %s -border %d -outroot %s' % (filename,border,out_ref),False)
+            single_header(out_ref+'.fits')
+            single_header(out_ref+'.weight.fits')
+        out, dt = timeit(run_makeweight)
+        print('%-24s %10.2f s' % ('makeWeight',dt))
+        for ext in ['.fits','.weight.fits']:
+            a = fits.getdata(out_native+ext); b = fits.getdata(out_ref+ext)
+            num = np.sum(~((a == b) | (np.isnan(a) & np.isnan(b))))
+            print('%-24s %10d pixels differ' % (ext,num))
+        # MSK bits of the pixels only one of them masks (fixes the bit set of make_weight_map)
+        msk = fits.getdata(filename,2).astype(np.int64)
+        a = fits.getdata(out_native+'.weight.fits'); b = fits.getdata(out_ref+'.weight.fits')
+        for name, only in [('masked by native only',(a == 0) & (b != 0)),('masked by makeWeight only',(a != 0) & (b == 0))]:
+            bits = [bit for bit in range(16) if np.any(msk[only] & (1 << bit))]
+            print('%-24s %10d pixels, MSK bits %s' % (name,np.sum(only),' '.join(['%d' % (1 << bit) for bit in bits])))
+    else:
+        print('makeWeight not found, skipping comparison.')
+    shutil.rmtree(work_dir)
+    return
+
+
+def bench_align(tile_dir,ccd=1,num_threads=8):
+    # align (one swarp per image) vs align_batch and align_native on the weighted images of a tile directory,
+    # outputs are compared pixel-by-pixel
+    import glob, tempfile, shutil
+    from astropy.io import fits
+    from misc import bash, clean_tpool
+    from pipeline import Pipeline
+    if bash('which swarp',False) != 0:
+        print('swarp not found.')
+        return
+    images = [f for f in sorted(glob.glob(os.path.join(tile_dir,'D*_immasked.fits'))) if '_proj' not in f and '_diff' not in f]
+    work_dirs = {}
+    modes = ['single','batch','native']
+    for mode in modes:
+        work_dirs[mode] = tempfile.mkdtemp()
+        for f in glob.glob(os.path.join(tile_dir,'template_c%d*' % ccd)) + images + [f[:-5]+'.weight.fits' for f in images]:
+            os.symlink(os.path.abspath(f),os.path.join(work_dirs[mode],os.path.basename(f)))
+        des_pipeline = Pipeline('g',None,None,work_dirs[mode],align_mode=mode)
+        info_list = np.array([(os.path.join(work_dirs[mode],os.path.basename(f)),ccd) for f in images],dtype=[('path','U200'),('ccd',int)])
+        if mode == 'single':
+            out, dt = timeit(clean_tpool,des_pipeline.align,info_list,num_threads)
+        elif mode == 'native':
+            out, dt = timeit(clean_tpool,des_pipeline.align_native,info_list,num_threads)
+        else:
+            out, dt = timeit(des_pipeline.align_batch,info_list,num_threads)
+        print('%-24s %10.2f s %8.2f s/image' % (mode,dt,dt/max(len(images),1)))
+        if mode == 'native':
+            print('    ' + des_pipeline.pixel_maps.summary())
+    for mode in modes[1:]:
+        for f in images:
+            for ext in ['_proj_c%d.fits' % ccd,'_proj_c%d.weight.fits' % ccd]:
+                name = os.path.basename(f)[:-5] + ext
+                a = fits.getdata(os.path.join(work_dirs['single'],name)); b = fits.getdata(os.path.join(work_dirs[mode],name))
+                if a.shape != b.shape:
+                    print('%-8s %-60s shape %s, single %s' % (mode,name,b.shape,a.shape))
+                    continue
+                num = np.sum(~((a == b) | (np.isnan(a) & np.isnan(b))))
+                if num > 0: print('%-8s %-60s %10d pixels differ, max %.3g' % (mode,name,num,np.nanmax(np.abs(a-b))))
+    for work_dir in work_dirs.values():
+        shutil.rmtree(work_dir)
+    return
+
+
+def make_diff_pair(work_dir,shape=(2048,1024),num_stars=400,seed=1):
+    # synthetic template/image pair: PSF sigma 1.5 vs 2.3 pixels, flux scale 1.1, tilted background
+    # and one transient (x, y, flux in template units) in the image
+    from astropy.io import fits
+    rng = np.random.RandomState(seed)
+    ny, nx = shape
+    xs, ys = rng.uniform(40,nx-40,num_stars), rng.uniform(40,ny-40,num_stars)
+    flux = 10**rng.uniform(3,5,num_stars)
+    transient = (nx/3.+0.3,ny/2.+0.7,5000.)
+    yy, xx = np.mgrid[0:ny,0:nx]
+    def render(sigma,scale,sky,sources):
+        data = np.zeros(shape) + sky
+        for x, y, f in sources:
+            y0, y1, x0, x1 = int(y)-20, int(y)+21, int(x)-20, int(x)+21
+            data[y0:y1,x0:x1] += scale*f*np.exp(-((xx[y0:y1,x0:x1]-x)**2+(yy[y0:y1,x0:x1]-y)**2)/(2*sigma**2))/(2*np.pi*sigma**2)
+        return data
+    stars = list(zip(xs,ys,flux))
+    files = {}
+    for name, sigma, scale, sky, noise, sources in [('template',1.5,1.0,0.,3.,stars),('image',2.3,1.1,5.+1e-3*xx,10.,stars+[transient])]:
+        files[name] = os.path.join(work_dir,'%s.fits' % name)
+        fits.PrimaryHDU((render(sigma,scale,sky,sources)+rng.normal(0,noise,shape)).astype(np.float32)).writeto(files[name])
+        weight = np.full(shape,1./noise**2,dtype=np.float32)
+        weight[rng.randint(0,ny,50),rng.randint(0,nx,50)] = 0.
+        fits.PrimaryHDU(weight).writeto(files[name][:-5]+'.weight.fits')
+    return files['image'], files['template'], transient
+
+
+def bench_diff(num_images=4,num_threads=4):
+    # native difference backend vs hotpants (etc/DES.hotpants) on synthetic pairs:
+    # residual noise, transient flux and pixel-by-pixel agreement of the two backends
+    import tempfile, shutil
+    from multiprocessing import Pool
+    from astropy.io import fits
+    from misc import bash
+    top_dir = '/'.join(os.path.dirname(os.path.abspath(__file__)).split('/')[0:-1])
+    pars = ''.join(open(os.path.join(top_dir,'etc/DES.hotpants')).readlines())
+    work_dir = tempfile.mkdtemp()
+    pairs = []
+    for i in range(num_images):
+        os.makedirs(os.path.join(work_dir,str(i)))
+        pairs.append(make_diff_pair(os.path.join(work_dir,str(i)),seed=i+1))
+    backends = ['native']
+    if bash('which hotpants',False) == 0:
+        backends.append('hotpants')
+    else:
+        print('hotpants not found, skipping comparison.')
+    def args(image,template,backend):
+        return (image,image[:-5]+'.weight.fits',template,template[:-5]+'.weight.fits',image[:-5]+'_%s_diff.fits' % backend,image[:-5]+'_%s_diff.weight.fits' % backend,pars)
+    print('%-24s %10s %12s %14s' % ('backend','s/image','resid. std','transient flux'))
+    for backend in backends:
+        if backend == 'native':
+            pool = Pool(num_threads)
+            out, dt = timeit(pool.map,_subtract_args,[args(image,template,backend) for image, template, transient in pairs])
+            pool.close()
+        else:
+            command = 'hotpants -inim %s -ini %s -tmplim %s -tni %s -outim %s -oni %s -useWeight %s'
+            out, dt = timeit(lambda: [bash(command % args(image,template,backend),False) for image, template, transient in pairs])
+        std, flux = [], []
+        for image, template, (x, y, f) in pairs:
+            diff = fits.getdata(image[:-5]+'_%s_diff.fits' % backend)
+            noise = fits.getdata(image[:-5]+'_%s_diff.weight.fits' % backend)
+            good = noise > 0
+            std.append(np.std(diff[good]/noise[good]))
+            yy, xx = np.mgrid[0:diff.shape[0],0:diff.shape[1]]
+            flux.append(np.sum(diff[(xx-x)**2+(yy-y)**2 < 15**2])/f)
+        print('%-24s %10.2f %12.3f %14.3f' % (backend,dt/len(pairs),np.mean(std),np.mean(flux)))
+    if 'hotpants' in backends:
+        for image, template, transient in pairs:
+            a = fits.getdata(image[:-5]+'_native_diff.fits'); b = fits.getdata(image[:-5]+'_hotpants_diff.fits')
+            noise = fits.getdata(image[:-5]+'_hotpants_diff.weight.fits')
+            good = noise > 0
+            print('%-40s rms(native-hotpants)/noise %.3f' % (os.path.basename(image),np.sqrt(np.mean(((a-b)[good]/noise[good])**2))))
+    shutil.rmtree(work_dir)
+    return
+
+
+def bench_varlc(num_sources=2000,max_epochs=120,seed=1):
+    # myvarlc_batch vs myvarlc on synthetic light curves of different lengths and extra variance
+    import io, contextlib
+    from varstats import myvarlc, myvarlc_batch
+    rng = np.random.RandomState(seed)
+    flux = np.zeros((num_sources,max_epochs)); sig = np.zeros(flux.shape); mask = np.zeros(flux.shape,dtype=bool)
+    for i in range(num_sources):
+        n = rng.randint(1,max_epochs+1)
+        s = rng.uniform(0.5,3.,n)
+        flux[i,:n] = 100. + rng.normal(0,1,n)*np.sqrt(s**2+rng.choice([0.,0.5,3.,20.])**2)
+        sig[i,:n] = s; mask[i,:n] = True
+    # the scalar version prints its failures
+    with contextlib.redirect_stdout(io.StringIO()), np.errstate(all='ignore'):
+        ref, dt_scalar = timeit(lambda: np.array([myvarlc(flux[i,mask[i]],sig[i,mask[i]]) for i in range(num_sources)]))
+    out, dt_batch = timeit(lambda: np.array(myvarlc_batch(flux,sig,mask)).T)
+    same = np.isclose(out,ref,rtol=1e-9,atol=1e-12,equal_nan=True).all(axis=1)
+    print('%-10s %10s' % ('version','s'))
+    print('%-10s %10.2f' % ('scalar',dt_scalar))
+    print('%-10s %10.2f' % ('batch',dt_batch))
+    print('%d/%d sources identical (good, avg, rms, sigavg, sigrms), %d converged' % (np.sum(same),num_sources,np.sum(ref[:,0] == 1)))
+    return
+
+
+def bench_incremental(num_sources=500,num_epochs=10,seed=1):
+    # incremental SN run bookkeeping: light curves written from difference catalogs, then the same
+    # exposures (archive URLs) queried again must give no new images, and appending them again no new rows
+    import tempfile, shutil, io, contextlib
+    from astropy.io import fits
+    from catalog import write_catalog
+    from lcstore import LightCurveStore
+    from pipeline import Pipeline
+    rng = np.random.RandomState(seed)
+    work_dir = tempfile.mkdtemp()
+    ccd = 5
+    des_pipeline = Pipeline('g',None,None,work_dir,debug_mode=True,incremental=True)
+    fits.PrimaryHDU(np.zeros((16,16),dtype=np.float32)).writeto(os.path.join(work_dir,'template_c%d.fits' % ccd))
+    num = np.arange(1,num_sources+1); ra = rng.uniform(0,1,num_sources); dec = rng.uniform(0,1,num_sources)
+    write_catalog(os.path.join(work_dir,'template_c%d.cat' % ccd),num,ra,dec,rng.uniform(100,200,(num_sources,3)),np.ones((num_sources,3)))
+    exposures = ['D%08d_g_c%02d_r4000p01_immasked' % (100000+i,ccd) for i in range(num_epochs+1)]
+    urls = ['https://desar2.cosmology.illinois.edu/DESFiles/desarchive/%s.fits.fz' % e for e in exposures]
+    def epoch_catalogs(idx):
+        info_list = np.zeros(len(idx),dtype=[('path','U200'),('mjd_obs',float),('ccd',int)])
+        for k, i in enumerate(idx):
+            info_list[k] = (os.path.join(work_dir,'%s_proj_c%d_template_c%d_diff.cat' % (exposures[i],ccd,ccd)),58000.+i,ccd)
+            write_catalog(info_list['path'][k],num,ra,dec,rng.normal(0,5,(num_sources,3)),np.ones((num_sources,3)))
+        return info_list
+    image_list = np.zeros(len(urls),dtype=[('path','U200'),('ccd',int)])
+    image_list['path'], image_list['ccd'] = urls, ccd
+    store = LightCurveStore(os.path.join(work_dir,'lightcurves'))
+    with contextlib.redirect_stdout(io.StringIO()):
+        des_pipeline.generate_light_curves(epoch_catalogs(range(num_epochs)))
+        rows = np.sum(store.index(ccd)['count'])
+        new = des_pipeline.new_exposures(image_list[0:num_epochs])
+        extra = des_pipeline.new_exposures(image_list)
+        # rerun of already processed epochs plus one new one
+        des_pipeline.generate_light_curves(epoch_catalogs(range(num_epochs-2,num_epochs+1)),append=True)
+    manifest = store.manifest(ccd)['exposures']
+    print('%d epochs processed, rerun: %d new images (expected 0), %d with one new exposure (expected 1)' % (num_epochs,len(new),len(extra)))
+    print('append of 2 old + 1 new epochs: %d rows added (expected %d), %d manifest entries (expected %d)' % (np.sum(store.index(ccd)['count'])-rows,num_sources,len(manifest),num_epochs+1))
+    ok = len(new) == 0 and len(extra) == 1 and np.sum(store.index(ccd)['count'])-rows == num_sources and sorted(manifest) == sorted(exposures)
+    print('OK' if ok else '***Incremental check failed***')
+    shutil.rmtree(work_dir)
+    return ok
+
+
+def _subtract_args(args):
+    from diffim import subtract
+    return subtract(*args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='desdia benchmarks.')
+    parser.add_argument('bench',type=str,choices=['query','download','weight','align','diff','varlc','incremental'],help='Benchmark to run')
+    parser.add_argument('--db',type=str,default='./work/desdm.sqlite',help='SQLite stand-in database (created if missing)')
+    parser.add_argument('--cache',type=str,default=None,help='Local query cache file')
+    parser.add_argument('-f','--filter',type=str,default='g',help='Filter to use')
+    parser.add_argument('--field',type=str,default='SN-C3',help='Field name')
+    parser.add_argument('--pointing',type=int,default=0,help='Survey pointing number')
+    parser.add_argument('--repeat',type=int,default=3,help='Number of repeats')
+    parser.add_argument('--num_files',type=int,default=50,help='Number of files to download')
+    parser.add_argument('--num_images',type=int,default=4,help='Number of synthetic image pairs (diff benchmark)')
+    parser.add_argument('--size',type=float,default=8.,help='File size [MB]')
+    parser.add_argument('--image',type=str,default=None,help='red_immask file for the weight benchmark (synthetic if not given)')
+    parser.add_argument('--tile_dir',type=str,default=None,help='Tile directory with template and weighted images for the align benchmark')
+    parser.add_argument('-c','--ccd',type=int,default=1,help='Template CCD for the align benchmark')
+    parser.add_argument('-n','--threads',type=int,default=8,help='Number of threads')
+    parser.add_argument('--fail_every',type=int,default=0,help='Drop every n-th server response half way (tests retry/resume)')
+    args = parser.parse_args()
+    if args.bench == 'query':
+        bench_query(args.db,args.filter,args.field,args.pointing,args.repeat,args.cache)
+    elif args.bench == 'download':
+        bench_download(args.num_files,args.size,fail_every=args.fail_every)
+    elif args.bench == 'weight':
+        bench_weight(args.image)
+    elif args.bench == 'align':
+        bench_align(args.tile_dir,args.ccd,args.threads)
+    elif args.bench == 'diff':
+        bench_diff(args.num_images,args.threads)
+    elif args.bench == 'varlc':
+        bench_varlc()
+    elif args.bench == 'incremental':
+        bench_incremental()
+    return
+
+if __name__ == "__main__":
+    main()
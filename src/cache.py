@@ -0,0 +1,134 @@
+import os, io, time, shutil, sqlite3
+import numpy as np
+import argparse
+
+class QueryCache:
+
+    def __init__(self,cache_path,read_only=False):
+        # persistent on-disk cache of Query results (structured numpy arrays)
+        self.cache_path = cache_path
+        self.read_only = read_only
+        cache_dir = os.path.dirname(os.path.abspath(cache_path))
+        if not read_only and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        if read_only:
+            # never creates the file; a missing cache (or table) is a cache miss
+            self.con = None
+            if os.path.exists(cache_path):
+                try:
+                    self.con = sqlite3.connect('file:%s?mode=ro' % os.path.abspath(cache_path),uri=True)
+                except TypeError:
+                    # Python 2 sqlite3 has no uri=, the file exists so connect does not create it
+                    self.con = sqlite3.connect(cache_path)
+                    self.con.execute("pragma query_only = ON")
+        else:
+            self.con = sqlite3.connect(cache_path)
+            self.con.execute("create table if not exists query_cache (query text, band text, key text, version text, created real, data blob, primary key (query, band, key, version))")
+            self.con.commit()
+
+
+    def make_key(self,args):
+        # floats are rounded so that values read back from csv/db give the same key
+        key = []
+        for a in args:
+            if isinstance(a,(float,np.floating)):
+                key.append('%.8f' % a)
+            else:
+                key.append(str(a))
+        return ','.join(key)
+
+
+    def get(self,query,band,key,version):
+        # returns (hit, result); result may be None for a cached empty query
+        if self.con is None:
+            return False, None
+        try:
+            row = self.con.execute("select data from query_cache where query=? and band=? and key=? and version=?",(query,band,key,version)).fetchone()
+        except sqlite3.OperationalError:
+            # read-only cache without the table
+            return False, None
+        if row is None:
+            return False, None
+        if row[0] is None:
+            return True, None
+        return True, np.load(io.BytesIO(bytes(row[0])),allow_pickle=False)
+
+
+    def put(self,query,band,key,version,result):
+        if self.read_only: return
+        data = None
+        if result is not None:
+            buf = io.BytesIO()
+            np.save(buf,result,allow_pickle=False)
+            data = sqlite3.Binary(buf.getvalue())
+        self.con.execute("insert or replace into query_cache values (?,?,?,?,?,?)",(query,band,key,version,time.time(),data))
+        self.con.commit()
+
+
+    def invalidate(self,query=None,band=None,version=None,older_than=None):
+        # remove matching entries (everything if no selection is given)
+        if self.read_only:
+            print('***Cache %s is read-only, nothing invalidated***' % self.cache_path)
+            return 0
+        where = []; args = []
+        for col, val in [('query',query),('band',band),('version',version)]:
+            if val is not None:
+                where.append('%s=?' % col)
+                args.append(val)
+        if older_than is not None:
+            where.append('created<?')
+            args.append(older_than)
+        command = "delete from query_cache"
+        if len(where) > 0:
+            command += " where " + " and ".join(where)
+        num = self.con.execute(command,args).rowcount
+        self.con.commit()
+        return num
+
+
+    def snapshot(self,snapshot_path):
+        # copy of the cache to ship with grid jobs (opened with read_only=True there)
+        if self.con is not None:
+            self.con.commit()
+        shutil.copyfile(self.cache_path,snapshot_path)
+        return snapshot_path
+
+
+    def summary(self):
+        if self.con is None:
+            return []
+        return self.con.execute("select query, band, version, count(*) from query_cache group by query, band, version").fetchall()
+
+
+    def close(self):
+        if self.con is not None:
+            self.con.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the local Query result cache.')
+    parser.add_argument('cache',type=str,help='Cache file')
+    parser.add_argument('--snapshot',type=str,default=None,help='Write a snapshot of the cache for grid jobs')
+    parser.add_argument('--invalidate',action='store_true',help='Remove cached entries (filtered by --query/--band/--version/--days)')
+    parser.add_argument('--query',type=str,default=None,help='Query type (field, pointing, overlap, coord, object)')
+    parser.add_argument('-f','--filter',type=str,default=None,help='Filter')
+    parser.add_argument('--version',type=str,default=None,help='Processing version')
+    parser.add_argument('--days',type=float,default=None,help='Only entries older than this many days')
+    args = parser.parse_args()
+    cache = QueryCache(args.cache)
+    if args.invalidate:
+        older_than = None
+        if args.days is not None:
+            older_than = time.time() - args.days*86400.
+        num = cache.invalidate(args.query,args.filter,args.version,older_than)
+        print('Removed %d cached queries.' % num)
+    if args.snapshot is not None:
+        cache.snapshot(args.snapshot)
+        print('Wrote snapshot %s' % args.snapshot)
+    for query, band, version, num in cache.summary():
+        print('%-10s %s %-10s %d' % (query,band,version,num))
+    cache.close()
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import os
+import numpy as np
+import argparse
+from astropy.io import fits
+from scipy.spatial import cKDTree
+
+# columns of the forced photometry catalogs (etc/SN_diffim.sex.param)
+COLUMNS = ['NUMBER','ALPHAWIN_J2000','DELTAWIN_J2000','FLUX_APER','FLUXERR_APER']
+NPY_MAGIC = b'\x93NUMPY'
+FITS_MAGIC = b'SIMPLE'
+
+
+def catalog_dtype(num_ap):
+    return [('NUMBER',np.int32),('ALPHAWIN_J2000',np.float64),('DELTAWIN_J2000',np.float64),
+            ('FLUX_APER',np.float32,(num_ap,)),('FLUXERR_APER',np.float32,(num_ap,))]
+
+
+def read_ascii_head(filename):
+    # SExtractor ASCII_HEAD: "#   4 FLUX_APER   ..." per column, vector columns span several numbers
+    names, starts = [], []
+    with open(filename) as f:
+        for line in f:
+            if not line.startswith('#'): break
+            words = line[1:].split()
+            if len(words) >= 2 and words[0].isdigit():
+                starts.append(int(words[0])-1)
+                names.append(words[1])
+    data = np.loadtxt(filename,ndmin=2)
+    starts.append(data.shape[1])
+    num_ap = starts[names.index('FLUX_APER')+1]-starts[names.index('FLUX_APER')] if 'FLUX_APER' in names else 0
+    cat = np.zeros(len(data),dtype=catalog_dtype(num_ap))
+    for i, name in enumerate(names):
+        if name in COLUMNS:
+            cat[name] = data[:,starts[i]:starts[i+1]].reshape(cat[name].shape)
+    return cat
+
+
+def read_catalog(filename):
+    # binary catalogs are memory mapped (.npy written by photometry.py or SExtractor FITS_LDAC),
+    # ASCII_HEAD catalogs are parsed; the format is taken from the file itself, not the name
+    with open(filename,'rb') as f:
+        magic = f.read(6)
+    if magic == NPY_MAGIC:
+        return np.load(filename,mmap_mode='r')
+    if magic == FITS_MAGIC:
+        hdul = fits.open(filename,memmap=True)
+        # FITS_LDAC: LDAC_IMHEAD and LDAC_OBJECTS per image, the last table holds the detections
+        return hdul[-1].data
+    return read_ascii_head(filename)
+
+
+def write_catalog(filename,num,ra,dec,flux,fluxerr):
+    # .npy structured array under the catalog name (read back with read_catalog)
+    cat = np.zeros(len(num),dtype=catalog_dtype(flux.shape[1]))
+    cat['NUMBER'], cat['ALPHAWIN_J2000'], cat['DELTAWIN_J2000'] = num, ra, dec
+    cat['FLUX_APER'], cat['FLUXERR_APER'] = flux, fluxerr
+    with open(filename,'wb') as f:
+        np.save(f,cat)
+    return filename
+
+
+def check_catalog(cat,template):
+    # columns and apertures must match the template catalog; returns the problem or None
+    names = cat.dtype.names
+    for name in COLUMNS:
+        if name not in names:
+            return 'missing column %s' % name
+    if np.shape(cat['FLUX_APER'])[1:] != np.shape(template['FLUX_APER'])[1:]:
+        return 'number of apertures differs from template'
+    return None
+
+
+def rows_aligned(cat,template):
+    # forced photometry rows line up with the template detections
+    return len(cat) == len(template) and np.array_equal(cat['NUMBER'],template['NUMBER'])
+
+
+def unit_vectors(ra,dec):
+    ra, dec = np.radians(ra), np.radians(dec)
+    return np.column_stack([np.cos(dec)*np.cos(ra),np.cos(dec)*np.sin(ra),np.sin(dec)])
+
+
+def template_tree(template):
+    # KD-tree of the template detections on the unit sphere (built once per CCD)
+    return cKDTree(unit_vectors(template['ALPHAWIN_J2000'],template['DELTAWIN_J2000']))
+
+
+def match_catalog(cat,tree,radius=1.):
+    # associates the detections of an epoch catalog with template detections within radius [arcsec];
+    # returns (catalog rows, template rows), each template detection keeps its nearest epoch detection
+    dist, idx = tree.query(unit_vectors(cat['ALPHAWIN_J2000'],cat['DELTAWIN_J2000']),distance_upper_bound=2*np.sin(np.radians(radius/3600.)/2))
+    rows = np.where(np.isfinite(dist))[0]
+    order = np.lexsort((dist[rows],idx[rows]))
+    rows = rows[order]
+    first = np.ones(len(rows),dtype=bool)
+    first[1:] = idx[rows][1:] != idx[rows][:-1]
+    rows = rows[first]
+    return rows, idx[rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert forced photometry catalogs (ASCII_HEAD or FITS_LDAC) to .npy.')
+    parser.add_argument('catalogs',nargs='+',type=str,help='Catalogs')
+    args = parser.parse_args()
+    for filename in args.catalogs:
+        cat = read_catalog(filename)
+        out = os.path.splitext(filename)[0]+'.npy'
+        write_catalog(out,cat['NUMBER'],cat['ALPHAWIN_J2000'],cat['DELTAWIN_J2000'],np.reshape(cat['FLUX_APER'],(len(cat),-1)),np.reshape(cat['FLUXERR_APER'],(len(cat),-1)))
+        print('%s -> %s (%d rows)' % (filename,out,len(cat)))
+    return
+
+if __name__ == "__main__":
+    main()
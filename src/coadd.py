@@ -0,0 +1,102 @@
+import os, time
+import numpy as np
+import argparse
+from astropy.io import fits
+from reproject import background
+
+# streaming coadd of aligned difference images (same pixel grid, e.g. *_template_c<ccd>_diff.fits):
+# images and weights are memory mapped one at a time, only the accumulators are kept in memory
+#   sum       sum of |diff| over all pixels (offset.py)
+#   average   mean of |diff| over pixels with weight > 0, like swarp COMBINE_TYPE AVERAGE (etc/SN_distemp.swarp)
+#   weighted  weighted mean of |diff|
+#   clipped   average after clipping pixels more than nsigma from the per-pixel mean (second pass)
+# the output weight is the sum of the input weights of the combined pixels
+# subtract_back removes the background of each |diff| before it is combined, like swarp SUBTRACT_BACK Y
+MODES = ['sum','average','weighted','clipped']
+
+
+def read_pair(filename):
+    # memory mapped image and weight (.weight.fits next to it, all ones if missing)
+    data = fits.getdata(filename,memmap=True)
+    weight_file = filename[0:-5]+'.weight.fits'
+    weight = fits.getdata(weight_file,memmap=True) if os.path.exists(weight_file) else np.ones(data.shape,dtype=np.float32)
+    return data, weight
+
+
+def coadd_diff(diff_files,out_sci=None,out_wgt=None,mode='sum',nsigma=3.,subtract_back=False):
+    # returns (coadd, weight); unreadable or empty images are skipped
+    if mode not in MODES:
+        raise ValueError('Unknown coadd mode %s' % mode)
+    acc = None
+    for npass in range(2 if mode == 'clipped' else 1):
+        if npass == 1:
+            # per-pixel mean and scatter from the first pass
+            with np.errstate(divide='ignore',invalid='ignore'):
+                mean = acc/norm
+                std = np.sqrt(np.maximum(acc2/norm-mean**2,0.))
+            del acc2
+        acc = None
+        header = None
+        num_images = 0
+        for filename in diff_files:
+            try:
+                data, weight = read_pair(filename)
+                if acc is None:
+                    acc = np.zeros(data.shape,dtype=np.float64)
+                    norm = np.zeros(data.shape,dtype=np.float64)
+                    wsum = np.zeros(data.shape,dtype=np.float64)
+                    if mode == 'clipped' and npass == 0:
+                        acc2 = np.zeros(data.shape,dtype=np.float64)
+                    header = fits.getheader(filename)
+                absdata = np.abs(data)
+                good = weight > 0
+                if subtract_back:
+                    absdata = absdata - background(absdata,weight)
+                if mode == 'sum':
+                    acc += absdata
+                elif mode == 'weighted':
+                    acc += np.where(good,weight*absdata,0.)
+                    norm += weight*good
+                else:
+                    if npass == 1:
+                        good &= np.abs(absdata-mean) <= nsigma*std
+                    acc += np.where(good,absdata,0.)
+                    norm += good
+                    if npass == 0 and mode == 'clipped':
+                        acc2 += np.where(good,absdata,0.)**2
+                wsum += np.where(good,weight,0.)
+                num_images += 1
+            except Exception as e:
+                print('***Skipping %s: %s***' % (os.path.basename(filename),e))
+        if acc is None:
+            print('***No difference images to coadd***')
+            return None, None
+    coadd = acc
+    if mode != 'sum':
+        with np.errstate(divide='ignore',invalid='ignore'):
+            coadd = np.where(norm > 0,acc/norm,0.)
+    coadd = coadd.astype(np.float32)
+    if out_sci is not None:
+        header['NCOMBINE'] = (num_images,'Number of coadded difference images')
+        header['COMBINET'] = (mode.upper(),'Coadd of |diff|')
+        fits.PrimaryHDU(coadd,header).writeto(out_sci,overwrite=True,output_verify='ignore')
+        if out_wgt is not None:
+            fits.PrimaryHDU(wsum.astype(np.float32),header).writeto(out_wgt,overwrite=True,output_verify='ignore')
+    return coadd, wsum
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Streaming coadd of |diff| of aligned difference images.')
+    parser.add_argument('out',type=str,help='Output coadd (weight written next to it)')
+    parser.add_argument('diff',nargs='+',type=str,help='Aligned difference images')
+    parser.add_argument('--mode',type=str,default='average',choices=MODES,help='Combination')
+    parser.add_argument('--nsigma',type=float,default=3.,help='Clipping threshold (clipped mode)')
+    parser.add_argument('--back',action='store_true',help='Subtract the background of each image before combining')
+    args = parser.parse_args()
+    start_time = time.time()
+    coadd_diff(args.diff,args.out,args.out[0:-5]+'.weight.fits',args.mode,args.nsigma,args.back)
+    print('%d images, %.2f s' % (len(args.diff),time.time()-start_time))
+    return
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,16 @@ import argparse
 import commands
 from random import randint
 import query, pipeline
+from footprint import FootprintIndex, in_footprint
 from misc import bash
+from merge import merge
+from variability import variability
 
-def start_desdia(pointing,ccd=None,targetra=None,targetdec=None,template_season=6,band='g',work_dir='./work',out_dir=None,threads=1,debug_mode=False,offset=False):
+def start_desdia(pointing,ccd=None,targetra=None,targetdec=None,template_season=6,band='g',work_dir='./work',out_dir=None,threads=1,debug_mode=False,offset=False,cache_path=None,footprint_dir=None,download_threads=4,image_cache=None,cache_budget=100.,weight='makeweight',template_store=None,align_mode='single',diff_backend='hotpants',cutout_size=None,photometry='sextractor',catalog_type='ascii',incremental=False,merge_catalog=False,variability_stats=False):
     # Start
     max_threads = 32
     top_dir = None
+    cache_read_only = False
     fermigrid = False
     xfer_dir = "/pnfs/des/persistent/${USER}"
     # If code is running on grid
@@ -25,19 +29,33 @@ def start_desdia(pointing,ccd=None,targetra=None,targetdec=None,template_season=
         top_dir = os.environ['CONDOR_DIR_INPUT']
         fermigrid = True
         max_threads = threads # Match to requested number of CPUs
-        time.sleep(randint(1,10)) # Be less harsh on database
+        # Use query cache snapshot shipped with the job if there is one
+        if cache_path is None and os.path.exists(os.path.join(top_dir,'query_cache.db')):
+            cache_path = os.path.join(top_dir,'query_cache.db')
+            cache_read_only = True
+        else:
+            time.sleep(randint(1,10)) # Be less harsh on database
+        # Use template store shipped with the job if there is one
+        if template_store is None and os.path.exists(os.path.join(top_dir,'templates')):
+            template_store = os.path.join(top_dir,'templates')
     # Create directory for tile
     tile_dir = os.path.join(work_dir,pointing)
     #if out_dir is None:
     #    out_dir = os.path.join(tile_dir,band)
     # Set up database
-    query_sci = query.Query('db-dessci')
+    query_sci = query.Query('db-dessci',cache_path,cache_read_only)
     print("Querying single-epoch images for %s." % pointing)
     # Get reduced filenames and related info
     # Supernova field
     if pointing.startswith('SN-') or pointing.lower() == "cosmos":
         # pointing is the fieldname in this case
-        image_list = query_sci.get_image_info_field(pointing,band)
+        # new exposures of an incremental run have to come from the database
+        if incremental and query_sci.cache is not None:
+            query_sci.cache.invalidate(query='field',band=band)
+        # stream query results so downloads start with the first batch
+        image_list = query_sci.iter_image_info_field(pointing,band)
+        if ccd is not None:
+            image_list = (b[b['ccd']==ccd] for b in image_list)
     # Main survey (pointing is a value from 0-2038)
     else:
         if targetra is None and targetdec is None:
@@ -48,14 +66,20 @@ def start_desdia(pointing,ccd=None,targetra=None,targetdec=None,template_season=
             # Get template filename info at requested pointing
             image_list = query_sci.get_image_info_pointing(data['tra'],data['tdec'],data['mjd_obs'],band=band)
         else:
-            # TODO: RACROSS0 edge case
             # Get template pointing at target
-            pointing_list = query_sci.get_pointing_coord(targetra,targetdec,band,template_season)
+            if footprint_dir is not None:
+                # Local footprint index (handles RA=0 crossing)
+                pointing_list = FootprintIndex(footprint_dir).get_pointing_coord(targetra,targetdec,band,template_season)
+            else:
+                pointing_list = query_sci.get_pointing_coord(targetra,targetdec,band,template_season)
+            if pointing_list is None:
+                print("***No pointing found at target!***")
+                return
             # Get template filename info at requested pointing
             image_list = query_sci.get_image_info_pointing(pointing_list['TRADEG'][0],pointing_list['TDECDEG'][0],pointing_list['mjd_obs'][0],band=band)
             # Restrict to images with just the target
             if ccd is None:
-                mask_target = (image_list['ramin'] < targetra) & (targetra < image_list['ramax']) & (image_list['decmin'] < targetdec) & (targetdec < image_list['decmax'])
+                mask_target = in_footprint(targetra,targetdec,image_list['ramin'],image_list['ramax'],image_list['decmin'],image_list['decmax'])
                 ccd = image_list['ccd'][mask_target]
             else:
                 print('***Warning: You specified a CCD and a target coordinate, which is usually not desired.***')
@@ -64,11 +88,14 @@ def start_desdia(pointing,ccd=None,targetra=None,targetdec=None,template_season=
         return
     
     # If ccd is specified, run in single-CCD mode
-    if ccd is not None:
+    if ccd is not None and isinstance(image_list,np.ndarray):
         image_list = image_list[image_list['ccd']==ccd]
     
     # Run pipeline
-    des_pipeline = pipeline.Pipeline(band,query_sci.usr,query_sci.psw,tile_dir,top_dir,debug_mode)
+    target = None
+    if targetra is not None and targetdec is not None:
+        target = (targetra,targetdec)
+    des_pipeline = pipeline.Pipeline(band,query_sci.usr,query_sci.psw,tile_dir,top_dir,debug_mode,download_threads,image_cache,cache_budget,weight,template_store,pointing,align_mode,diff_backend,target,cutout_size,photometry,catalog_type,incremental)
     num_threads = np.clip(threads,0,max_threads)
     
     print("Running pipeline.")
@@ -76,10 +103,21 @@ def start_desdia(pointing,ccd=None,targetra=None,targetdec=None,template_season=
     if pointing.startswith('SN-') or pointing.lower() == "cosmos":
         # Here image_list is all image info
         image_list_all = des_pipeline.run_ccd_sn(image_list,num_threads,template_season,fermigrid)
+        if len(image_list_all) == 0:
+            print("***No images found in field/tile %s!***" % pointing)
+            return
     # Main survey
     else:
         # Here image_list is just the template image info
         image_list_all = des_pipeline.run_ccd_survey(image_list,query_sci,num_threads,template_season,fermigrid,band,coadd_diff=offset,offset=offset)
+    # Merge the CCD light curves into one catalog of deduplicated objects
+    if merge_catalog:
+        print('Merging light curves.')
+        merge([os.path.join(tile_dir,'lightcurves')],os.path.join(tile_dir,'merged'),num_threads)
+    # Rank all sources by variability
+    if variability_stats:
+        print('Computing variability statistics.')
+        variability([os.path.join(tile_dir,'lightcurves')],os.path.join(tile_dir,'variability.npy'),num_threads)
     # Save data to out_dir
     b = np.vstack(map(list, image_list_all))
     np.savetxt(os.path.join(tile_dir,'image_list_all.csv'), b, fmt='\n'.join(['%s']*b.shape[1]))
@@ -108,6 +146,21 @@ def main():
     parser.add_argument('-f','--filter',type=str,default='g',help='Filter to use')
     parser.add_argument('-n','--threads',type=int,default=1,help='Number of threads')
     parser.add_argument('-s','--season',type=int,default=6,help='Template season to use Y[0-6]')
+    parser.add_argument('--download_threads',type=int,default=4,help='Number of concurrent downloads (independent of --threads)')
+    parser.add_argument('--cache',type=str,default=None,help='Local query cache file (see src/cache.py)')
+    parser.add_argument('--weight',type=str,default='makeweight',choices=['makeweight','native'],help='Weight map backend (makeWeight binary or in-process [experimental, mask bits not yet validated against makeWeight])')
+    parser.add_argument('--align',type=str,default='single',choices=['single','batch','native'],help='Alignment mode (one swarp per image, multi-image swarp runs per template CCD [experimental, not yet validated against single] or in-process resampling)')
+    parser.add_argument('--diff',type=str,default='hotpants',choices=['hotpants','native'],help='Difference imaging backend (hotpants or in-process Alard-Lupton fit)')
+    parser.add_argument('--photometry',type=str,default='sextractor',choices=['sextractor','native'],help='Forced photometry backend (SExtractor per epoch or in-process over all epochs)')
+    parser.add_argument('--catalog',type=str,default='ascii',choices=['ascii','binary'],help='Catalog format (ASCII_HEAD text or binary FITS_LDAC/.npy)')
+    parser.add_argument('--incremental',action='store_true',help='SN fields: only process exposures not yet in the light curves and append them')
+    parser.add_argument('--merge',action='store_true',help='Merge the light curves of all CCDs into one catalog of deduplicated objects')
+    parser.add_argument('--variability',action='store_true',help='Write variability statistics of all sources (variability.npy)')
+    parser.add_argument('--cutout',type=int,default=None,help='In TARGET mode, only process a box of this size [pixels] around the target')
+    parser.add_argument('--template_store',type=str,default=None,help='Persistent template store directory (read-only if not writable)')
+    parser.add_argument('--image_cache',type=str,default=None,help='Shared image cache directory (see src/imcache.py)')
+    parser.add_argument('--cache_budget',type=float,default=100.,help='Disk budget of the image cache [GB]')
+    parser.add_argument('--footprints',type=str,default=None,help='Local CCD footprint index directory (see src/footprint.py)')
     args = parser.parse_args()
     band = np.asscalar(np.asarray(args.filter))
     work_dir = np.asscalar(np.asarray(args.work_dir))
@@ -136,6 +189,8 @@ def main():
         print("RA:             %f [deg.]" % args.ra)
         print("dec:            %f [deg.]" % args.dec)
         print("CCD:            auto")
+        if args.cutout is not None:
+            print("Cutout:         %d pixels" % args.cutout)
     elif args.ccd is None:
         print("CCD:         all")
     else:
@@ -144,8 +199,24 @@ def main():
     print("Template:      Y%d" % args.season)
     print("Work directory: %s" % work_dir)
     print("Threads:        %d" % args.threads)
+    print("Downloads:      %d" % args.download_threads)
     print("Debug mode:     %d" % args.debug)
     print("offset    :     %d" % args.offset)
+    print("Query cache:    %s" % args.cache)
+    print("Image cache:    %s" % args.image_cache)
+    print("Weight maps:    %s" % args.weight)
+    if args.weight == 'native':
+        print("                (experimental: check with benchmark.py weight before use)")
+    print("Templates:      %s" % args.template_store)
+    print("Alignment:      %s" % args.align)
+    if args.align == 'batch':
+        print("                (experimental: check with benchmark.py align before use)")
+    print("Differencing:   %s" % args.diff)
+    print("Photometry:     %s" % args.photometry)
+    print("Catalogs:       %s" % args.catalog)
+    print("Incremental:    %s" % args.incremental)
+    print("Merge:          %s" % args.merge)
+    print("Variability:    %s" % args.variability)
     print("==============================================")
     if args.nowarn == True:
         import warnings
@@ -167,7 +238,7 @@ def main():
     #        tile = tile_info[num_proc][0]
     #    start_tile(tile,args.ccd,band,work_dir,out_dir,threads,args.debug)
     # single-tile mode
-    start_desdia(pointing,args.ccd,args.ra,args.dec,args.season,band,work_dir,out_dir,args.threads,args.debug,args.offset)
+    start_desdia(pointing,args.ccd,args.ra,args.dec,args.season,band,work_dir,out_dir,args.threads,args.debug,args.offset,args.cache,args.footprints,args.download_threads,args.image_cache,args.cache_budget,args.weight,args.template_store,args.align,args.diff,args.cutout,args.photometry,args.catalog,args.incremental,args.merge,args.variability)
     return
 
 if __name__ == "__main__":
@@ -0,0 +1,300 @@
+import os, time
+import numpy as np
+import argparse
+from astropy.io import fits
+from scipy import ndimage, fft
+from scipy.signal import fftconvolve
+
+# in-process Alard & Lupton (1998) image subtraction, configured by a hotpants parameter string
+# (etc/DES.hotpants); the template is convolved to match the image (hotpants -c t)
+HOTPANTS_DEFAULTS = {'r': 10, 'rss': 15, 'ng': [3,6,0.7,4,1.5,2,3.0], 'ko': 2, 'bgo': 1, 'nsx': 10, 'nsy': 10,
+                     'nss': 3, 'ft': 20., 'ks': 2., 'kfm': 0.99, 'n': 't', 'fi': 1e-30, 'fin': 0.,
+                     'il': -1e10, 'iu': 25000., 'tl': -1e10, 'tu': 25000.}
+
+
+def parse_hotpants(pars):
+    # hotpants command line options -> dict (flags without value are True)
+    options = dict(HOTPANTS_DEFAULTS)
+    tokens = pars.split()
+    i = 0
+    while i < len(tokens):
+        key = tokens[i].lstrip('-')
+        values = []
+        i += 1
+        while i < len(tokens) and not (tokens[i].startswith('-') and not _is_number(tokens[i])):
+            values.append(tokens[i])
+            i += 1
+        if key == 'ng':
+            options[key] = [int(values[0])] + [float(v) if k % 2 else int(v) for k, v in enumerate(values[1:])]
+        elif len(values) == 0:
+            options[key] = True
+        elif _is_number(values[0]):
+            v = float(values[0])
+            options[key] = int(v) if v == int(v) and key in ['r','rss','ko','bgo','nsx','nsy','nss'] else v
+        else:
+            options[key] = values[0]
+    return options
+
+
+def _is_number(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+
+def basis_kernels(r,ng):
+    # Gaussians times polynomials (-ng ngauss deg0 sigma0 deg1 sigma1 ...) on a (2r+1)^2 grid;
+    # the first one is normalized to unit sum, all others have zero sum (constant photometric
+    # scale is carried by the first kernel only)
+    y, x = np.mgrid[-r:r+1,-r:r+1].astype(float)
+    kernels = []
+    for k in range(ng[0]):
+        deg, sigma = ng[1+2*k], ng[2+2*k]
+        g = np.exp(-(x**2+y**2)/(2.*sigma**2))
+        # far wings would underflow to subnormal numbers in the FFTs
+        g[g < 1e-15] = 0.
+        for i in range(deg+1):
+            for j in range(deg+1-i):
+                kernels.append(g*x**i*y**j)
+    kernels = [k/np.sqrt(np.sum(k**2)) for k in kernels]
+    kernels[0] = kernels[0]/np.sum(kernels[0])
+    for n in range(1,len(kernels)):
+        kernels[n] = kernels[n] - np.sum(kernels[n])*kernels[0]
+    return np.array(kernels)
+
+
+def poly_terms(u,v,order):
+    # u^i v^j with i+j <= order
+    return [u**i*v**j for i in range(order+1) for j in range(order+1-i)]
+
+
+def find_substamps(template,good,options,margin):
+    # up to nss bright, isolated and unmasked peaks per stamp (nsx x nsy stamps)
+    ny, nx = template.shape
+    rss = options['rss']
+    values = template[good]
+    med = np.median(values)
+    sigma = 1.4826*np.median(np.abs(values-med))
+    peaks = (template == ndimage.maximum_filter(template,size=5)) & (template > med+options['ft']*sigma)
+    peaks &= (template < options['tu'])
+    # whole substamp must be unmasked (in template and image)
+    peaks &= ndimage.minimum_filter(good.astype(np.uint8),size=2*rss+1) > 0
+    peaks[:margin,:] = False; peaks[-margin:,:] = False
+    peaks[:,:margin] = False; peaks[:,-margin:] = False
+    ys, xs = np.nonzero(peaks)
+    order = np.argsort(-template[ys,xs])
+    ys, xs = ys[order], xs[order]
+    stamp = (ys*options['nsy']//ny)*options['nsx'] + xs*options['nsx']//nx
+    centers = []
+    count = {}
+    for y, x, s in zip(ys,xs,stamp):
+        if count.get(s,0) >= options['nss']: continue
+        # isolated from the substamps already selected
+        if any([abs(y-cy) < rss and abs(x-cx) < rss for cy, cx in centers]): continue
+        centers.append((y,x))
+        count[s] = count.get(s,0) + 1
+    return centers
+
+
+def stamp_convolutions(template,centers,kernels,options):
+    # template substamps convolved with every basis kernel (only depends on the template),
+    # all basis kernels are applied to a substamp with one FFT of the template cutout
+    r, rss = options['r'], options['rss']
+    size = 2*(rss+r)+1
+    fshape = [fft.next_fast_len(size+2*r,True)]*2
+    kf = _rfft2_kernel(kernels[:,::-1,::-1],fshape)
+    conv = np.zeros((len(centers),len(kernels),(2*rss+1)**2),dtype=np.float32)
+    for i, (cy, cx) in enumerate(centers):
+        t = template[cy-rss-r:cy+rss+r+1,cx-rss-r:cx+rss+r+1]
+        conv[i] = fft.irfft2(fft.rfft2(t,fshape)[None]*kf,fshape)[:,2*r:size,2*r:size].reshape(len(kernels),-1)
+    return conv
+
+
+def fit_kernel(image,var,centers,conv,options,shape,max_iter=3):
+    # least squares fit of spatially varying kernel coefficients and background,
+    # substamps with outlying residuals (ks sigma) are rejected and the fit repeated
+    ny, nx = shape
+    rss = options['rss']
+    ko, bgo = options['ko'], options['bgo']
+    num_k = conv.shape[1]*len(poly_terms(0.,0.,ko))
+    y, x = np.mgrid[-rss:rss+1,-rss:rss+1].astype(float)
+    rows = []
+    for (cy, cx), c in zip(centers,conv):
+        sl = (slice(cy-rss,cy+rss+1),slice(cx-rss,cx+rss+1))
+        # kernel coefficients are evaluated at the substamp center, background per pixel
+        pk = np.array(poly_terms((cx-nx/2.)/(nx/2.),(cy-ny/2.)/(ny/2.),ko))
+        pb = np.array(poly_terms(((cx+x)-nx/2.)/(nx/2.),((cy+y)-ny/2.)/(ny/2.),bgo)).reshape(-1,c.shape[1])
+        a = np.vstack([(c[:,None,:]*pk[None,:,None]).reshape(num_k,-1),pb]).T.astype(np.float64)
+        b, w = image[sl].ravel(), 1./var[sl].ravel()
+        rows.append((a,b,w,np.dot(a.T*w,a),np.dot(a.T*w,b)))
+    use = np.ones(len(rows),dtype=bool)
+    for it in range(max_iter+1):
+        if np.sum(use) == 0: break
+        ata = sum([row[3] for row, u in zip(rows,use) if u])
+        atb = sum([row[4] for row, u in zip(rows,use) if u])
+        coeffs = np.linalg.lstsq(ata,atb,rcond=None)[0]
+        chi2 = np.array([np.mean((b-np.dot(a,coeffs))**2*w) for a, b, w, ata_s, atb_s in rows])
+        med = np.median(chi2[use])
+        mad = 1.4826*np.median(np.abs(chi2[use]-med))
+        reject = use & (chi2 > med+options['ks']*max(mad,1e-3*med))
+        if np.sum(reject) == 0 or np.sum(use & ~reject) < 3: break
+        use &= ~reject
+    return coeffs[:num_k].reshape(conv.shape[1],-1), coeffs[num_k:], np.sum(use)
+
+
+def _rfft2_kernel(kernel,fshape):
+    # negligible high frequencies of the wide Gaussians would otherwise underflow to subnormal numbers
+    kf = fft.rfft2(kernel,fshape)
+    kf[np.abs(kf) < 1e-15*np.max(np.abs(kf),axis=(-2,-1),keepdims=True)] = 0.
+    return kf
+
+
+def convolve_template(template,spatial_kernels,ko,shape):
+    # sum_p P_p(x,y) (template * k_p) with one FFT per spatial term
+    ny, nx = shape
+    r = (spatial_kernels.shape[1]-1)//2
+    fshape = [fft.next_fast_len(ny+2*r,True),fft.next_fast_len(nx+2*r,True)]
+    tf = fft.rfft2(template,fshape)
+    yy, xx = np.mgrid[0:ny,0:nx]
+    pk = poly_terms((xx-nx/2.)/(nx/2.),(yy-ny/2.)/(ny/2.),ko)
+    out = np.zeros(shape,dtype=np.float64)
+    for k, p in zip(spatial_kernels,pk):
+        conv = fft.irfft2(tf*_rfft2_kernel(k,fshape),fshape)[r:r+ny,r:r+nx]
+        out += p*conv
+    return out
+
+
+def read_template(template_sci,template_wgt,options):
+    template = fits.getdata(template_sci).astype(np.float64)
+    wt = fits.getdata(template_wgt).astype(np.float64)
+    good_t = (wt > 0) & np.isfinite(template) & (template > options['tl'])
+    var_t = np.where(good_t,1./np.where(good_t,wt,1.),0.)
+    return template, good_t, var_t
+
+
+def template_stamps(template_sci,template_wgt,pars):
+    # substamp centers (y, x) selected on the template
+    options = parse_hotpants(pars)
+    template, good_t, var_t = read_template(template_sci,template_wgt,options)
+    centers = find_substamps(np.where(good_t,template,-np.inf),good_t,options,options['r']+options['rss'])
+    return np.array(centers,dtype=int).reshape(-1,2)
+
+
+def prepare_template(template_sci,template_wgt,pars,prep_file=None):
+    # template side of the fit, shared by all epochs of a CCD: substamp centers, their basis
+    # convolutions, the fill value for masked pixels and the distance to the nearest masked pixel
+    options = parse_hotpants(pars)
+    r, rss = options['r'], options['rss']
+    template, good_t, var_t = read_template(template_sci,template_wgt,options)
+    fill = np.median(template[good_t])
+    centers = np.array(find_substamps(np.where(good_t,template,-np.inf),good_t,options,r+rss),dtype=int).reshape(-1,2)
+    kernels = basis_kernels(r,options['ng'])
+    if np.all(good_t):
+        dist = np.full(good_t.shape,np.inf,dtype=np.float32)
+    else:
+        dist = ndimage.distance_transform_edt(good_t).astype(np.float32)
+    prep = {'centers': centers, 'conv': stamp_convolutions(np.where(good_t,template,fill),centers,kernels,options),
+            'fill': fill, 'dist': dist, 'pars': pars}
+    if prep_file is not None:
+        # written under a temporary name, concurrent jobs only see complete files
+        tmp_file = "%s.tmp%d.npz" % (prep_file[:-4],os.getpid())
+        np.savez(tmp_file,**prep)
+        os.rename(tmp_file,prep_file)
+    return prep
+
+
+def load_template(template_sci,template_wgt,pars,prep_file):
+    # stored template precompute, rebuilt if missing, older than the template or for other parameters
+    if prep_file is not None and os.path.exists(prep_file) and os.path.getmtime(prep_file) >= os.path.getmtime(template_sci):
+        prep = dict(np.load(prep_file))
+        if str(prep['pars']) == pars:
+            return prep
+    return prepare_template(template_sci,template_wgt,pars,prep_file)
+
+
+def subtract(image_sci,image_wgt,template_sci,template_wgt,out_sci,out_wgt,pars,prep_file=None):
+    # writes the difference image (normalized to the template, hotpants -n t) and its noise image
+    # (as hotpants -oni); returns the number of substamps used
+    # prep_file holds the template precompute (prepare_template), shared by all epochs
+    options = parse_hotpants(pars)
+    r, rss, ko, bgo = options['r'], options['rss'], options['ko'], options['bgo']
+    prep = load_template(template_sci,template_wgt,pars,prep_file)
+    header = fits.getheader(image_sci)
+    image = fits.getdata(image_sci).astype(np.float64)
+    wi = fits.getdata(image_wgt).astype(np.float64)
+    template, good_t, var_t = read_template(template_sci,template_wgt,options)
+    shape = image.shape
+    ny, nx = shape
+    good_i = (wi > 0) & np.isfinite(image) & (image > options['il']) & (image < options['iu'])
+    var_i = np.where(good_i,1./np.where(good_i,wi,1.),0.)
+    # masked template pixels would ring through the convolution
+    template_fill = np.where(good_t,template,prep['fill'])
+    kernels = basis_kernels(r,options['ng'])
+    # template substamps that are also unmasked in the image
+    use = np.array([np.all(good_i[cy-rss:cy+rss+1,cx-rss:cx+rss+1]) for cy, cx in prep['centers']],dtype=bool)
+    centers, conv = prep['centers'][use], prep['conv'][use]
+    num_k = len(kernels)*len(poly_terms(0.,0.,ko))
+    if len(centers) < 3 or len(centers)*(2*rss+1)**2 < num_k:
+        raise RuntimeError('only %d substamps found' % len(centers))
+    coeffs, coeffs_bg, num_used = fit_kernel(image,np.where(good_i & good_t,var_i+var_t,np.inf),centers,conv,options,shape)
+    # kernel of each spatial term
+    spatial_kernels = np.tensordot(coeffs.T,kernels,axes=1)
+    conv = convolve_template(template_fill,spatial_kernels[:,::-1,::-1],ko,shape)
+    yy, xx = np.mgrid[0:ny,0:nx]
+    u, v = (xx-nx/2.)/(nx/2.), (yy-ny/2.)/(ny/2.)
+    bg = sum([c*p for c, p in zip(coeffs_bg,poly_terms(u,v,bgo))])
+    # photometric scale: only the first basis kernel has non-zero sum
+    ksum = sum([c*p for c, p in zip(coeffs[0],poly_terms(u,v,ko))])
+    diff = image - conv - bg
+    # variance: image + template variance convolved with the squared kernel at the center (-convvar)
+    kernel_center = spatial_kernels[0]
+    var = var_i + fftconvolve(var_t,kernel_center[::-1,::-1]**2,mode='same')
+    # masked template pixels spread over the kernel core (kfm of the absolute kernel flux)
+    kabs = np.abs(kernel_center)
+    yk, xk = np.mgrid[-r:r+1,-r:r+1]
+    rad = np.hypot(xk,yk).ravel()
+    order = np.argsort(rad)
+    frac = np.cumsum(kabs.ravel()[order])/np.sum(kabs)
+    core = rad[order][min(np.searchsorted(frac,options['kfm']),len(frac)-1)]
+    bad = ~good_i | (prep['dist'] <= core)
+    if options['n'] == 't':
+        diff = diff/ksum
+        var = var/ksum**2
+    diff = np.where(bad,options['fi'],diff).astype(np.float32)
+    noise = np.where(bad,options['fin'],np.sqrt(np.maximum(var,0.))).astype(np.float32)
+    header['KSUM00'] = (float(np.mean(ksum)),'Mean kernel sum')
+    header['NSTAMPS'] = (int(num_used),'Substamps used in kernel fit')
+    fits.PrimaryHDU(data=diff,header=header).writeto(out_sci,overwrite=True,output_verify='ignore')
+    fits.PrimaryHDU(data=noise,header=header).writeto(out_wgt,overwrite=True,output_verify='ignore')
+    return int(num_used)
+
+
+def write_stamp_list(centers,ssf_file):
+    # substamp centers for hotpants -ssf (1-based x y)
+    with open(ssf_file,'w') as f:
+        for cy, cx in centers:
+            f.write('%d %d\n' % (cx+1,cy+1))
+    return ssf_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description='In-process Alard-Lupton image subtraction (hotpants parameters).')
+    parser.add_argument('image',type=str,help='Image (with .weight.fits next to it)')
+    parser.add_argument('template',type=str,help='Template (with .weight.fits next to it)')
+    parser.add_argument('out',type=str,help='Output difference image')
+    parser.add_argument('--pars',type=str,default=None,help='hotpants parameter file (default etc/DES.hotpants)')
+    args = parser.parse_args()
+    pars_file = args.pars
+    if pars_file is None:
+        top_dir = '/'.join(os.path.dirname(os.path.abspath(__file__)).split('/')[0:-1])
+        pars_file = os.path.join(top_dir,'etc/DES.hotpants')
+    pars = open(pars_file).read()
+    start_time = time.time()
+    num = subtract(args.image,args.image[:-5]+'.weight.fits',args.template,args.template[:-5]+'.weight.fits',args.out,args.out[:-5]+'.weight.fits',pars)
+    print('%d substamps, %.2f s' % (num,time.time()-start_time))
+    return
+
+if __name__ == "__main__":
+    main()
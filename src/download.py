@@ -0,0 +1,237 @@
+import os, ssl, time, base64, threading
+import numpy as np
+try:
+    import http.client as httplib
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse
+except ImportError: # python 2
+    import httplib
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse
+
+class Downloader:
+
+    def __init__(self,usr=None,psw=None,max_connections=4,retries=3,backoff=2.,timeout=120.,chunk_size=1<<20):
+        # in-process replacement for wget with keep-alive connections shared between threads
+        self.headers = {"Connection": "keep-alive"}
+        if usr is not None:
+            auth = base64.b64encode(("%s:%s" % (usr,psw)).encode()).decode()
+            self.headers["Authorization"] = "Basic %s" % auth
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        # at most max_connections downloads at once, independent of the pipeline thread count
+        self.semaphore = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = {} # idle connections by (scheme, host, port)
+        self.stats = []
+
+
+    def get_connection(self,scheme,host,port,fresh=False):
+        # returns (connection, reused); fresh=True always opens a new connection
+        with self.lock:
+            idle = self.idle.get((scheme,host,port),[])
+            if len(idle) > 0 and not fresh:
+                return idle.pop(), True
+        if scheme == "https":
+            # same as wget --no-check-certificate
+            context = ssl._create_unverified_context()
+            return httplib.HTTPSConnection(host,port,timeout=self.timeout,context=context), False
+        return httplib.HTTPConnection(host,port,timeout=self.timeout), False
+
+
+    def release_connection(self,scheme,host,port,con):
+        with self.lock:
+            self.idle.setdefault((scheme,host,port),[]).append(con)
+
+
+    def drop_idle(self,scheme,host,port):
+        # idle connections to a host that closed one of them are likely stale as well
+        with self.lock:
+            idle = self.idle.pop((scheme,host,port),[])
+        for con in idle:
+            con.close()
+
+
+    def fetch(self,url,part_path,redirects=5):
+        # one attempt, resumes from the size of part_path; returns number of bytes written
+        u = urlparse(url)
+        port = u.port or (443 if u.scheme == "https" else 80)
+        path = u.path + ("?" + u.query if u.query else "")
+        headers = dict(self.headers)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > 0:
+            headers["Range"] = "bytes=%d-" % offset
+        con, reused = self.get_connection(u.scheme,u.hostname,port)
+        try:
+            con.request("GET",path,headers=headers)
+            response = con.getresponse()
+        except Exception:
+            con.close()
+            if not reused: raise
+            # idle connection was closed by the server, open a new one
+            self.drop_idle(u.scheme,u.hostname,port)
+            con, reused = self.get_connection(u.scheme,u.hostname,port,fresh=True)
+            con.request("GET",path,headers=headers)
+            response = con.getresponse()
+        if response.status in (301,302,303,307,308) and redirects > 0:
+            location = response.getheader("Location")
+            response.read()
+            self.release_connection(u.scheme,u.hostname,port,con)
+            if location.startswith("/"):
+                location = "%s://%s%s" % (u.scheme,u.netloc,location)
+            return self.fetch(location,part_path,redirects-1)
+        if response.status == 416: # already complete
+            response.read()
+            self.release_connection(u.scheme,u.hostname,port,con)
+            return 0
+        if response.status not in (200,206):
+            response.read()
+            self.release_connection(u.scheme,u.hostname,port,con)
+            raise IOError("HTTP %d %s" % (response.status,response.reason))
+        # server ignored Range request: start over
+        mode = "ab" if response.status == 206 else "wb"
+        length = response.getheader("Content-Length")
+        num_bytes = 0
+        try:
+            with open(part_path,mode) as f:
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if not chunk: break
+                    f.write(chunk)
+                    num_bytes += len(chunk)
+        except Exception:
+            con.close()
+            raise
+        if length is not None and num_bytes != int(length):
+            con.close()
+            raise IOError("Incomplete read (%d of %s bytes)" % (num_bytes,length))
+        if response.getheader("Connection","").lower() == "close":
+            con.close()
+        else:
+            self.release_connection(u.scheme,u.hostname,port,con)
+        return num_bytes
+
+
+    def download(self,url,out_dir):
+        # download url into out_dir (skips existing files like wget -nc); returns local path or None
+        local_path = os.path.join(out_dir,os.path.basename(urlparse(url).path))
+        if os.path.exists(local_path):
+            return local_path
+        part_path = local_path + ".part"
+        start_time = time.time()
+        num_bytes = 0
+        error = ""
+        with self.semaphore:
+            for attempt in range(self.retries+1):
+                if attempt > 0:
+                    time.sleep(self.backoff*2**(attempt-1))
+                try:
+                    self.fetch(url,part_path)
+                    os.rename(part_path,local_path)
+                    error = ""
+                    break
+                except Exception as e:
+                    error = str(e)
+                    print('***Download attempt %d failed for %s: %s***' % (attempt+1,os.path.basename(local_path),error))
+        # size of the downloaded (or partial) file
+        for path in [local_path,part_path]:
+            if os.path.exists(path): num_bytes = os.path.getsize(path)
+        with self.lock:
+            self.stats.append((os.path.basename(local_path),num_bytes,time.time()-start_time,attempt+1,error == ""))
+        if error != "":
+            return None
+        return local_path
+
+
+    def get_stats(self):
+        dtype = [("filename","|S60"),("bytes",int),("seconds",float),("attempts",int),("ok",bool)]
+        with self.lock:
+            return np.array(self.stats,dtype=dtype)
+
+
+    def summary(self):
+        stats = self.get_stats()
+        if len(stats) == 0: return "No downloads."
+        return "%d files (%d failed), %.1f MB, median %.2f s/file, %d retries" % (len(stats),np.sum(~stats["ok"]),np.sum(stats["bytes"])/1e6,
+                                                                                np.median(stats["seconds"]),np.sum(stats["attempts"]-1))
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    # serves files from server.root with basic auth, keep-alive and Range requests
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self,format,*args):
+        return
+
+    def do_GET(self):
+        server = self.server
+        if server.auth is not None and self.headers.get("Authorization") != server.auth:
+            self.send_response(401)
+            self.send_header("Content-Length","0")
+            self.end_headers()
+            return
+        local_path = os.path.join(server.root,self.path.lstrip("/"))
+        if not os.path.isfile(local_path):
+            self.send_response(404)
+            self.send_header("Content-Length","0")
+            self.end_headers()
+            return
+        size = os.path.getsize(local_path)
+        start = 0
+        if self.headers.get("Range") is not None:
+            start = int(self.headers.get("Range").split("=")[1].split("-")[0])
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Length","0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range","bytes %d-%d/%d" % (start,size-1,size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length",str(size-start))
+        self.end_headers()
+        with open(local_path,"rb") as f:
+            f.seek(start)
+            data = f.read()
+        # fault injection: drop the connection half way through
+        with server.lock:
+            server.num_requests += 1
+            fail = server.fail_every > 0 and server.num_requests % server.fail_every == 0
+        if fail:
+            self.wfile.write(data[:len(data)//2])
+            self.close_connection = True
+            return
+        self.wfile.write(data)
+
+
+class LocalArchiveServer(ThreadingMixIn,HTTPServer):
+    # local stand-in for the DES file archive (tests and benchmarks)
+    daemon_threads = True
+
+    def __init__(self,root,usr=None,psw=None,port=0,fail_every=0):
+        HTTPServer.__init__(self,("127.0.0.1",port),ArchiveHandler)
+        self.root = root
+        self.auth = None
+        if usr is not None:
+            self.auth = "Basic %s" % base64.b64encode(("%s:%s" % (usr,psw)).encode()).decode()
+        self.fail_every = fail_every
+        self.num_requests = 0
+        self.lock = threading.Lock()
+        self.url = "http://127.0.0.1:%d/" % self.server_address[1]
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,195 @@
+import os, time
+import numpy as np
+import argparse
+
+# Index over y6a1_image CCD footprints stored as memory-mappable .npy files:
+#   footprints.npy  one row per CCD image (RA interval normalized so ramin may be < 0 if it crosses RA=0)
+#   cell_start.npy  offsets into cell_rows for each (dec, RA) cell
+#   cell_rows.npy   footprint rows overlapping each cell
+CELL_SIZE = 1.0 # deg.
+NUM_RA = int(360/CELL_SIZE)
+NUM_DEC = int(180/CELL_SIZE)
+
+footprint_dtype = [("filename","|S41"),("expnum",int),("ccd",int),("band","|S1"),("program","|S10"),("mjd_obs",float),
+                   ("tradeg",float),("tdecdeg",float),("ramin",float),("ramax",float),("decmin",float),("decmax",float)]
+
+def wrap_interval(ramin,ramax):
+    # CCDs crossing RA=0 have racmin ~0 and racmax ~360, store them as [racmax-360, racmin]
+    ramin = np.asarray(ramin,dtype=float).copy()
+    ramax = np.asarray(ramax,dtype=float).copy()
+    cross = (ramax - ramin) > 180.
+    ramin[cross], ramax[cross] = ramax[cross] - 360., ramin[cross]
+    return ramin, ramax
+
+def pointing_box(ramin,ramax,decmin,decmax):
+    # box around the CCD footprints of a pointing (raw racmin/racmax), ramin > ramax if it crosses RA=0
+    ramin, ramax = wrap_interval(ramin,ramax)
+    # CCDs on both sides of RA=0 (near 0 and near 360) are moved next to each other
+    if len(ramin) > 0 and np.max(ramax) - np.min(ramin) > 180.:
+        shift = ramin > 180.
+        ramin[shift], ramax[shift] = ramin[shift] - 360., ramax[shift] - 360.
+    return np.mod(np.min(ramin),360.), np.mod(np.max(ramax),360.), np.min(decmin), np.max(decmax)
+
+def in_footprint(ra,dec,ramin,ramax,decmin,decmax):
+    # point in CCD test that handles RA wraparound (intervals from wrap_interval or raw racmin/racmax)
+    ramin, ramax = wrap_interval(ramin,ramax)
+    ra = np.mod(ra,360.)
+    mask_ra = ((ramin <= ra) & (ra <= ramax)) | ((ramin <= ra-360.) & (ra-360. <= ramax))
+    return mask_ra & (decmin <= dec) & (dec <= decmax)
+
+def overlap_footprint(ramin_box,ramax_box,decmin_box,decmax_box,ramin,ramax,decmin,decmax):
+    # box overlap test; a box with ramin_box > ramax_box crosses RA=0
+    ramin, ramax = wrap_interval(ramin,ramax)
+    ramin_box = np.mod(ramin_box,360.)
+    ramax_box = np.mod(ramax_box,360.)
+    if ramin_box > ramax_box: ramin_box -= 360.
+    mask_ra = np.zeros(len(ramin),dtype=bool)
+    # compare against the box and its copies shifted by one turn
+    for shift in [-360.,0.,360.]:
+        mask_ra |= (ramin <= ramax_box+shift) & (ramin_box+shift <= ramax)
+    return mask_ra & (decmin <= decmax_box) & (decmin_box <= decmax)
+
+def cell_ra(ra):
+    return np.mod(np.floor(np.asarray(ra)/CELL_SIZE).astype(int),NUM_RA)
+
+def cell_dec(dec):
+    return np.clip(np.floor((np.asarray(dec)+90.)/CELL_SIZE).astype(int),0,NUM_DEC-1)
+
+
+def build_index(footprints,index_dir):
+    # write footprint table and cell lists to index_dir
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    footprints = np.array(footprints,dtype=footprint_dtype)
+    footprints['ramin'], footprints['ramax'] = wrap_interval(footprints['ramin'],footprints['ramax'])
+    # cells covered by each footprint (a CCD spans at most a few cells)
+    dec0 = cell_dec(footprints['decmin']); dec1 = cell_dec(footprints['decmax'])
+    ra0 = np.floor(footprints['ramin']/CELL_SIZE).astype(int); ra1 = np.floor(footprints['ramax']/CELL_SIZE).astype(int)
+    rows = [np.zeros(0,dtype=int)]; cells = [np.zeros(0,dtype=int)]
+    num_ddec = np.max(dec1-dec0)+1 if len(footprints) > 0 else 0
+    num_dra = np.max(ra1-ra0)+1 if len(footprints) > 0 else 0
+    for ddec in range(num_ddec):
+        for dra in range(num_dra):
+            mask = (dec0+ddec <= dec1) & (ra0+dra <= ra1)
+            idx = np.where(mask)[0]
+            rows.append(idx)
+            cells.append((dec0[idx]+ddec)*NUM_RA + np.mod(ra0[idx]+dra,NUM_RA))
+    rows = np.concatenate(rows); cells = np.concatenate(cells)
+    order = np.argsort(cells,kind='mergesort')
+    cell_rows = rows[order].astype(np.int64)
+    cell_start = np.searchsorted(cells[order],np.arange(NUM_RA*NUM_DEC+1)).astype(np.int64)
+    np.save(os.path.join(index_dir,'footprints.npy'),footprints)
+    np.save(os.path.join(index_dir,'cell_rows.npy'),cell_rows)
+    np.save(os.path.join(index_dir,'cell_start.npy'),cell_start)
+    return FootprintIndex(index_dir)
+
+
+def dump_footprints(query_sci,band=None,batch_size=100000):
+    # DB dump of every red_immask CCD footprint
+    cur = query_sci.connect()
+    get_list = "select i.filename, i.expnum, i.ccdnum, i.band, e.program, e.mjd_obs, e.tradeg, e.tdecdeg, i.racmin, i.racmax, i.deccmin, i.deccmax from y6a1_image i, y6a1_exposure e where i.filetype='red_immask' and i.expnum=e.expnum"
+    if band is not None:
+        cur.execute(get_list + " and i.band=:band",band=band)
+    else:
+        cur.execute(get_list)
+    footprints = []
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if len(rows) == 0: break
+        footprints.append(np.array([tuple(r) for r in rows],dtype=footprint_dtype))
+    if len(footprints) == 0:
+        return np.zeros(0,dtype=footprint_dtype)
+    return np.concatenate(footprints)
+
+
+class FootprintIndex:
+
+    def __init__(self,index_dir):
+        # files are memory mapped, only the touched cells are read
+        self.index_dir = index_dir
+        self.footprints = np.load(os.path.join(index_dir,'footprints.npy'),mmap_mode='r')
+        self.cell_rows = np.load(os.path.join(index_dir,'cell_rows.npy'),mmap_mode='r')
+        self.cell_start = np.load(os.path.join(index_dir,'cell_start.npy'),mmap_mode='r')
+
+
+    def cell_candidates(self,cell_ids):
+        rows = [self.cell_rows[self.cell_start[c]:self.cell_start[c+1]] for c in np.unique(cell_ids)]
+        if len(rows) == 0: return np.zeros(0,dtype=np.int64)
+        return np.unique(np.concatenate(rows))
+
+
+    def select(self,footprints,band=None,mjd_min=None,mjd_max=None,program=None):
+        mask = np.ones(len(footprints),dtype=bool)
+        if band is not None: mask &= footprints['band'] == band.encode()
+        if program is not None: mask &= footprints['program'] == program.encode()
+        if mjd_min is not None: mask &= footprints['mjd_obs'] > mjd_min
+        if mjd_max is not None: mask &= footprints['mjd_obs'] < mjd_max
+        return footprints[mask]
+
+
+    def contains(self,ra,dec,band=None,mjd_min=None,mjd_max=None,program=None):
+        # all CCD images containing (ra, dec)
+        cell = cell_dec(dec)*NUM_RA + cell_ra(ra)
+        rows = self.cell_rows[self.cell_start[cell]:self.cell_start[cell+1]]
+        f = self.footprints[np.sort(rows)]
+        f = f[in_footprint(ra,dec,f['ramin'],f['ramax'],f['decmin'],f['decmax'])]
+        return self.select(f,band,mjd_min,mjd_max,program)
+
+
+    def contains_many(self,ra,dec,band=None,mjd_min=None,mjd_max=None,program=None):
+        # batch point lookup, returns list of results in input order
+        return [self.contains(r,d,band,mjd_min,mjd_max,program) for r, d in zip(ra,dec)]
+
+
+    def overlap(self,ramin,ramax,decmin,decmax,band=None,mjd_min=None,mjd_max=None,program=None):
+        # all CCD images overlapping box (ramin > ramax if box crosses RA=0)
+        ra0 = int(np.floor(ramin/CELL_SIZE)); ra1 = int(np.floor(ramax/CELL_SIZE))
+        if ra1 < ra0: ra1 += NUM_RA
+        dec_cells = np.arange(cell_dec(decmin),cell_dec(decmax)+1)
+        ra_cells = np.mod(np.arange(ra0,ra1+1),NUM_RA)
+        cells = (dec_cells[:,None]*NUM_RA + ra_cells[None,:]).flatten()
+        f = self.footprints[self.cell_candidates(cells)]
+        f = f[overlap_footprint(ramin,ramax,decmin,decmax,f['ramin'],f['ramax'],f['decmin'],f['decmax'])]
+        return self.select(f,band,mjd_min,mjd_max,program)
+
+
+    def get_pointing_coord(self,ra,dec,band='g',season=6):
+        # local version of Query.get_pointing_coord
+        t0_Y6 = 58250
+        t1_Y6 = 58615
+        t0 = t0_Y6 + 365*(season - 6)
+        t1 = t1_Y6 + 365*(season - 6)
+        f = self.contains(ra,dec,band,t0,t1,'survey')
+        if len(f) == 0:
+            return None
+        dtype = [("TRADEG",float),("TDECDEG",float),("mjd_obs",float),('ccd',float)]
+        info_list = np.array(sorted(set(zip(f['tradeg'],f['tdecdeg'],f['mjd_obs'],f['ccd'].astype(float)))),dtype=dtype)
+        return info_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local spatial index over DES CCD footprints.')
+    parser.add_argument('index_dir',type=str,help='Index directory')
+    parser.add_argument('--build',action='store_true',help='Build index from database dump')
+    parser.add_argument('-f','--filter',type=str,default=None,help='Filter to use (default is all)')
+    parser.add_argument('--ra',type=float,default=None,help="Target RA [deg.]")
+    parser.add_argument('--dec',type=float,default=None,help="Target dec [deg.]")
+    args = parser.parse_args()
+    if args.build:
+        import query
+        query_sci = query.Query('db-dessci')
+        print('Dumping CCD footprints.')
+        footprints = dump_footprints(query_sci,args.filter)
+        print('Indexing %d footprints.' % len(footprints))
+        build_index(footprints,args.index_dir)
+    if args.ra is not None and args.dec is not None:
+        index = FootprintIndex(args.index_dir)
+        start_time = time.time()
+        f = index.contains(args.ra,args.dec,args.filter)
+        print('Found %d CCD images in %.2f ms' % (len(f),(time.time()-start_time)*1000.))
+        for row in f:
+            print('%s %d %d %.5f' % (row['filename'].decode(),row['expnum'],row['ccd'],row['mjd_obs']))
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import os, time, shutil, sqlite3, threading
+import argparse
+
+def link_file(src,dst):
+    # hard link (the tile keeps its file if another job evicts the entry), copy across file systems
+    try:
+        os.link(src,dst)
+    except OSError:
+        shutil.copy2(src,dst)
+
+
+class ImageCache:
+
+    def __init__(self,cache_dir,budget_gb=100.):
+        # shared store of downloaded images and their weight/mask products
+        # entries are keyed by the archive filename root (e.g. D00251234_g_c01_r2345p01_immasked),
+        # which already carries the processing version (reqnum/attempt)
+        self.cache_dir = cache_dir
+        self.budget = budget_gb*1e9
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.lock = threading.Lock()
+        # entries used by this process are not evicted by it; tile directories hold hard links,
+        # so eviction by other jobs only drops the cache copy
+        self.pinned = set()
+        self.con = sqlite3.connect(os.path.join(cache_dir,'index.db'),timeout=60,check_same_thread=False)
+        self.con.execute("create table if not exists entries (key text primary key, size integer, last_used real)")
+        self.con.commit()
+
+
+    def key(self,filename):
+        # filename root without .fits/.fits.fz/.weight.fits
+        name = os.path.basename(filename)
+        for ext in ['.fits.fz','.weight.fits','.fits']:
+            if name.endswith(ext):
+                return name[:-len(ext)]
+        return name
+
+
+    def entry_dir(self,key):
+        return os.path.join(self.cache_dir,key[:9],key)
+
+
+    def link(self,filename,tile_dir):
+        # link cached products of filename into tile_dir, returns False on a miss
+        key = self.key(filename)
+        entry_dir = self.entry_dir(key)
+        if not os.path.exists(entry_dir):
+            return False
+        for name in os.listdir(entry_dir):
+            dst = os.path.join(tile_dir,name)
+            if not os.path.lexists(dst):
+                link_file(os.path.join(entry_dir,name),dst)
+        with self.lock:
+            self.pinned.add(key)
+            self.con.execute("update entries set last_used=? where key=?",(time.time(),key))
+            self.con.commit()
+        return True
+
+
+    def store(self,files):
+        # move files (products of a single image) into the cache and replace them by hard links
+        key = self.key(files[0])
+        entry_dir = self.entry_dir(key)
+        tmp_dir = "%s.tmp%d_%d" % (entry_dir,os.getpid(),threading.current_thread().ident)
+        os.makedirs(tmp_dir)
+        size = 0
+        for f in files:
+            size += os.path.getsize(f)
+            shutil.move(f,os.path.join(tmp_dir,os.path.basename(f)))
+        try:
+            os.rename(tmp_dir,entry_dir)
+        except OSError:
+            # stored by another job in the meantime
+            shutil.rmtree(tmp_dir)
+        for f in files:
+            link_file(os.path.join(entry_dir,os.path.basename(f)),f)
+        with self.lock:
+            self.pinned.add(key)
+            self.con.execute("insert or replace into entries values (?,?,?)",(key,size,time.time()))
+            self.con.commit()
+        self.evict()
+        return entry_dir
+
+
+    def evict(self):
+        # drop least recently used entries until the cache is within budget
+        with self.lock:
+            total = self.con.execute("select sum(size) from entries").fetchone()[0] or 0
+            if total <= self.budget:
+                return 0
+            removed = 0
+            for key, size in self.con.execute("select key, size from entries order by last_used").fetchall():
+                if total <= self.budget: break
+                if key in self.pinned: continue
+                shutil.rmtree(self.entry_dir(key),ignore_errors=True)
+                self.con.execute("delete from entries where key=?",(key,))
+                total -= size
+                removed += 1
+            self.con.commit()
+        return removed
+
+
+    def summary(self):
+        num, total = self.con.execute("select count(*), sum(size) from entries").fetchone()
+        return "%d cached images, %.1f of %.1f GB" % (num,(total or 0)/1e9,self.budget/1e9)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the shared image cache.')
+    parser.add_argument('cache_dir',type=str,help='Cache directory')
+    parser.add_argument('--budget',type=float,default=100.,help='Disk budget [GB]')
+    parser.add_argument('--evict',action='store_true',help='Evict least recently used images down to the budget')
+    args = parser.parse_args()
+    image_cache = ImageCache(args.cache_dir,args.budget)
+    if args.evict:
+        print('Evicted %d images.' % image_cache.evict())
+    print(image_cache.summary())
+    return
+
+if __name__ == "__main__":
+    main()
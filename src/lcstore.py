@@ -0,0 +1,137 @@
+import os, json, shutil, threading
+import numpy as np
+import argparse
+
+# light curves of a field/pointing: store_dir/c<ccd>/<column>.npy, rows sorted by num then mjd_obs,
+# and store_dir/c<ccd>/index.npy with the first row and number of rows of every source;
+# store_dir/c<ccd>/manifest.json lists the exposures in the light curves and the template version
+DTYPE = [('num',np.int64),('mjd_obs',np.float64),('ra',np.float64),('dec',np.float64),
+         ('flux3',np.float64),('flux4',np.float64),('flux5',np.float64),
+         ('fluxerr3',np.float64),('fluxerr4',np.float64),('fluxerr5',np.float64)]
+INDEX_DTYPE = [('num',np.int64),('start',np.int64),('count',np.int64)]
+
+
+class LightCurveStore:
+
+    def __init__(self,store_dir):
+        self.store_dir = store_dir
+
+
+    def ccd_dir(self,ccd):
+        return os.path.join(self.store_dir,'c%d' % ccd)
+
+
+    def ccds(self):
+        if not os.path.exists(self.store_dir):
+            return []
+        return sorted([int(d[1:]) for d in os.listdir(self.store_dir) if d.startswith('c') and d[1:].isdigit()])
+
+
+    def write(self,ccd,data,manifest=None):
+        # replaces the light curves of a CCD (data: structured array with the DTYPE columns)
+        data = np.asarray(data)
+        order = np.lexsort((data['mjd_obs'],data['num']))
+        num, start, count = np.unique(data['num'][order],return_index=True,return_counts=True)
+        index = np.zeros(len(num),dtype=INDEX_DTYPE)
+        index['num'], index['start'], index['count'] = num, start, count
+        ccd_dir = self.ccd_dir(ccd)
+        tmp_dir = "%s.tmp%d_%d" % (ccd_dir,os.getpid(),threading.current_thread().ident)
+        os.makedirs(tmp_dir)
+        for name, dtype in DTYPE:
+            np.save(os.path.join(tmp_dir,name+'.npy'),data[name][order].astype(dtype))
+        np.save(os.path.join(tmp_dir,'index.npy'),index)
+        if manifest is not None:
+            with open(os.path.join(tmp_dir,'manifest.json'),'w') as f:
+                json.dump(manifest,f,indent=1)
+        # swap in the new CCD directory
+        if os.path.exists(ccd_dir):
+            shutil.rmtree(ccd_dir)
+        os.rename(tmp_dir,ccd_dir)
+        return ccd_dir
+
+
+    def append(self,ccd,data,manifest=None):
+        # adds measurements (new epochs) to the light curves of a CCD, the CCD is rewritten in sorted order;
+        # (num, mjd_obs) rows already in the store are not added again
+        data = np.asarray(data).astype(DTYPE)
+        if os.path.exists(os.path.join(self.ccd_dir(ccd),'index.npy')):
+            old = self.read_ccd(ccd)
+            old_keys = set(zip(old['num'].tolist(),old['mjd_obs'].tolist()))
+            new = np.array([k not in old_keys for k in zip(data['num'].tolist(),data['mjd_obs'].tolist())],dtype=bool)
+            data = np.concatenate([old,data[new]])
+        return self.write(ccd,data,manifest)
+
+
+    def manifest(self,ccd):
+        filename = os.path.join(self.ccd_dir(ccd),'manifest.json')
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as f:
+            return json.load(f)
+
+
+    def index(self,ccd):
+        return np.load(os.path.join(self.ccd_dir(ccd),'index.npy'))
+
+
+    def columns(self,ccd,names=None):
+        # memory mapped columns of a CCD
+        if names is None:
+            names = [name for name, dtype in DTYPE]
+        return dict([(name,np.load(os.path.join(self.ccd_dir(ccd),name+'.npy'),mmap_mode='r')) for name in names])
+
+
+    def read_ccd(self,ccd,names=None):
+        cols = self.columns(ccd,names)
+        data = np.zeros(len(list(cols.values())[0]),dtype=[d for d in DTYPE if d[0] in cols])
+        for name in cols:
+            data[name] = cols[name]
+        return data
+
+
+    def read(self,ccd,num,names=None):
+        # light curve of one source: a single contiguous slice of every column
+        index = self.index(ccd)
+        i = np.searchsorted(index['num'],num)
+        cols = self.columns(ccd,names)
+        data = np.zeros(0 if i == len(index) or index['num'][i] != num else index['count'][i],dtype=[d for d in DTYPE if d[0] in cols])
+        if len(data) > 0:
+            start = index['start'][i]
+            for name in cols:
+                data[name] = cols[name][start:start+len(data)]
+        return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Light curve store of a field/pointing.')
+    parser.add_argument('store_dir',type=str,help='Light curve store (e.g. <tile_dir>/lightcurves)')
+    parser.add_argument('-c','--ccd',type=int,default=None,help='CCD')
+    parser.add_argument('--num',type=int,default=None,help='Print the light curve of this source')
+    parser.add_argument('--text',type=str,default=None,help='Export the CCD to a text file (old cat_c?.dat layout)')
+    parser.add_argument('--convert',type=str,default=None,help='Import a text cat_c?.dat file into the CCD')
+    args = parser.parse_args()
+    store = LightCurveStore(args.store_dir)
+    hdr = ' '.join([name for name, dtype in DTYPE])
+    if args.convert is not None:
+        dat = np.loadtxt(args.convert,ndmin=2)
+        data = np.zeros(len(dat),dtype=DTYPE)
+        for i, (name, dtype) in enumerate(DTYPE):
+            data[name] = dat[:,i]
+        print('Saved %s' % store.write(args.ccd,data))
+    elif args.num is not None:
+        data = store.read(args.ccd,args.num)
+        print(hdr)
+        for row in data:
+            print(' '.join([str(v) for v in row]))
+    elif args.text is not None:
+        np.savetxt(args.text,store.read_ccd(args.ccd),fmt='%d %f %f %f %f %f %f %f %f %f',header=hdr)
+    else:
+        for ccd in store.ccds():
+            index = store.index(ccd)
+            manifest = store.manifest(ccd)
+            num_exp = len(manifest['exposures']) if manifest is not None else 0
+            print('c%d: %d sources, %d measurements, %d exposures' % (ccd,len(index),np.sum(index['count']),num_exp))
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import os, time
+import numpy as np
+import argparse
+from multiprocessing import Pool
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from footprint import cell_ra, cell_dec, NUM_RA
+from lcstore import LightCurveStore, DTYPE
+from catalog import unit_vectors
+
+# merged catalog of one or more light curve stores (CCDs of a pointing/field, or several pointings):
+#   objects.npy       one row per object: position, sky cell, rows of its light curve in cells/<cell>.npy
+#   members.npy       (object_id, store, ccd, num) of every merged source
+#   cells/<cell>.npy  measurements of the objects of a sky cell, sorted by object_id and mjd_obs
+# sources closer than MATCH_RADIUS are the same object, duplicate measurements of an object
+# (same exposure on overlapping templates) keep the one with the smallest fluxerr4
+MATCH_RADIUS = 1.0 # arcsec
+source_dtype = [('store',np.int32),('ccd',np.int32),('num',np.int64),('ra',np.float64),('dec',np.float64),('nobs',np.int64)]
+object_dtype = [('object_id',np.int64),('ra',np.float64),('dec',np.float64),('cell',np.int64),('nsources',np.int64),('nobs',np.int64),('start',np.int64),('count',np.int64)]
+member_dtype = [('object_id',np.int64),('store',np.int32),('ccd',np.int32),('num',np.int64)]
+merged_dtype = [('object_id',np.int64)] + DTYPE[1:] + [('store',np.int32),('ccd',np.int32)]
+
+
+def sky_cell(ra,dec):
+    return cell_dec(dec)*NUM_RA + cell_ra(ra)
+
+
+def read_sources(store_dirs):
+    # one row per source of every CCD of every store (positions are the template positions)
+    sources = []
+    for i, store_dir in enumerate(store_dirs):
+        store = LightCurveStore(store_dir)
+        for ccd in store.ccds():
+            index = store.index(ccd)
+            cols = store.columns(ccd,['ra','dec'])
+            src = np.zeros(len(index),dtype=source_dtype)
+            src['store'], src['ccd'], src['num'], src['nobs'] = i, ccd, index['num'], index['count']
+            src['ra'], src['dec'] = cols['ra'][index['start']], cols['dec'][index['start']]
+            sources.append(src)
+    return np.concatenate(sources) if len(sources) > 0 else np.zeros(0,dtype=source_dtype)
+
+
+def match_cell(args):
+    # friends-of-friends groups of the sources of a cell and its margin, only sources of different
+    # catalogs (store and CCD) are linked; returns the smallest source index of the group of every source of the cell
+    idx, ra, dec, catalog, core, radius = args
+    tree = cKDTree(unit_vectors(ra,dec))
+    pairs = tree.query_pairs(2*np.sin(np.radians(radius/3600.)/2),output_type='ndarray')
+    pairs = pairs[catalog[pairs[:,0]] != catalog[pairs[:,1]]]
+    graph = coo_matrix((np.ones(len(pairs)),(pairs[:,0],pairs[:,1])),shape=(len(idx),len(idx)))
+    num, labels = connected_components(graph,directed=False)
+    first = np.full(num,np.iinfo(np.int64).max,dtype=np.int64)
+    np.minimum.at(first,labels,idx)
+    return idx[core], first[labels[core]]
+
+
+def partitions(sources,radius):
+    # sources of each sky cell plus the sources of the neighbouring cells within radius of it
+    cells = sky_cell(sources['ra'],sources['dec'])
+    catalog = sources['store'].astype(np.int64)*100000 + sources['ccd']
+    margin = radius/3600.
+    margin_ra = margin/np.maximum(np.cos(np.radians(sources['dec'])),1e-3)
+    extra = [sky_cell(sources['ra']+dra*margin_ra,sources['dec']+ddec*margin) for dra in [-1,0,1] for ddec in [-1,0,1]]
+    src = np.concatenate([np.arange(len(sources))]*len(extra))
+    cell = np.concatenate(extra)
+    # unique (cell, source) pairs
+    key = np.unique(cell*np.int64(len(sources))+src)
+    cell, src = key//len(sources), key % len(sources)
+    bounds = np.searchsorted(cell,np.unique(cell))
+    for start, end in zip(bounds,np.append(bounds[1:],len(cell))):
+        idx = src[start:end]
+        yield idx, sources['ra'][idx], sources['dec'][idx], catalog[idx], cells[idx] == cell[start], radius
+
+
+def write_cell(args):
+    # light curves of the objects of one cell, read from memory mapped store columns
+    out_file, store_dirs, members = args
+    rows = []
+    for (store, ccd) in set(zip(members['store'],members['ccd'])):
+        sel = members[(members['store'] == store) & (members['ccd'] == ccd)]
+        lcstore = LightCurveStore(store_dirs[store])
+        index = lcstore.index(ccd)
+        cols = lcstore.columns(ccd)
+        i = np.searchsorted(index['num'],sel['num'])
+        take = np.concatenate([np.arange(s,s+c) for s, c in zip(index['start'][i],index['count'][i])]) if len(i) > 0 else np.zeros(0,dtype=int)
+        lc = np.zeros(len(take),dtype=merged_dtype)
+        lc['object_id'] = np.repeat(sel['object_id'],index['count'][i])
+        for name, dtype in DTYPE[1:]:
+            lc[name] = cols[name][take]
+        lc['store'], lc['ccd'] = store, ccd
+        rows.append(lc)
+    lc = np.concatenate(rows)
+    # sort by object and mjd, best measurement first among duplicates
+    err = np.where(np.isfinite(lc['fluxerr4']),lc['fluxerr4'],np.inf)
+    lc = lc[np.lexsort((err,lc['mjd_obs'],lc['object_id']))]
+    keep = np.ones(len(lc),dtype=bool)
+    keep[1:] = (lc['object_id'][1:] != lc['object_id'][:-1]) | (lc['mjd_obs'][1:] != lc['mjd_obs'][:-1])
+    lc = lc[keep]
+    np.save(out_file,lc)
+    object_id, start, count = np.unique(lc['object_id'],return_index=True,return_counts=True)
+    return object_id, start, count
+
+
+def merge(store_dirs,out_dir,num_threads=1,radius=MATCH_RADIUS):
+    # merged, deduplicated catalog of the light curve stores in out_dir
+    start_time = time.time()
+    store_dirs = [os.path.abspath(s) for s in store_dirs]
+    sources = read_sources(store_dirs)
+    if len(sources) == 0:
+        print('***No light curves to merge***')
+        return None
+    pool = Pool(num_threads) if num_threads > 1 else None
+    imap = pool.imap_unordered if pool is not None else map
+    # group sources of all stores (parallel over sky cells)
+    group = np.zeros(len(sources),dtype=np.int64)
+    for idx, first in imap(match_cell,partitions(sources,radius)):
+        group[idx] = first
+    # objects are represented by their source with most measurements
+    heads, object_id = np.unique(group,return_inverse=True)
+    order = np.lexsort((-sources['nobs'],object_id))
+    best = order[np.searchsorted(object_id[order],np.arange(len(heads)))]
+    objects = np.zeros(len(heads),dtype=object_dtype)
+    objects['object_id'] = np.arange(len(heads))
+    objects['ra'], objects['dec'] = sources['ra'][best], sources['dec'][best]
+    objects['cell'] = sky_cell(objects['ra'],objects['dec'])
+    objects['nsources'] = np.bincount(object_id,minlength=len(heads))
+    members = np.zeros(len(sources),dtype=member_dtype)
+    members['object_id'] = object_id
+    for name in ['store','ccd','num']:
+        members[name] = sources[name]
+    members = members[np.argsort(object_id,kind='mergesort')]
+    # write light curves per sky cell (parallel over cells)
+    cell_dir = os.path.join(out_dir,'cells')
+    if not os.path.exists(cell_dir):
+        os.makedirs(cell_dir)
+    member_cell = objects['cell'][members['object_id']]
+    jobs = [(os.path.join(cell_dir,'%d.npy' % cell),store_dirs,members[member_cell == cell]) for cell in np.unique(objects['cell'])]
+    for oid, start, count in imap(write_cell,jobs):
+        objects['start'][oid], objects['count'][oid] = start, count
+    objects['nobs'] = objects['count']
+    if pool is not None:
+        pool.close()
+    np.save(os.path.join(out_dir,'objects.npy'),objects)
+    np.save(os.path.join(out_dir,'members.npy'),members)
+    with open(os.path.join(out_dir,'stores.txt'),'w') as f:
+        f.write('\n'.join(store_dirs)+'\n')
+    print('Merged %d sources into %d objects in %d sky cells (%.2f s).' % (len(sources),len(objects),len(jobs),time.time()-start_time))
+    return objects
+
+
+def read_object(out_dir,object_id):
+    # light curve of one merged object
+    objects = np.load(os.path.join(out_dir,'objects.npy'),mmap_mode='r')
+    obj = objects[object_id]
+    lc = np.load(os.path.join(out_dir,'cells','%d.npy' % obj['cell']),mmap_mode='r')
+    return np.array(lc[obj['start']:obj['start']+obj['count']])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge light curve stores into one catalog with deduplicated objects.')
+    parser.add_argument('out_dir',type=str,help='Output directory')
+    parser.add_argument('stores',nargs='+',type=str,help='Light curve stores (<tile_dir>/lightcurves of one or more pointings)')
+    parser.add_argument('-n','--threads',type=int,default=1,help='Number of processes')
+    parser.add_argument('-r','--radius',type=float,default=MATCH_RADIUS,help='Match radius [arcsec]')
+    args = parser.parse_args()
+    merge(args.stores,args.out_dir,args.threads,args.radius)
+    return
+
+if __name__ == "__main__":
+    main()
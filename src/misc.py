@@ -4,6 +4,9 @@ from astropy import units as u
 from astropy.io import fits
 from multiprocessing import Pool
 from multiprocessing.dummy import Pool as ThreadPool
+from threading import Thread, Lock
+try: from queue import Queue
+except ImportError: from Queue import Queue # python 2
 
 def single_header(filename):
     hdul = fits.open(filename,ignore_missing_end=True)
@@ -11,6 +14,64 @@ def single_header(filename):
     hdu.writeto(filename,clobber=True,output_verify='ignore')
     return
 
+# DESDM BADPIX bits that do not make a pixel unusable (SUSPECT, FIXED, NEAREDGE, TAPEBUMP)
+# not yet matched against makeWeight on a real red_immask file, check with benchmark.py weight
+BADPIX_OK = 2048 | 4096 | 8192 | 16384
+
+def stream_image(hdu,filename,data_type):
+    # single-header copy of an image HDU header, the data is written in row blocks with write_rows
+    header = fits.PrimaryHDU(data=np.zeros((0,0),dtype=data_type)).header
+    for card in hdu.header.cards:
+        if card.keyword not in header and card.keyword not in ['XTENSION','PCOUNT','GCOUNT','EXTNAME','CHECKSUM','DATASUM','BSCALE','BZERO','']:
+            header.append(card)
+    ny, nx = hdu.shape
+    header['NAXIS1'] = nx; header['NAXIS2'] = ny
+    if os.path.exists(filename): os.remove(filename)
+    return fits.StreamingHDU(filename,header)
+
+def make_weight_map(filename,outroot,border=20,mask_bits=~BADPIX_OK,block_rows=256):
+    # In-process version of makeWeight + single_header (experimental): reads SCI/MSK/WGT of a red_immask
+    # file and writes single-header outroot.fits and outroot.weight.fits in one pass of row blocks
+    # (memory mapped or decompressed tile by tile, so only a block of each HDU is held in memory)
+    with fits.open(filename,memmap=True,ignore_missing_end=True) as hdul:
+        # red_immask layout: SCI, MSK, WGT
+        sci, msk, wgt = hdul[1], hdul[2], hdul[3]
+        ny, nx = sci.shape
+        out_sci = stream_image(sci,outroot+'.fits',sci.section[0:1].dtype)
+        out_wgt = stream_image(wgt,outroot+'.weight.fits',np.float32)
+        for y0 in range(0,ny,block_rows):
+            y1 = min(y0+block_rows,ny)
+            out_sci.write(np.asarray(sci.section[y0:y1]))
+            # zero weight for masked pixels and the border
+            weight = np.array(wgt.section[y0:y1],dtype=np.float32)
+            weight[(msk.section[y0:y1].astype(np.int64) & mask_bits) != 0] = 0.
+            if border > 0:
+                weight[:max(border-y0,0),:] = 0.; weight[max(ny-border-y0,0):,:] = 0.
+                weight[:,:border] = 0.; weight[:,-border:] = 0.
+            out_wgt.write(weight)
+        out_sci.close(); out_wgt.close()
+    return 0
+
+def make_cutout(filename,outname,ra,dec,size):
+    # size x size pixel cutout around (ra, dec) with updated WCS (clipped at the image edges)
+    # returns False if (ra, dec) is not on the image
+    from astropy.wcs import WCS
+    from astropy.nddata import Cutout2D
+    hdul = fits.open(filename,ignore_missing_end=True)
+    hdu = hdul[0]
+    wcs = WCS(hdu.header)
+    x, y = wcs.all_world2pix(ra,dec,0)
+    ny, nx = hdu.data.shape
+    if not (0 <= x < nx and 0 <= y < ny):
+        hdul.close()
+        return False
+    cutout = Cutout2D(hdu.data,(float(x),float(y)),(size,size),wcs=wcs,mode='trim')
+    header = hdu.header.copy()
+    header.update(cutout.wcs.to_header(relax=True))
+    fits.PrimaryHDU(data=cutout.data,header=header).writeto(outname,overwrite=True,output_verify='ignore')
+    hdul.close()
+    return True
+
 def bash(command,print_out=True):
     if print_out: print(command)
     try: return subprocess.call(command.split())
@@ -40,6 +101,60 @@ def clean_tpool(pool_func, arg_tuple, num_threads):
         pool.join()
     return clean_info(out)
 
+def stage_tpool(arg_list, stages, queue_size=None):
+    # dataflow version of chained clean_tpool calls: each item moves on to the next stage
+    # as soon as it is done, through bounded queues; stages is a list of (pool_func, num_threads)
+    # arg_list can be any iterable (e.g. a stream of query results), None results are dropped
+    if queue_size is None:
+        queue_size = 2*max([n for f, n in stages])
+    queues = [Queue(queue_size) for i in range(len(stages))] + [Queue()]
+    done = object()
+    # an exception of the input iterable (e.g. a failing streamed query) is raised in the caller
+    # once the stages have drained, instead of passing off the items fed so far as the whole input
+    feed_error = []
+    def feed():
+        try:
+            for arg in arg_list:
+                queues[0].put(arg)
+        except Exception as e:
+            feed_error.append(e)
+        finally:
+            for i in range(stages[0][1]):
+                queues[0].put(done)
+    def work(i, counter, lock):
+        pool_func, num_threads = stages[i]
+        while True:
+            arg = queues[i].get()
+            if arg is done: break
+            try: out = pool_func(arg)
+            except Exception as e:
+                print('***Stage %s failed: %s***' % (pool_func.__name__, e))
+                out = None
+            if out is not None: queues[i+1].put(out)
+        # last worker of this stage closes the next one
+        with lock:
+            counter[0] -= 1
+            if counter[0] == 0:
+                for j in range(stages[i+1][1] if i+1 < len(stages) else 1):
+                    queues[i+1].put(done)
+    threads = [Thread(target=feed)]
+    for i, (pool_func, num_threads) in enumerate(stages):
+        counter, lock = [num_threads], Lock()
+        threads += [Thread(target=work, args=(i, counter, lock)) for j in range(num_threads)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    out = []
+    while True:
+        o = queues[-1].get()
+        if o is done: break
+        out.append(o)
+    for t in threads:
+        t.join()
+    if len(feed_error) > 0:
+        raise feed_error[0]
+    return clean_info(out)
+
 def safe_rm(file_path, debug_mode=False):
     if debug_mode: return
     try: os.remove(file_path)
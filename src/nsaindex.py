@@ -0,0 +1,97 @@
+import os, time
+import numpy as np
+import argparse
+from astropy.io import fits
+from footprint import cell_ra, cell_dec, CELL_SIZE, NUM_RA, NUM_DEC
+
+# NASA-Sloan Atlas galaxies for offset.py, partitioned into the sky cells of the footprint index:
+#   galaxies.npy    RA, DEC, PETROTH90 (and NSAID, row in the NSA file) sorted by cell
+#   cell_start.npy  first galaxy of each (dec, RA) cell
+# both are memory mapped, a CCD only reads the cells it overlaps
+NSA_FILE = '/data/des80.a/data/cburke/nsa_v0_1_2.fits'
+NSA_INDEX = '/data/des80.a/data/cburke/nsa_v0_1_2_index'
+galaxy_dtype = [('RA',np.float64),('DEC',np.float64),('PETROTH90',np.float32),('NSAID',np.int64),('row',np.int64)]
+
+
+def build_index(nsa_file,index_dir):
+    # one-time conversion of the NSA catalog (only the needed columns are read from the memory mapped table)
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    with fits.open(nsa_file,memmap=True) as hdul:
+        nsa = hdul[1].data
+        galaxies = np.zeros(len(nsa),dtype=galaxy_dtype)
+        for name in ['RA','DEC','PETROTH90','NSAID']:
+            galaxies[name] = nsa[name]
+    galaxies['row'] = np.arange(len(galaxies))
+    cells = cell_dec(galaxies['DEC'])*NUM_RA + cell_ra(galaxies['RA'])
+    order = np.lexsort((galaxies['DEC'],cells))
+    galaxies = galaxies[order]
+    cell_start = np.searchsorted(cells[order],np.arange(NUM_RA*NUM_DEC+1)).astype(np.int64)
+    np.save(os.path.join(index_dir,'galaxies.npy'),galaxies)
+    np.save(os.path.join(index_dir,'cell_start.npy'),cell_start)
+    return NSAIndex(index_dir)
+
+
+class NSAIndex:
+
+    def __init__(self,index_dir):
+        self.index_dir = index_dir
+        self.galaxies = np.load(os.path.join(index_dir,'galaxies.npy'),mmap_mode='r')
+        self.cell_start = np.load(os.path.join(index_dir,'cell_start.npy'),mmap_mode='r')
+
+
+    def box(self,ramin,ramax,decmin,decmax,margin=0.):
+        # galaxies in the box extended by margin [arcsec] (ramin > ramax if the box crosses RA=0)
+        margin = margin/3600.
+        decmin, decmax = decmin-margin, decmax+margin
+        cos_dec = max(np.cos(np.radians(max(abs(decmin),abs(decmax)))),1e-3)
+        ramin, ramax = np.mod(ramin-margin/cos_dec,360.), np.mod(ramax+margin/cos_dec,360.)
+        ra0 = int(np.floor(ramin/CELL_SIZE)); ra1 = int(np.floor(ramax/CELL_SIZE))
+        if ra1 < ra0: ra1 += NUM_RA
+        galaxies = []
+        for dec_cell in range(cell_dec(decmin),cell_dec(decmax)+1):
+            # RA cells of a dec row are contiguous in galaxies.npy, except across RA=0
+            row = dec_cell*NUM_RA
+            for c0, c1 in ([(ra0,ra1)] if ra1 < NUM_RA else [(ra0,NUM_RA-1),(0,ra1-NUM_RA)]):
+                galaxies.append(self.galaxies[self.cell_start[row+c0]:self.cell_start[row+c1+1]])
+        galaxies = np.concatenate(galaxies) if len(galaxies) > 0 else np.zeros(0,dtype=galaxy_dtype)
+        mask = (decmin <= galaxies['DEC']) & (galaxies['DEC'] <= decmax)
+        if ramin <= ramax:
+            mask &= (ramin <= galaxies['RA']) & (galaxies['RA'] <= ramax)
+        else:
+            mask &= (ramin <= galaxies['RA']) | (galaxies['RA'] <= ramax)
+        return np.array(galaxies[mask])
+
+
+    def wcs_footprint(self,wcs,margin=0.):
+        # galaxies on an image (astropy WCS with the image shape)
+        corners = wcs.calc_footprint()
+        ra, dec = np.mod(corners[:,0],360.), corners[:,1]
+        ramin, ramax = np.min(ra), np.max(ra)
+        if ramax - ramin > 180.:
+            ramin, ramax = np.min(ra[ra > 180.]), np.max(ra[ra < 180.])
+        return self.box(ramin,ramax,np.min(dec),np.max(dec),margin)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sky cell index of the NASA-Sloan Atlas for offset.py.')
+    parser.add_argument('index_dir',type=str,nargs='?',default=NSA_INDEX,help='Index directory')
+    parser.add_argument('--build',action='store_true',help='Build the index from the NSA catalog')
+    parser.add_argument('--nsa',type=str,default=NSA_FILE,help='NSA catalog (FITS)')
+    parser.add_argument('--box',type=float,nargs=4,default=None,help='List galaxies in RAMIN RAMAX DECMIN DECMAX [deg.]')
+    args = parser.parse_args()
+    if args.build:
+        start_time = time.time()
+        index = build_index(args.nsa,args.index_dir)
+        print('Indexed %d galaxies in %.2f s.' % (len(index.galaxies),time.time()-start_time))
+    if args.box is not None:
+        index = NSAIndex(args.index_dir)
+        start_time = time.time()
+        galaxies = index.box(*args.box)
+        print('Found %d galaxies in %.2f ms' % (len(galaxies),(time.time()-start_time)*1000.))
+        for g in galaxies:
+            print('%d %.6f %+.6f %.2f' % (g['NSAID'],g['RA'],g['DEC'],g['PETROTH90']))
+    return
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,9 @@ from photutils import DAOStarFinder, CircularAperture, aperture_photometry, SkyC
 from scipy.stats import norm, halfnorm
 import warnings
 from humanize import naturalsize
+from varstats import myvarlc, myvarlc_batch
+from coadd import coadd_diff
+from nsaindex import NSAIndex, NSA_INDEX
 
 #ignore by message
 warnings.filterwarnings("ignore", message="The kernel is not normalized")
@@ -35,159 +38,6 @@ plt.style.use('seaborn-whitegrid')
 
 #################################################################################################
 # FUNCTIONS
-# Check for variability: 
-def myvarlc(fluxin,sigin):
-    n = np.shape(fluxin)[0]
-    #convergence threshold    tiny = 2.e-5
-    tiny = 2.e-5
-    #lower limit for extra variance
-    #vmin = tiny * v0
-    #trap no data
-    good = 0.
-    avg = 0.
-    rms = 0.
-    sigavg = -1.
-    sigrms = -1.
-    
-    if( n <= 0 ):
-        print('flux,sig arrays empty, no data',n)
-        return(good, avg, rms, sigavg, sigrms)
-    
-    #only use data with non zero error bar
-    idinc = np.where(sigin > 0)[0]
-    flux = fluxin[idinc]
-    flux2 = flux * flux
-    sig  = sigin[idinc]
-    sig2 = sig*sig
-    ng = np.shape(sig)[0]
-    
-    #trap no valid data
-    if( ng <= 0 ):
-        print('** ERROR in avgrmsx. n', n, ' ng', ng)
-        return(good, avg, rms, sigavg, sigrms)
-    
-    #average positive error bars
-    e1 = np.mean(sig)
-    #KDH : V1 MAY VANISH IF E1 TOO SMALL
-    v1 = e1 * e1
-    #initial estimate
-    x = e1/sig
-    x2 = x*x
-    sum1 = np.sum(flux*x2)
-    sum2 = np.sum(x2)
-    varguess = np.std(flux) 
-    #optimal average and its variance
-    avg = sum1 / sum2
-    sigavg = e1 / np.sqrt( sum2 )
-    v0 = e1 * ( sigavg / sum2 )
-    #scale factor ( makes <1/sig^2>=1 )
-    v1 = ng * e1 * ( e1 / sum2 )
-    e1 = np.sqrt( v1 )
-    v0 = v0 / v1
-    #convergence threshold
-    tiny = 2.e-5
-    #lower limit for extra variance
-    vmin = tiny * v0
-    #initial parameter guesses
-    #avg = 10.0#np.mean(flux)
-    #rms = 0.1#np.std(flux)
-    var = rms*rms
-    #max-likelihood estimate of mean and extra varian
-    nloop = 1000
-    for loop in range(nloop):
-        #stow for convergence test
-        oldavg = avg
-        oldrms = rms
-        oldvar = var
-        #rescale
-        d = flux/e1
-        d2=d*d
-        e = sig/e1
-        #e2 = e*e
-        a = avg/e1
-        #weight
-        w = 1./(v0 + e*e)
-        #"goodness" of the data 
-        g = v0 * w
-        x = g * (d - a)
-        xx = x*x
-        sum1 = np.sum(g*d)
-        sumg = np.sum(g)
-        sum  = np.sum(g*g)
-        sum2 = np.sum(xx)
-        sum3 = np.sum(g*xx)  
-        sum4 = np.sum(x*g)
-        a = sum1 / sumg
-        v0 = sum2 / sumg
-        v0 = max( vmin, v0 )
-        va = v0 / sumg
-        #new avg and rms
-        avg = a
-        rms = np.sqrt( v0 )
-        #hessian matrix
-        Hmm = sumg/v0
-        Hmv = sum4/v0/v0
-        Hvv = sum3/v0/v0/v0 - 0.5*sum/v0/v0
-        #correction for covariance
-        c = 1. - Hmv*Hmv/Hmm/Hvv
-        #error bars on avg and rms
-        sigavg = np.sqrt( 1./Hmm/c )#np.sqrt( va )
-        if ((1./Hvv/c) < 0.0): 
-            print('Negative argument in sigv0')
-            good = nan
-            avg = nan
-            rms = nan
-            sigavg = nan
-            sigrms = nan
-            return good, avg, rms, sigavg, sigrms
-        sigv0  = np.sqrt( 1./Hvv/c )
-        #g = 2.0 * ( 2.0 * sum3 / sum2 * sumg - sum )
-        sigrms = rms
-        if( Hvv > 0.0 ): 
-            sigrms = 1./2 / rms * sigv0 #combination of error formula for x^1/3
-        #restore scaling
-        avg = a * e1
-        rms = rms * e1
-        sigavg = sigavg * e1
-        sigrms = sigrms * e1
-        #"good" data points ( e.g. with sig < rms )
-        if( sumg < 0.0 ):
-            print('** ERROR in AVGRMSX. NON-POSITIVE SUM(G)=', gsum)
-            print('** loop', loop, ' ndat', n, ' ngood', ng)
-            print('** dat(:)', flux[:])
-            print('** sig(:)', sig[:])
-            good = 0
-            return(good, avg, rms, sigavg, sigrms)
-        #converge when test < 1
-        if( loop > 10 ):
-            safe = 0.9
-            avg = oldavg * ( 1. - safe ) + safe * avg
-            rms = oldrms * ( 1. - safe ) + safe * rms
-            chiavg = ( avg - oldavg ) / sigavg
-            chirms = ( rms - oldrms ) / sigrms
-            test = max( abs( chiavg ), abs( chirms ) ) / tiny
-            #report on last 5 iterations
-            if( loop > nloop - 3 ):
-                print('Loop', loop, ' of', nloop, ' in AVGRMSX')
-                print('Ndat', n, ' Ngood', good, ' Neff', g)
-                print(' avg', avg, ' rms', rms)
-                print(' +/-', sigavg, ' +/-', sigrms)
-                print(' chiavg', chiavg, ' chirms', chirms, ' test', test)
-            #if( test < 1. ):
-            #    print('** CONVERGED ** :))')
-            #converged
-            if( test < 1. ):
-                good = 1
-                return(good, avg, rms, sigavg, sigrms)
-        #quit if v0 vanishes
-        if( v0 <= 0. ): 
-            print('no variance var <=0',var)
-            return(good, avg, rms, sigavg, sigrms)
-        #next loop
-    #failed to converge
-    print('** AVGRMSX FAILED TO CONVERGE :(((((')
-    return(good, avg, rms, sigavg, sigrms)
-
 # Check for empty FITS files from desdia code: 
 def check_files(filenames_arr, empty_arr, ok_arr):
     for i in range(len(filenames_arr)):
@@ -237,6 +87,14 @@ def var_stats(flux, flux_err, arr_snr, arr_avg, arr_sigavg, arr_rms, arr_sigrms)
     arr_sigrms.append(sigrms)
     return 
 
+# Variability statistics of all sources at once (padded [sources, epochs] arrays, mask marks measurements):
+def var_stats_batch(flux, flux_err, mask=None):
+    good, avg, rms, sigavg, sigrms = myvarlc_batch(flux, flux_err, mask)
+    # snr only for converged light curves
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = np.where(good == 1, rms/sigrms, np.nan)
+    return snr, avg, sigavg, rms, sigrms
+
 # Remove files with a specific extension once offset code is done:
 def rem_files(filepaths_arr):
     for i in filepaths_arr:
@@ -307,9 +165,10 @@ def main(dia_dir_path, nsa_path, ccd, band='g'):
     
     print('\t Extracting data from FITS files...')
 
+    # memory mapped, pixels are only read when used
     for i in range(len(ok_diff)):
-        diff_data, diff_hdr = fits.getdata(ok_diff[i], header=True)
-        dw_data, dw_hdr = fits.getdata(ok_dw[i], header=True)
+        diff_data, diff_hdr = fits.getdata(ok_diff[i], header=True, memmap=True)
+        dw_data, dw_hdr = fits.getdata(ok_dw[i], header=True, memmap=True)
         diff_data_set.append(diff_data)
         diff_hdr_set.append(diff_hdr)
         dw_data_set.append(dw_data)
@@ -324,11 +183,8 @@ def main(dia_dir_path, nsa_path, ccd, band='g'):
     
     ##### CO-ADDING & COMPARING:
     # Co-added difference image:
-    abs_diff_data = np.abs(diff_data_set)
-    co_add_data = np.zeros(np.shape(abs_diff_data[0]), dtype=float)
     print('\t Co-adding difference images... \n')
-    for i in range(len(abs_diff_data)):
-        co_add_data = co_add_data + abs_diff_data[i]
+    co_add_data, co_add_wgt = coadd_diff(ok_diff, mode='sum')
     
     # Co-added difference image:
     diff_fig, diff_ax = plt.subplots(figsize=(10,10))
@@ -413,8 +269,8 @@ def main(dia_dir_path, nsa_path, ccd, band='g'):
     temp_sources.add_column(temp_skycoord, name='SkyCoord')
 
     # Get size of each extended source in template image:
-    nsa_path = '/data/des80.a/data/cburke/nsa_v0_1_2.fits'
-    nsa_tab = Table.read(nsa_path) # make sure to import table!
+    # only the NSA sky cells overlapping the template CCD are read (nsa_path: index from nsaindex.py)
+    nsa_tab = NSAIndex(nsa_path).wcs_footprint(w_temp, margin=2.)
     nsa_skycoord = SkyCoord(ra=nsa_tab['RA']*u.deg, dec=nsa_tab['DEC']*u.deg, frame='icrs')
     
     nsa_idx, temp_idx, d2d, d3d = temp_skycoord.search_around_sky(nsa_skycoord, 2*u.arcsec)
@@ -595,14 +451,17 @@ def main(dia_dir_path, nsa_path, ccd, band='g'):
     # For each source, extract data from the difference images:
     print('\t Performing aperture photometry...')
     print('\t Making and saving light curves... \n')
+    # 4'' aperture light curves of all sources for the variability statistics:
+    lc_flux = np.full((len(diff_sources), len(diff_data_set)), np.nan)
+    lc_flux_err = np.full((len(diff_sources), len(diff_data_set)), np.nan)
     for i in range(len(diff_sources)):
         # Aperture photometry:
         radii = [np.round(3*u.arcsec / pix_scale).value/2., np.round(4*u.arcsec / pix_scale).value/2., 
                  np.round(5*u.arcsec / pix_scale).value/2.]
         diffim_aps = [CircularAperture([diff_sources[i]['xcentroid'], diff_sources[i]['ycentroid']], r=r) for r in radii]
         
-        for j in range(len(abs_diff_data)):
-            ptab = aperture_photometry(abs_diff_data[j], diffim_aps, error=dw_data_set[j])
+        for j in range(len(diff_data_set)):
+            ptab = aperture_photometry(np.abs(diff_data_set[j]), diffim_aps, error=dw_data_set[j])
             ap_names_og = ['aperture_sum_0', 'aperture_sum_1', 'aperture_sum_2']
             ap_names_new = ['ap_sum3', 'ap_sum4', 'ap_sum5']
             mag_names = ['mag_3', 'mag_4', 'mag_5']
@@ -630,7 +489,7 @@ def main(dia_dir_path, nsa_path, ccd, band='g'):
                phot_table2 = ptab
                phot_table = vstack([phot_table, phot_table2])
         
-        #var_stats(flux, flux_err, arr_snr, arr_avg, arr_sigavg, arr_rms, arr_sigrms)
+        lc_flux[i], lc_flux_err[i] = phot_table['ap_sum4'], phot_table['ap_sum4_err']
         ptab_name = djnames[i] + "_photdata_matchid_" + str(match_ids[i])
         phot_table.write((pdata_path + '/' + ptab_name + '.csv'), format='ascii.csv')
         
@@ -661,6 +520,13 @@ def main(dia_dir_path, nsa_path, ccd, band='g'):
         plt.subplots_adjust(hspace=0.1)
         plt.savefig((lc_path + '/' + lc_name + '.png'), facecolor='white', transparent=False)
     
+    # Variability statistics of all sources at once, added to the source table:
+    lc_mask = np.isfinite(lc_flux) & np.isfinite(lc_flux_err)
+    arr_snr, arr_avg, arr_sigavg, arr_rms, arr_sigrms = var_stats_batch(lc_flux, lc_flux_err, lc_mask)
+    for name, col in zip(['snr', 'avg', 'sigavg', 'rms', 'sigrms'], [arr_snr, arr_avg, arr_sigavg, arr_rms, arr_sigrms]):
+        diff_sources.add_column(col, name=name)
+    diff_sources.write((ccd_path + '/diff_sources.csv'), format='ascii.csv', overwrite=True)
+    
     final_size = os.stat(dia_dir_path).st_size
     
     print('\t DATA PRODUCT SUMMARY:')
@@ -697,4 +563,4 @@ def main(dia_dir_path, nsa_path, ccd, band='g'):
 
 ###############################################################################
 # Main function:
-main('/data/des80.a/data/gtorrini/1', 1, 'g')
+main('/data/des80.a/data/gtorrini/1', NSA_INDEX, 1, 'g')
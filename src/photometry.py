@@ -0,0 +1,132 @@
+import os, time
+import numpy as np
+import argparse
+from astropy.io import fits
+from astropy.wcs import WCS
+from reproject import background
+import catalog
+
+# in-process replacement for the SExtractor double-image forced photometry (etc/SN_diffim.sex):
+# FLUX_APER/FLUXERR_APER at the template detections on aligned difference images
+# (5x5 subpixel sampling, GLOBAL background, MAP_WEIGHT rescaled to the measured noise, GAIN 0)
+SUBPIX = 5
+BACK_SIZE = 64
+BACK_FILTERSIZE = 3
+WEIGHT_THRESH = 1e-10
+
+
+def read_sex_config(sex_file):
+    # keyword -> value string of a SExtractor configuration file
+    config = {}
+    for line in open(sex_file):
+        line = line.split('#')[0].split()
+        if len(line) >= 2:
+            config[line[0]] = ' '.join(line[1:])
+    return config
+
+
+def aperture_weights(x,y,diameters,subpix=SUBPIX):
+    # fraction of each pixel of a (2R+1)^2 box inside each aperture, per source
+    # returns (box x offsets, box y offsets, weights [num sources, num apertures, box pixels])
+    radii = 0.5*np.asarray(diameters,dtype=float)
+    half = int(np.ceil(np.max(radii)))+1
+    dy, dx = np.mgrid[-half:half+1,-half:half+1]
+    dx, dy = dx.ravel(), dy.ravel()
+    # subpixel centers relative to the pixel center
+    s = (np.arange(subpix)+0.5)/subpix-0.5
+    sx, sy = np.meshgrid(s,s)
+    sx, sy = sx.ravel(), sy.ravel()
+    ix, iy = np.round(x).astype(int), np.round(y).astype(int)
+    fx, fy = x-ix, y-iy
+    weights = np.zeros((len(x),len(radii),len(dx)),dtype=np.float32)
+    for i in range(0,len(x),100):
+        px = (dx[None,:,None]+sx[None,None,:]-fx[i:i+100,None,None]).astype(np.float32)
+        py = (dy[None,:,None]+sy[None,None,:]-fy[i:i+100,None,None]).astype(np.float32)
+        r2 = px**2+py**2
+        for k, r in enumerate(radii):
+            weights[i:i+100,k] = np.count_nonzero(r2 < r**2,axis=2)/float(subpix**2)
+    return dx, dy, weights, ix, iy
+
+
+def read_stamps(data,weight,dx,dy,ix,iy,subtract_back=True):
+    # background subtracted pixels and variances of the aperture boxes [sources, box pixels] of one image,
+    # pixels below WEIGHT_THRESH (or off the image) are zero
+    ny, nx = data.shape
+    data = np.asarray(data,dtype=np.float32)
+    weight = np.asarray(weight,dtype=np.float32)
+    good = weight > WEIGHT_THRESH
+    if subtract_back:
+        data = data - background(data,weight,BACK_SIZE,BACK_FILTERSIZE)
+    # MAP_WEIGHT: relative weights scaled to the measured background noise
+    values = data[good]
+    med = np.median(values)
+    sigma = 1.4826*np.median(np.abs(values-med))
+    sigfac2 = sigma**2/np.median(1./weight[good])
+    x, y = ix[:,None]+dx[None,:], iy[:,None]+dy[None,:]
+    inside = (x >= 0) & (x < nx) & (y >= 0) & (y < ny)
+    x, y = np.clip(x,0,nx-1), np.clip(y,0,ny-1)
+    use = inside & good[y,x]
+    pix = np.where(use,data[y,x],0.)
+    var = np.where(use,sigfac2/np.where(use,weight[y,x],1.),0.)
+    return pix, var
+
+
+def forced_photometry(ra,dec,template_sci,diff_files,diameters,chunk=16):
+    # aperture photometry at (ra, dec) on all aligned difference images (and their .weight.fits)
+    # images are memory mapped; the aperture boxes of chunk epochs are stacked into a cube and
+    # measured at once; returns flux, fluxerr [epochs, sources, apertures] (NaN for unreadable epochs)
+    x, y = WCS(fits.getheader(template_sci)).all_world2pix(ra,dec,0)
+    dx, dy, weights, ix, iy = aperture_weights(np.atleast_1d(x),np.atleast_1d(y),diameters)
+    flux = np.full((len(diff_files),len(ix),len(diameters)),np.nan,dtype=np.float32)
+    fluxerr = np.full(flux.shape,np.nan,dtype=np.float32)
+    for i in range(0,len(diff_files),chunk):
+        pix = np.zeros((len(diff_files[i:i+chunk]),len(ix),len(dx)),dtype=np.float32)
+        var = np.zeros(pix.shape,dtype=np.float32)
+        ok = np.zeros(len(pix),dtype=bool)
+        for j, filename in enumerate(diff_files[i:i+chunk]):
+            try:
+                with fits.open(filename,memmap=True) as hdul_sci, fits.open(filename[0:-5]+'.weight.fits',memmap=True) as hdul_wgt:
+                    pix[j], var[j] = read_stamps(hdul_sci[0].data,hdul_wgt[0].data,dx,dy,ix,iy)
+                ok[j] = True
+            except Exception as e:
+                print('***Photometry failed for %s: %s***' % (os.path.basename(filename),e))
+        flux[i:i+len(pix)][ok] = np.einsum('nkp,enp->enk',weights,pix[ok])
+        fluxerr[i:i+len(pix)][ok] = np.sqrt(np.einsum('nkp,enp->enk',weights,var[ok]))
+    return flux, fluxerr
+
+
+def write_catalog(filename,num,ra,dec,flux,fluxerr,binary=False):
+    # same layout as the SExtractor ASCII_HEAD catalogs (etc/SN_diffim.sex.param), or .npy
+    if binary:
+        return catalog.write_catalog(filename,num,ra,dec,flux,fluxerr)
+    num_ap = flux.shape[1]
+    hdr = ['   1 NUMBER','   2 ALPHAWIN_J2000','   3 DELTAWIN_J2000','   4 FLUX_APER','%4d FLUXERR_APER' % (4+num_ap)]
+    dat = np.column_stack([num,ra,dec,flux,fluxerr])
+    np.savetxt(filename,dat,fmt=['%10d','%11.7f','%+11.7f']+['%12.7g']*(2*num_ap),header='\n'.join(hdr),comments='#')
+    return filename
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Forced aperture photometry on aligned difference images.')
+    parser.add_argument('template_cat',type=str,help='Template catalog (NUMBER ALPHAWIN_J2000 DELTAWIN_J2000 ...)')
+    parser.add_argument('template',type=str,help='Template image (WCS of the aligned difference images)')
+    parser.add_argument('diff',nargs='+',type=str,help='Difference images')
+    parser.add_argument('--binary',action='store_true',help='Write .npy catalogs instead of ASCII')
+    parser.add_argument('--sex',type=str,default=None,help='SExtractor configuration (default etc/SN_diffim.sex)')
+    args = parser.parse_args()
+    sex_file = args.sex
+    if sex_file is None:
+        top_dir = '/'.join(os.path.dirname(os.path.abspath(__file__)).split('/')[0:-1])
+        sex_file = os.path.join(top_dir,'etc/SN_diffim.sex')
+    diameters = [float(d) for d in read_sex_config(sex_file)['PHOT_APERTURES'].split(',')]
+    template = catalog.read_catalog(args.template_cat)
+    num, ra, dec = template['NUMBER'], template['ALPHAWIN_J2000'], template['DELTAWIN_J2000']
+    start_time = time.time()
+    flux, fluxerr = forced_photometry(ra,dec,args.template,args.diff,diameters)
+    print('%d sources, %d epochs, %.2f s' % (len(num),len(args.diff),time.time()-start_time))
+    for filename, f, e in zip(args.diff,flux,fluxerr):
+        write_catalog(filename[0:-5]+'.cat',num,ra,dec,f,e,args.binary)
+    return
+
+if __name__ == "__main__":
+    main()
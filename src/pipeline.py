@@ -1,12 +1,25 @@
-import os, sys
+import os, re, sys, time, hashlib
 import numpy as np
 from misc import *
+from query import select_overlap
+from footprint import pointing_box
+from download import Downloader
+from imcache import ImageCache
+from templates import TemplateStore
+from reproject import PixelMapCache, reproject, paste_on_grid
+from diffim import subtract, load_template, template_stamps, write_stamp_list
+import photometry
+from catalog import read_catalog, check_catalog, rows_aligned, template_tree, match_catalog
+from lcstore import LightCurveStore, DTYPE as LC_DTYPE
+from coadd import coadd_diff
 
-def difference(file_info):
-    # Get DES hotpants files (TEMPORARY)
-    top_path = os.path.abspath(__file__)
-    top_dir = '/'.join(os.path.dirname(top_path).split('/')[0:-1])
-    hotpants_file = os.path.join(top_dir,'etc/DES.hotpants')
+def difference(file_info,hotpants_pars=None,backend='hotpants',pool=None):
+    # hotpants parameters are read once by the Pipeline, the file is only read for standalone calls
+    if hotpants_pars is None:
+        top_path = os.path.abspath(__file__)
+        top_dir = '/'.join(os.path.dirname(top_path).split('/')[0:-1])
+        hotpants_file = os.path.join(top_dir,'etc/DES.hotpants')
+        hotpants_pars = ''.join(open(hotpants_file,'r').readlines())
     local_path = file_info["path"]
     ccd = file_info["ccd"]
     file_root = local_path[0:-5]
@@ -17,12 +30,30 @@ def difference(file_info):
     outfile_wgt = file_root + "_template_c%d" % ccd + "_diff.weight.fits"
     template_sci = os.path.join(path_root,"template_c%d.fits" % ccd)
     template_wgt = os.path.join(path_root,"template_c%d.weight.fits" % ccd)
-    hotpants_pars = ''.join(open(hotpants_file,'r').readlines())
+    # template substamps and statistics precomputed once per CCD (Pipeline.prepare_difference)
+    template_prep = os.path.join(path_root,"template_c%d.stamps.npz" % ccd)
+    template_ssf = os.path.join(path_root,"template_c%d.ssf" % ccd)
     # HOTPANTS input parameters
     if not os.path.exists(outfile_sci):
-        command = 'hotpants -inim %s -ini %s -tmplim %s -tni %s -outim %s -oni %s -useWeight %s'
         args = (file_sci,file_wgt,template_sci,template_wgt,outfile_sci,outfile_wgt,hotpants_pars)
-        code = bash(command % args)
+        if backend == 'native':
+            args = args + (template_prep if os.path.exists(template_prep) else None,)
+            # in-process Alard-Lupton fit (diffim.py), in a worker process if a pool is given
+            try:
+                if pool is None:
+                    subtract(*args)
+                else:
+                    pool.apply(subtract,args)
+                code = 0
+            except Exception as e:
+                print('***Native difference failed for %s: %s***' % (os.path.basename(file_sci),e))
+                code = 1
+        else:
+            command = 'hotpants -inim %s -ini %s -tmplim %s -tni %s -outim %s -oni %s -useWeight %s'
+            if os.path.exists(template_ssf):
+                # substamps selected on the template only, no search per epoch
+                command += ' -ssf %s -afssc 0' % template_ssf
+            code = bash(command % args)
         # Handle HOTPANTS fatal error
         if code != 0:
             print('***HOTPANTS FATAL ERROR**')
@@ -31,17 +62,95 @@ def difference(file_info):
             return None
     else:
         print('***Difference image exists**')
-    return
+    return file_info
+
+
+def exposure_key(path):
+    # exposure name of an image URL, local image or its difference catalog
+    # (D..._immasked.fits.fz, D..._immasked_proj_c5_template_c5_diff.cat -> D..._immasked)
+    return re.split('_proj_c[0-9]+|_template_c[0-9]+',os.path.basename(path).split('.')[0])[0]
+
+
+class ImageRegistry:
+
+    def __init__(self):
+        # processed (downloaded and weighted) images of a run, one entry per physical file
+        # maps filename root to the local science image (None if processing failed)
+        self.images = {}
+
+
+    def key(self,path):
+        return os.path.basename(path).split('.')[0]
+
+
+    def add(self,image_list,file_info):
+        # register processed file_info; images of image_list missing from file_info failed
+        for path in image_list['path']:
+            self.images.setdefault(self.key(path),None)
+        if len(file_info) == 0: return
+        for path in file_info['path']:
+            self.images[self.key(path)] = path
+
+
+    def missing(self,image_list):
+        # unique images that have not been processed yet
+        keys = np.array([self.key(p) for p in image_list['path']])
+        _, idx = np.unique(keys,return_index=True)
+        idx = [i for i in np.sort(idx) if keys[i] not in self.images]
+        return image_list[idx]
+
+
+    def select(self,image_list,ccd):
+        # copy of image_list pointing to the processed images, assigned to template CCD
+        keys = np.array([self.key(p) for p in image_list['path']])
+        _, idx = np.unique(keys,return_index=True)
+        image_list = image_list[np.sort(idx)]
+        keys = keys[np.sort(idx)]
+        mask = np.array([self.images.get(k) is not None for k in keys],dtype=bool)
+        file_info = image_list[mask].copy()
+        file_info['path'] = [self.images[k] for k, m in zip(keys,mask) if m]
+        # dithering means the image CCD is not the template CCD
+        file_info['ccd'] = ccd
+        return file_info
 
 
 class Pipeline:
 
-    def __init__(self,bands,usr,psw,work_dir,top_dir=None,debug_mode=False):
+    def __init__(self,bands,usr,psw,work_dir,top_dir=None,debug_mode=False,download_threads=4,image_cache=None,cache_budget=100.,weight='makeweight',template_store=None,pointing=None,align_mode='single',diff_backend='hotpants',target=None,cutout_size=None,photometry='sextractor',catalog_type='ascii',incremental=False):
         self.bands = bands
         self.usr = usr
         self.psw = psw
         self.tile_dir = work_dir
         self.debug_mode = debug_mode
+        self.weight = weight
+        self.align_mode = align_mode
+        # template -> exposure pixel maps shared by all epochs (align_mode 'native')
+        self.pixel_maps = PixelMapCache()
+        # difference image backend (hotpants or native), native runs in a process pool
+        self.diff_backend = diff_backend
+        self.diff_pool = None
+        # (ra, dec) of a single target: only a cutout_size box around it is aligned, differenced and photometered
+        self.target = target
+        self.cutout_size = cutout_size
+        # forced photometry backend (sextractor per epoch or native over all epochs of a CCD)
+        self.photometry = photometry
+        # catalogs written as text (ascii) or memory mappable binary (FITS_LDAC from sextractor, .npy from photometry.py)
+        self.catalog_binary = catalog_type == 'binary'
+        # incremental runs only process exposures missing from the light curve store manifests,
+        # CCD -> processed exposure keys (None if the CCD has to be processed from scratch)
+        self.incremental = incremental
+        self.processed = {}
+        self.download_threads = download_threads
+        self.downloader = Downloader(usr,psw,max_connections=download_threads)
+        # persistent templates shared across work directories and grid jobs
+        self.pointing = pointing
+        self.template_store = None
+        if template_store is not None:
+            self.template_store = TemplateStore(template_store)
+        # shared image cache across tiles and runs
+        self.image_cache = None
+        if image_cache is not None:
+            self.image_cache = ImageCache(image_cache,cache_budget)
         # setup directories
         top_path = os.path.abspath(__file__)
         # default paths
@@ -61,6 +170,8 @@ class Pipeline:
             par_name = os.path.join(self.top_dir,"SN_diffim.sex.param")
             flt_name = os.path.join(self.top_dir,"SN_diffim.sex.conv")
             self.sex_pars = " -PARAMETERS_NAME %s -FILTER_NAME %s" % (par_name,flt_name)
+        if self.catalog_binary:
+            self.sex_pars += " -CATALOG_TYPE FITS_LDAC"
         # get hotpants parameters
         self.hotpants_pars = ''.join(open(self.hotpants_file,'r').readlines())
         # make directories
@@ -72,10 +183,14 @@ class Pipeline:
         # download image from image archive server
         url = info_list['path'] # Get URL
         local_path = os.path.join(self.tile_dir,os.path.basename(url))
+        if self.image_cache is not None and not os.path.exists(local_path[:-3]):
+            # link weight/mask products from the image cache
+            if self.image_cache.link(local_path,self.tile_dir):
+                print('***Image cached***')
         if not os.path.exists(local_path[:-3]):
-            command = 'wget -nc --no-check-certificate -q --user %s --password %s %s -P %s'
-            args = (self.usr,self.psw,url,self.tile_dir)
-            bash(command % args)
+            if self.downloader.download(url,self.tile_dir) is None:
+                print('***Download failed: %s***' % os.path.basename(url))
+                return None
         else:
             print('***Image exists***')
         # Change to local_path
@@ -93,13 +208,20 @@ class Pipeline:
             # skip if file already exists (for debugging)
             if not os.path.exists(file_sci):
                 # make weight maps and mask
-                code = bash('makeWeight -inFile_img %s -border 20 -outroot %s' % (local_path,file_root))
+                if self.weight == 'native':
+                    code = make_weight_map(local_path,file_root,border=20)
+                else:
+                    code = bash('makeWeight -inFile_img %s -border 20 -outroot %s' % (local_path,file_root))
                 if code != 0:
                     safe_rm(local_path, self.debug_mode)
                     return None
-                # convert files to single-header format
-                single_header(file_sci)
-                single_header(file_wgt)
+                if self.weight != 'native':
+                    # convert files to single-header format
+                    single_header(file_sci)
+                    single_header(file_wgt)
+                if self.image_cache is not None:
+                    try: self.image_cache.store([file_sci,file_wgt])
+                    except Exception as e: print('***Could not cache %s: %s***' % (file_sci,e))
             else:
                 print('***Weight image exists***')
             # Change to weight file
@@ -118,34 +240,47 @@ class Pipeline:
             return 1
         coadd_sci = os.path.join(self.tile_dir,'coadd_diff_c%d.fits' % ccd)
         coadd_wgt = os.path.join(self.tile_dir,'coadd_diff_c%d.weight.fits' % ccd)
-        # get lists for template creation and projection
-        info_list_abs = []
-        # Take absolute value of image
-        for i, f in enumerate(info_list["path"]):
-            try:
-                with fits.open(f[:-4]+".fits") as hdul:
-                    hdu = hdul[0]
-                    hdu = fits.PrimaryHDU(np.abs(hdu.data), hdu.header)
-                    f_abs = f[:-4] + "_abs.fits"
-                    hdu.writeto(f_abs, clobber=True)
-                    info_list_abs.append(f_abs)
-                    bash('ln -s %s %s' % (f[:-4]+".weight.fits", f[:-4]+"_abs.weight.fits"))
-            except:
-                pass
-        # Create swarp list
-        swarp_all_list = " ".join(info_list_abs)
-        # create coadd
-        s = swarp_all_list.split()
-        resample_dir = os.path.dirname(coadd_sci)
+        # streaming average of |diff| over the aligned difference images (coadd.py),
+        # background subtracted like the swarp coadd (etc/SN_distemp.swarp) it replaces
+        diff_files = [f[:-4]+".fits" for f in info_list["path"]]
         if not os.path.exists(coadd_sci):
-            bash('ln -s %s %s.head' % (s[0], coadd_sci[0:-5]))
-            command = 'swarp %s -c %s -IMAGEOUT_NAME %s -WEIGHTOUT_NAME %s -NTHREADS %d -RESAMPLE_DIR %s'
-            args = (swarp_all_list,self.swarp_file,coadd_sci,coadd_wgt,num_threads,resample_dir)
-            bash(command % args)
+            coadd_diff(diff_files,coadd_sci,coadd_wgt,mode='average',subtract_back=True)
         return 0
     
 
-    def make_template(self, info_list, sn=True, season=6, num_threads=1):
+    def template_version(self,ccd,path_root=None):
+        # content hash of the template a CCD is differenced against
+        template_sci = os.path.join(path_root or self.tile_dir,'template_c%d.fits' % ccd)
+        if not os.path.exists(template_sci):
+            return None
+        h = hashlib.sha1()
+        with open(template_sci,'rb') as f:
+            for block in iter(lambda: f.read(1<<24),b''):
+                h.update(block)
+        return h.hexdigest()[:16]
+
+
+    def processed_exposures(self,ccd):
+        # exposures already in the light curves of a CCD, if they can be appended to
+        # (same template as the manifest and template catalog kept by the previous run)
+        if ccd not in self.processed:
+            manifest = LightCurveStore(os.path.join(self.tile_dir,'lightcurves')).manifest(ccd)
+            if manifest is None or not os.path.exists(os.path.join(self.tile_dir,'template_c%d.cat' % ccd)) or manifest['template'] != self.template_version(ccd):
+                self.processed[ccd] = None
+            else:
+                self.processed[ccd] = set(manifest['exposures'])
+        return self.processed[ccd]
+
+
+    def new_exposures(self,image_list):
+        # image_list without the exposures already processed (array or iterator of batches)
+        if not isinstance(image_list,np.ndarray):
+            return (self.new_exposures(batch) for batch in image_list)
+        mask = [(self.processed_exposures(ccd) is None) or (exposure_key(path) not in self.processed_exposures(ccd)) for path, ccd in zip(image_list['path'],image_list['ccd'])]
+        return image_list[np.array(mask,dtype=bool)]
+
+
+    def make_template(self, info_list, sn=True, season=6, num_threads=1, align=True):
         # Use Y3 images
         ccd = info_list["ccd"][0]
         t0_Y6 = 58250
@@ -172,6 +307,17 @@ class Pipeline:
         # get lists for template creation and projection
         swarp_all_list = " ".join(info_list["path"])
         swarp_temp_list = " ".join(info_list_template["path"])
+        # look up template built from the same inputs and configuration
+        template_entry = None
+        if self.template_store is not None:
+            input_hash = self.template_store.input_hash(info_list_template["path"],[self.swarp_file,self.sex_file])
+            template_entry = self.template_store.entry_dir(self.pointing,ccd,self.bands,season,input_hash)
+            if self.template_store.link(template_entry,[template_sci,template_wgt,template_cat]):
+                print('***Template found in template store***')
+                if align:
+                    info_list['path'] = swarp_all_list.split()
+                    clean_tpool(self.align,info_list,num_threads)
+                return 0
         # create template (coadd of best frames)
         s = swarp_temp_list.split()
         resample_dir = os.path.dirname(template_sci)
@@ -180,14 +326,24 @@ class Pipeline:
             command = 'swarp %s -c %s -IMAGEOUT_NAME %s -WEIGHTOUT_NAME %s -NTHREADS %d -RESAMPLE_DIR %s'
             args = (swarp_temp_list,self.swarp_file,template_sci,template_wgt,num_threads,resample_dir)
             bash(command % args)
-        # Align
-        info_list_swarp = info_list
-        info_list_swarp['path'] = swarp_all_list.split()
-        clean_tpool(self.align,info_list_swarp,num_threads)
+        # Align (unless done per image by the caller)
+        if align:
+            info_list_swarp = info_list
+            info_list_swarp['path'] = swarp_all_list.split()
+            clean_tpool(self.align,info_list_swarp,num_threads)
         # Extract sources
         command = 'sex %s -WEIGHT_IMAGE %s  -CATALOG_NAME %s -c %s -MAG_ZEROPOINT 22.5 %s'
         args = (template_sci,template_wgt,template_cat,self.sex_file,self.sex_pars)
-        bash(command % args)
+        code = bash(command % args)
+        # publish template for later runs
+        if template_entry is not None and code == 0 and os.path.exists(template_cat):
+            provenance = {'pointing': str(self.pointing), 'ccd': int(ccd), 'band': self.bands, 'season': season,
+                          'inputs': [os.path.basename(f) for f in info_list_template["path"]],
+                          'mjd_obs': [float(m) for m in info_list_template["mjd_obs"]],
+                          'psf_fwhm': [float(p) for p in info_list_template["psf_fwhm"]],
+                          'swarp_file': self.swarp_file, 'sex_file': self.sex_file}
+            try: self.template_store.put(template_entry,[template_sci,template_wgt,template_cat],provenance)
+            except Exception as e: print('***Could not store template: %s***' % e)
         return 0
     
     
@@ -197,8 +353,9 @@ class Pipeline:
         # project and align images to template
         file_root = filename_in[0:-5]
         path_root = os.path.dirname(filename_in)
-        filename_out = file_root+"_proj.fits"
-        file_header = file_root+"_proj.head"
+        # one projection per template CCD (survey images can overlap several)
+        filename_out = file_root+"_proj_c%d.fits" % ccd
+        file_header = file_root+"_proj_c%d.head" % ccd
         template_sci = os.path.join(path_root,"template_c%d.fits"%ccd)
         # symbolic link for header geometry
         if not os.path.exists(filename_out):
@@ -210,76 +367,237 @@ class Pipeline:
             print('out file exists')
         info_list["path"] = filename_out
         return info_list
+
+
+    def align_native(self,info_list):
+        # same as align, resampled in-process with pixel maps cached per template CCD
+        filename_in = info_list["path"]
+        ccd = info_list["ccd"]
+        path_root = os.path.dirname(filename_in)
+        filename_out = filename_in[0:-5]+"_proj_c%d.fits" % ccd
+        template_sci = os.path.join(path_root,"template_c%d.fits"%ccd)
+        if not os.path.exists(filename_out):
+            try:
+                reproject(filename_in,template_sci,filename_out,self.pixel_maps)
+            except Exception as e:
+                print('***Reprojection failed for %s: %s***' % (os.path.basename(filename_in),e))
+                return None
+        else:
+            print('out file exists')
+        info_list["path"] = filename_out
+        return info_list
+
+
+    def cutout_target(self,file_info,ccd):
+        # template cutout around the target in tile_dir/cutout, epochs are linked there so the
+        # following stages (alignment onto the cutout template included) only touch the box
+        ra, dec = self.target
+        cutout_dir = os.path.join(self.tile_dir,'cutout')
+        if not os.path.exists(cutout_dir):
+            os.makedirs(cutout_dir)
+        template_sci = os.path.join(cutout_dir,'template_c%d.fits' % ccd)
+        template_wgt = os.path.join(cutout_dir,'template_c%d.weight.fits' % ccd)
+        template_cat = os.path.join(cutout_dir,'template_c%d.cat' % ccd)
+        if not os.path.exists(template_cat):
+            if not make_cutout(os.path.join(self.tile_dir,'template_c%d.fits' % ccd),template_sci,ra,dec,self.cutout_size):
+                print('***Target not on template CCD %d***' % ccd)
+                return file_info[0:0]
+            make_cutout(os.path.join(self.tile_dir,'template_c%d.weight.fits' % ccd),template_wgt,ra,dec,self.cutout_size)
+            # template catalog of the cutout (same detections as the forced photometry)
+            command = 'sex %s -WEIGHT_IMAGE %s  -CATALOG_NAME %s -c %s -MAG_ZEROPOINT 22.5 %s'
+            args = (template_sci,template_wgt,template_cat,self.sex_file,self.sex_pars)
+            if bash(command % args) != 0 or not os.path.exists(template_cat): return file_info[0:0]
+        paths = []
+        for path in file_info['path']:
+            for f in [path,path[0:-5]+'.weight.fits']:
+                link = os.path.join(cutout_dir,os.path.basename(f))
+                if not os.path.lexists(link):
+                    os.symlink(os.path.abspath(f),link)
+            paths.append(os.path.join(cutout_dir,os.path.basename(path)))
+        # longer paths than the path field may hold
+        width = max([len(p) for p in paths] + [file_info.dtype['path'].itemsize//file_info.dtype['path'].alignment])
+        dtype = [(n, file_info.dtype[n] if n != 'path' else '%s%d' % (file_info.dtype['path'].kind,width)) for n in file_info.dtype.names]
+        file_info = file_info.astype(dtype)
+        file_info['path'] = paths
+        print('Processing %dx%d pixel cutout around (%f, %f).' % (self.cutout_size,self.cutout_size,ra,dec))
+        return file_info
+
+
+    def align_batch(self,info_list,num_threads=1,max_batch=50):
+        # same as align, but all images of a template CCD are resampled by a few multi-image
+        # swarp runs (-COMBINE N keeps the resampled frames) sized to the thread budget
+        # resampled frames are named like the align outputs (X_proj_c<ccd>.fits, X_proj_c<ccd>.weight.fits)
+        # and have the template dimensions
+        # experimental: pixels have not been compared with align() on real data yet (benchmark.py align)
+        threads_per_job = max(1,min(num_threads,8))
+        num_jobs = max(1,num_threads//threads_per_job)
+        jobs = []
+        for ccd in np.unique(info_list['ccd']):
+            todo = [p for p, c in zip(info_list['path'],info_list['ccd']) if c == ccd and not os.path.exists(p[0:-5]+"_proj_c%d.fits" % ccd)]
+            if len(todo) == 0: continue
+            num_batches = min(len(todo),max(num_jobs,int(np.ceil(len(todo)/float(max_batch)))))
+            for k, batch in enumerate(np.array_split(np.array(todo),num_batches)):
+                jobs.append((ccd,k,list(batch)))
+        def run_job(job):
+            ccd, k, batch = job
+            path_root = os.path.dirname(batch[0])
+            out_root = os.path.join(path_root,"align_c%d_%d" % (ccd,k))
+            template_sci = os.path.join(path_root,"template_c%d.fits" % ccd)
+            # output geometry of the whole batch
+            if not os.path.lexists(out_root+".head"):
+                bash('ln -s %s %s.head' % (template_sci,out_root))
+            start_time = time.time()
+            bash('swarp %s -c %s -COMBINE N -DELETE_TMPFILES N -RESAMPLE_DIR %s -RESAMPLE_SUFFIX _proj_c%d.fits -NTHREADS %d -IMAGEOUT_NAME %s.fits -WEIGHTOUT_NAME %s.weight.fits' % (' '.join(batch),self.swarp_file,path_root,ccd,threads_per_job,out_root,out_root), True)
+            # resampled frames are cropped to each image footprint, paste them onto the template grid
+            for p in batch:
+                filename_out = p[0:-5]+"_proj_c%d.fits" % ccd
+                if os.path.exists(filename_out) and not paste_on_grid(filename_out,template_sci):
+                    safe_rm(filename_out)
+                    safe_rm(filename_out[0:-5]+".weight.fits")
+            seconds = time.time() - start_time
+            print('Aligned %d images to CCD %d in %.1f s (%.2f s/image).' % (len(batch),ccd,seconds,seconds/len(batch)))
+            return (len(batch),seconds)
+        start_time = time.time()
+        stats = clean_tpool(run_job,jobs,num_jobs)
+        if len(stats) > 0:
+            seconds = time.time() - start_time
+            print('Aligned %d images with %d swarp runs in %.1f s (%.2f s/image).' % (np.sum(stats[:,0]),len(stats),seconds,seconds/np.sum(stats[:,0])))
+        info_list = info_list.copy()
+        info_list['path'] = [p[0:-5]+"_proj_c%d.fits" % c for p, c in zip(info_list['path'],info_list['ccd'])]
+        mask = np.array([os.path.exists(p) for p in info_list['path']],dtype=bool)
+        if np.sum(~mask) > 0:
+            print('***Alignment failed for %d images***' % np.sum(~mask))
+        return info_list[mask]
+
+
+    def prepare_difference(self,ccd,path_root=None):
+        # template side of the difference imaging, done once for all epochs of a CCD:
+        # substamp selection (and their basis convolutions for the native backend)
+        # path_root: template directory of the epochs (tile_dir, or tile_dir/cutout for a target cutout)
+        if path_root is None:
+            path_root = self.tile_dir
+        template_sci = os.path.join(path_root,"template_c%d.fits" % ccd)
+        template_wgt = os.path.join(path_root,"template_c%d.weight.fits" % ccd)
+        template_prep = os.path.join(path_root,"template_c%d.stamps.npz" % ccd)
+        template_ssf = os.path.join(path_root,"template_c%d.ssf" % ccd)
+        try:
+            if self.diff_backend == 'native':
+                centers = load_template(template_sci,template_wgt,self.hotpants_pars,template_prep)['centers']
+            elif not os.path.exists(template_ssf) or os.path.getmtime(template_ssf) < os.path.getmtime(template_sci):
+                centers = template_stamps(template_sci,template_wgt,self.hotpants_pars)
+                write_stamp_list(centers,template_ssf)
+            else:
+                return
+            print('Selected %d template substamps.' % len(centers))
+        except Exception as e:
+            print('***Template precompute failed for CCD %d: %s***' % (ccd,e))
+        return
+
+
+    def difference(self,file_info):
+        return difference(file_info,self.hotpants_pars,self.diff_backend,self.diff_pool)
+
+
+    def align_difference_photometry(self,file_info,num_threads=1):
+        # align -> difference -> photometry per image; batched alignment runs ahead of the other stages
+        if self.diff_backend == 'native' and self.diff_pool is None and num_threads > 1:
+            # started while no stage threads are running
+            self.diff_pool = Pool(num_threads)
+        stages = [(self.difference,num_threads)]
+        if self.photometry != 'native':
+            stages.append((self.forced_photometry,num_threads))
+        try:
+            for ccd in np.unique(file_info['ccd']):
+                # the template next to the epochs is the one they are differenced against
+                self.prepare_difference(ccd,os.path.dirname(file_info['path'][file_info['ccd'] == ccd][0]))
+            if self.align_mode == 'batch':
+                file_info = self.align_batch(file_info,num_threads)
+                if len(file_info) == 0: return file_info
+            elif self.align_mode == 'native':
+                stages = [(self.align_native,num_threads)] + stages
+            else:
+                stages = [(self.align,num_threads)] + stages
+            file_info = stage_tpool(file_info,stages)
+        finally:
+            # the difference pool only lives for this stage
+            if self.diff_pool is not None:
+                self.diff_pool.close()
+                self.diff_pool.join()
+                self.diff_pool = None
+        if self.align_mode == 'native':
+            print(self.pixel_maps.summary())
+            # the epochs of these CCDs are aligned, their maps are not needed again
+            self.pixel_maps.clear()
+        if self.photometry == 'native':
+            file_info = self.forced_photometry_native(file_info)
+        return file_info
     
 
-    def generate_light_curves(self,info_list):
+    def generate_light_curves(self,info_list,append=False):
         # generates light curve files from list of sextractor catalogs
         # with forced photometry on the template image
         # measure template flux to add to difference flux
         ccd = info_list['ccd'][0]
-        template_cat = os.path.join(self.tile_dir,'template_c%d.cat'%ccd)
         diff_cat = info_list['path']
+        # template catalog next to the difference catalogs (tile_dir or cutout directory)
+        template_cat = os.path.join(os.path.dirname(diff_cat[0]),'template_c%d.cat'%ccd)
         mjds = info_list['mjd_obs']
-        # assumes all catalogs have same number of lines (detections)
-        # template catalog
-        # Yes, this code is horrifying...
-        num,ra,dec,f3_temp,f4_temp,f5_temp,ferr3_temp,ferr4_temp,ferr5_temp = np.loadtxt(template_cat, unpack=True)
-        num_list = []; mjd_list = []
-        ra_list = []; dec_list = []
-        f3_list = []; ferr3_list = []
-        f4_list = []; ferr4_list = []
-        f5_list = []; ferr5_list = []
+        # catalogs are read without text parsing if binary (read_catalog), catalogs whose rows are not
+        # the template detections are matched to them by position (match_catalog)
+        template = read_catalog(template_cat)
+        tree = None
+        f_temp = np.reshape(template['FLUX_APER'],(len(template),-1)).astype(float)
+        ferr_temp = np.reshape(template['FLUXERR_APER'],(len(template),-1)).astype(float)
+        # every catalog has at most the template rows, so the output is allocated once
+        lc = np.zeros(len(diff_cat)*len(template),dtype=LC_DTYPE)
+        num_rows = 0
+        exposures = []
         # difference catalog
         for i, diff_cat_file in enumerate(diff_cat):
             try:
-                num,ra,dec,df3,df4,df5,dferr3,dferr4,dferr5 = np.loadtxt(str(diff_cat_file), unpack=True)
+                cat = read_catalog(str(diff_cat_file))
             except:
                 continue
-            mjd = np.full(len(num), mjds[i])
+            problem = check_catalog(cat,template)
+            if problem is not None:
+                print('***Skipping %s: %s***' % (os.path.basename(str(diff_cat_file)),problem))
+                continue
+            if rows_aligned(cat,template):
+                cat_rows = temp_rows = np.arange(len(cat))
+            else:
+                # different detections than the template: KD-tree match of the positions
+                if tree is None:
+                    tree = template_tree(template)
+                cat_rows, temp_rows = match_catalog(cat,tree)
+                print('Matched %d of %d detections of %s to the template.' % (len(cat_rows),len(cat),os.path.basename(str(diff_cat_file))))
+            df = np.reshape(cat['FLUX_APER'],(len(cat),-1))[cat_rows].astype(float)
+            dferr = np.reshape(cat['FLUXERR_APER'],(len(cat),-1))[cat_rows].astype(float)
             # Bad photometry
-            df3[np.abs(df3)<1e-29] = np.nan
-            df4[np.abs(df4)<1e-29] = np.nan
-            df5[np.abs(df5)<1e-29] = np.nan
+            df[np.abs(df)<1e-29] = np.nan
+            rows = lc[num_rows:num_rows+len(cat_rows)]
+            rows['num'], rows['ra'], rows['dec'] = template['NUMBER'][temp_rows], template['ALPHAWIN_J2000'][temp_rows], template['DELTAWIN_J2000'][temp_rows]
+            rows['mjd_obs'] = mjds[i]
             # Save light curves
-            f3 = np.sum([f3_temp,df3],axis=0)
-            f4 = np.sum([f4_temp,df4],axis=0)
-            f5 = np.sum([f5_temp,df5],axis=0)
+            rows['flux3'], rows['flux4'], rows['flux5'] = (f_temp[temp_rows]+df).T
             # Add errors in quadrature
-            ferr3 = np.sqrt(np.sum([ferr3_temp**2,dferr3**2],axis=0))
-            ferr4 = np.sqrt(np.sum([ferr4_temp**2,dferr4**2],axis=0))
-            ferr5 = np.sqrt(np.sum([ferr5_temp**2,dferr5**2],axis=0))
-            # append arrays
-            num_list.append(num)
-            mjd_list.append(mjd)
-            ra_list.append(ra)
-            dec_list.append(dec)
-            f3_list.append(f3)
-            f4_list.append(f4)
-            f5_list.append(f5)
-            ferr3_list.append(ferr3)
-            ferr4_list.append(ferr4)
-            ferr5_list.append(ferr5)
+            rows['fluxerr3'], rows['fluxerr4'], rows['fluxerr5'] = np.sqrt(ferr_temp[temp_rows]**2+dferr**2).T
+            num_rows += len(cat_rows)
+            exposures.append(exposure_key(str(diff_cat_file)))
             safe_rm(diff_cat, self.debug_mode)
-        # flatten and save data
-        num_list = np.array(num_list).flatten()
-        mjd_list = np.array(mjd_list).flatten()
-        ra_list = np.array(ra_list).flatten()
-        dec_list = np.array(dec_list).flatten()
-        f3_list = np.array(f3_list).flatten()
-        f4_list = np.array(f4_list).flatten()
-        f5_list = np.array(f5_list).flatten()
-        ferr3_list = np.array(ferr3_list).flatten()
-        ferr4_list = np.array(ferr4_list).flatten()
-        ferr5_list = np.array(ferr5_list).flatten()
-        # save
+        # save to the light curve store next to the catalogs (sorted by num and mjd_obs, indexed by num)
         path_root = os.path.dirname(diff_cat[0])
-        path_dat = os.path.join(path_root,'cat_c%d.dat' % ccd)
-        dat = [num_list, mjd_list, ra_list, dec_list, f3_list, f4_list, f5_list, ferr3_list, ferr4_list, ferr5_list]
-        hdr = 'num mjd_obs ra dec flux3 flux4 flux5 fluxerr3 fluxerr4 fluxerr5'
-        print('Saving catalog as %s' % path_dat)
-        np.savetxt(path_dat,np.array(dat).T,fmt='%d %f %f %f %f %f %f %f %f %f',header=hdr)
-        safe_rm(template_cat, self.debug_mode)
-        safe_rm('%s.head' % template_cat[0:-5], self.debug_mode)
+        store = LightCurveStore(os.path.join(path_root,'lightcurves'))
+        manifest = {'template': self.template_version(ccd,path_root), 'exposures': exposures}
+        if append:
+            old_exposures = store.manifest(ccd)['exposures']
+            manifest['exposures'] = old_exposures + [e for e in exposures if e not in set(old_exposures)]
+            print('Appending %d epochs to %s' % (len(exposures),store.append(ccd,lc[0:num_rows],manifest)))
+        else:
+            print('Saving light curves to %s' % store.write(ccd,lc[0:num_rows],manifest))
+        # the template catalog is needed again to append later epochs
+        if not self.incremental:
+            safe_rm(template_cat, self.debug_mode)
+            safe_rm('%s.head' % template_cat[0:-5], self.debug_mode)
         return
 
 
@@ -304,32 +622,78 @@ class Pipeline:
         # Update to catalog file
         info_list["path"] = outfile_cat
         return info_list
+
+
+    def forced_photometry_native(self,file_info):
+        # same catalogs as forced_photometry, measured in-process on all difference images of a CCD at once
+        if len(file_info) == 0: return file_info
+        diameters = [float(d) for d in photometry.read_sex_config(self.sex_file)['PHOT_APERTURES'].split(',')]
+        keep = np.zeros(len(file_info),dtype=bool)
+        for ccd in np.unique(file_info['ccd']):
+            idx = np.where(file_info['ccd'] == ccd)[0]
+            path_root = os.path.dirname(file_info['path'][idx[0]])
+            template_sci = os.path.join(path_root,"template_c%d.fits" % ccd)
+            template_cat = os.path.join(path_root,"template_c%d.cat" % ccd)
+            file_root = [p[0:-5] + "_template_c%d" % ccd + "_diff" for p in file_info['path'][idx]]
+            todo = [i for i, f in enumerate(file_root) if not os.path.exists(f + ".cat")]
+            keep[idx] = [os.path.exists(f + ".cat") for f in file_root]
+            if len(todo) > 0:
+                start_time = time.time()
+                template = read_catalog(template_cat)
+                num, ra, dec = template['NUMBER'], template['ALPHAWIN_J2000'], template['DELTAWIN_J2000']
+                diff_files = [file_root[i] + ".fits" for i in todo]
+                flux, fluxerr = photometry.forced_photometry(ra,dec,template_sci,diff_files,diameters)
+                for i, f, e in zip(todo,flux,fluxerr):
+                    if np.all(np.isnan(f)): continue
+                    photometry.write_catalog(file_root[i] + ".cat",num,ra,dec,f,e,self.catalog_binary)
+                    keep[idx[i]] = True
+                print('Forced photometry of %d sources on %d epochs (CCD %d): %.2f s' % (len(num),len(todo),ccd,time.time()-start_time))
+            for i in idx:
+                file_info['path'][i] = file_info['path'][i][0:-5] + "_template_c%d" % ccd + "_diff.cat"
+        return file_info[keep]
     
 
     def run_ccd_sn(self,image_list,num_threads=1,template_season=6,fermigrid=False):
         # given list of single-epoch image filenames in same tile or region, execute pipeline
-        print('Pooling %d single-epoch images to %d threads.' % (len(image_list),num_threads))
+        # image_list can also be an iterator of batches (Query.iter_image_info_field)
+        # images flow through download -> weight and align -> difference -> photometry without
+        # waiting for each other; only the template build waits for all images of a CCD
         print('Downloading images, making weight maps and image masks.')
-        file_info_all = clean_tpool(self.download_image, image_list, num_threads)
-        print("Downloaded %d images" % len(file_info_all))
-        file_info_all = clean_tpool(self.make_weight, file_info_all, num_threads)
+        if isinstance(image_list,np.ndarray):
+            print('Pooling %d single-epoch images to %d threads.' % (len(image_list),num_threads))
+        else:
+            print('Streaming single-epoch images to %d threads.' % num_threads)
+        if self.incremental:
+            # only exposures not in the light curves yet
+            image_list = self.new_exposures(image_list)
+            if isinstance(image_list,np.ndarray):
+                print('%d new single-epoch images.' % len(image_list))
+        if not isinstance(image_list,np.ndarray):
+            image_list = (i for batch in image_list for i in batch)
+        file_info_all = stage_tpool(image_list, [(self.download_image,self.download_threads),(self.make_weight,num_threads)])
+        print("Processed %d images" % len(file_info_all))
+        print(self.downloader.summary())
+        if len(file_info_all) == 0: return file_info_all
         print('Making templates and aligning frames.')
         # CCD loop
         for ccd in np.sort(np.unique(file_info_all['ccd'])):
             print('Running CCD %d.' % ccd)
             file_info = file_info_all[file_info_all['ccd']==ccd]
             if len(file_info) == 0: continue
-            code = self.make_template(file_info,sn=True,season=template_season,num_threads=num_threads)
-            if code != 0: continue
-            # make difference images
-            print('Differencing images.')
-            clean_pool(difference,file_info,num_threads)
-            # forced photometry
-            print('Performing forced photometry.')
-            file_info = clean_tpool(self.forced_photometry,file_info,num_threads)
+            # new epochs of an incremental run use the existing template
+            append = self.incremental and self.processed_exposures(ccd) is not None
+            if append:
+                print('Appending new epochs to the light curves of CCD %d.' % ccd)
+            else:
+                code = self.make_template(file_info,sn=True,season=template_season,num_threads=num_threads,align=False)
+                if code != 0: continue
+            # align, make difference images and do forced photometry per image
+            print('Aligning, differencing images and performing forced photometry.')
+            file_info = self.align_difference_photometry(file_info,num_threads)
+            if len(file_info) == 0: continue
             # write lightcurve data
             print('Generating light curves.')
-            self.generate_light_curves(file_info)
+            self.generate_light_curves(file_info,append)
             # clean directory
         return file_info_all
     
@@ -338,9 +702,18 @@ class Pipeline:
         # given list of single-epoch image filenames in same pointing, execute pipeline
         print('Pooling %d single-epoch images to %d threads.' % (len(image_list),num_threads))
         print('Downloading images, making weight maps and image masks.')
-        file_info_all = clean_tpool(self.download_image, image_list, num_threads)
-        print("Downloaded %d images" % len(file_info_all))
-        file_info_all = clean_tpool(self.make_weight, file_info_all, num_threads)
+        file_info_all = stage_tpool(image_list, [(self.download_image,self.download_threads),(self.make_weight,num_threads)])
+        print("Processed %d images" % len(file_info_all))
+        print(self.downloader.summary())
+        # download and make weights once per image, shared between template CCDs
+        registry = ImageRegistry()
+        registry.add(image_list,file_info_all)
+        print('Querying overlapping CCD images.')
+        # Query all images overlapping the pointing at once, then assign them to each template CCD
+        # (dithering prevents us from using same CCD ID as in SN fields)
+        # (the box is split at RA=0 for pointings crossing it)
+        box = pointing_box(file_info_all['ramin'],file_info_all['ramax'],file_info_all['decmin'],file_info_all['decmax'])
+        image_list_pointing = query_sci.get_image_info_overlap_bulk(*box,band=band)
         print('Making templates and aligning frames.')
         # CCD loop in template list
         image_list_all = []
@@ -349,35 +722,33 @@ class Pipeline:
             file_info_template = file_info_all[file_info_all['ccd']==ccd]
             if len(file_info_template) == 0: continue
             print('Making template')
-            code = self.make_template(file_info_template,sn=False,season=template_season,num_threads=num_threads)
+            code = self.make_template(file_info_template,sn=False,season=template_season,num_threads=num_threads,align=False)
             if code != 0: continue
-            print('Querying overlapping CCD images.')
-            # Now query images which overlap with this template CCD
-            # (dithering prevents us from using same CCD ID as in SN fields)
-            image_list = query_sci.get_image_info_overlap(file_info_template['ramin'][0],file_info_template['ramax'][0],
-                                                         file_info_template['decmin'][0],file_info_template['decmax'][0],
-                                                         band=band)
+            # Now select images which overlap with this template CCD
+            image_list = select_overlap(image_list_pointing,file_info_template['ramin'][0],file_info_template['ramax'][0],
+                                        file_info_template['decmin'][0],file_info_template['decmax'][0])
             if image_list is None:
                 print('***Error: No overlapping images found.***')
                 return
-            print('Downloading images, making weight maps and image masks.')
-            file_info = clean_tpool(self.download_image,image_list,num_threads)
-            print("Downloaded %d images" % len(file_info))
-            file_info = clean_tpool(self.make_weight,file_info,num_threads)
-            # Small hack to set the image CCD to the template's CCD
-            file_info['ccd'] = np.full(len(file_info), ccd)
-            print('Aligning frames.')
-            info_list = clean_tpool(self.align,file_info,num_threads=num_threads)
-            # make difference images
+            image_list_new = registry.missing(image_list)
+            print('Downloading %d new images (%d already processed), making weight maps and image masks.' % (len(image_list_new),len(image_list)-len(image_list_new)))
+            if len(image_list_new) > 0:
+                file_info = stage_tpool(image_list_new, [(self.download_image,self.download_threads),(self.make_weight,num_threads)])
+                print("Processed %d images" % len(file_info))
+                print(self.downloader.summary())
+                registry.add(image_list_new,file_info)
+            file_info = registry.select(image_list,ccd)
+            if self.target is not None and self.cutout_size is not None:
+                file_info = self.cutout_target(file_info,ccd)
+            if len(file_info) == 0: continue
+            # align, make difference images and do forced photometry per image
             # we should be good with this! No need to combine ones taken on the same night anymore ;)
             # they will come through nicely by sorting the catalogs afterwords
-            print('Differencing images.')
-            clean_pool(difference,file_info,num_threads)
-            # forced photometry
-            print('Performing forced photometry.')
-            file_info = clean_tpool(self.forced_photometry,file_info,num_threads)
+            print('Aligning, differencing images and performing forced photometry.')
+            file_info = self.align_difference_photometry(file_info,num_threads)
+            if len(file_info) == 0: continue
             # write lightcurve data
-	    # seems to be different numbers of detections in template and diff images for some reason
+            # catalogs with other detections than the template are matched to it in generate_light_curves
             if offset==False:
                 print('Generating light curves.')
                 self.generate_light_curves(file_info)
@@ -1,24 +1,87 @@
 import os
-import despydb.desdbi as desdbi
 import numpy as np
 import argparse
+from cache import QueryCache
+from footprint import wrap_interval
+
+BASE_URL = "https://desar2.cosmology.illinois.edu/DESFiles/desarchive/"
+# processing versions of the zeropoint tables (also used as cache version)
+Y6_VERSION = "y6a1_v2.1"
+SV_VERSION = "v2.0"
 
 class Query:
 
-    def __init__(self,section="db-dessci"):
-        # read des services file doe database connection
-        self.desdmfile = os.environ["DES_SERVICES"]
-        f = open(self.desdmfile,"r")
-        contents = f.read()
-        s = contents.split('[%s]' % section)[1].replace("\n"," ")
-        self.usr = s.split("user")[1].split("=")[1].split()[0]
-        self.psw = s.split("passwd")[1].split("=")[1].split()[0]
+    def __init__(self,section="db-dessci",cache_path=None,cache_read_only=False,con=None):
+        # con: DB-API connection to use instead of DESDM Oracle (e.g. sqlitedb.SqliteConnection)
+        self.section = section
+        self.usr = None
+        self.psw = None
+        if con is None:
+            # read des services file doe database connection
+            self.desdmfile = os.environ["DES_SERVICES"]
+            f = open(self.desdmfile,"r")
+            contents = f.read()
+            s = contents.split('[%s]' % section)[1].replace("\n"," ")
+            self.usr = s.split("user")[1].split("=")[1].split()[0]
+            self.psw = s.split("passwd")[1].split("=")[1].split()[0]
+        # connection is only started on a cache miss
+        self.con = con
+        self.cur = None
+        self.cache = None
+        if cache_path is not None:
+            self.cache = QueryCache(cache_path,cache_read_only)
+
+
+    def connect(self):
         # start connection
-        self.con = desdbi.DesDbi(self.desdmfile,section)
-        self.cur = self.con.cursor()
-        
+        if self.con is None:
+            import despydb.desdbi as desdbi
+            self.con = desdbi.DesDbi(self.desdmfile,self.section)
+        if self.cur is None:
+            self.cur = self.con.cursor()
+        return self.cur
+
+
+    def cached(self,query,band,key,func,*args):
+        # look up query result in local cache before going to the database
+        if self.cache is None:
+            self.connect()
+            return func(*args)
+        key = self.cache.make_key(key)
+        hit, info_list = self.cache.get(query,band,key,Y6_VERSION)
+        if hit:
+            return info_list
+        self.connect()
+        info_list = func(*args)
+        self.cache.put(query,band,key,Y6_VERSION,info_list)
+        return info_list
+
 
     def get_filenames_from_object(self,ra,dec,band,window_radius=10):
+        return self.cached('object',band,(ra,dec,window_radius),self._get_filenames_from_object,ra,dec,band,window_radius)
+
+
+    def get_pointing_coord(self,ra,dec,band='g',season=6):
+        return self.cached('coord',band,(ra,dec,season),self._get_pointing_coord,ra,dec,band,season)
+
+
+    def get_image_info_pointing(self,tra,tdec,mjd_obs,band='g'):
+        return self.cached('pointing',band,(tra,tdec,mjd_obs),self._get_image_info_pointing,tra,tdec,mjd_obs,band)
+
+
+    def get_image_info_overlap(self,ramin,ramax,decmin,decmax,band='g'):
+        return self.cached('overlap',band,(ramin,ramax,decmin,decmax),self._get_image_info_overlap,ramin,ramax,decmin,decmax,band)
+
+
+    def get_image_info_field(self,field,band='g'):
+        return self.cached('field',band,(field,),self._get_image_info_field,field,band)
+
+
+    def get_image_info_overlap_bulk(self,ramin,ramax,decmin,decmax,band='g'):
+        return self.cached('overlap_bulk',band,(ramin,ramax,decmin,decmax),self._get_image_info_overlap_bulk,ramin,ramax,decmin,decmax,band)
+
+
+    def _get_filenames_from_object(self,ra,dec,band,window_radius=10):
         # get reduced filename from RA, DEC of object
         dec_radian = dec*np.pi/180.
         ra_upper = (ra+window_radius/3600./np.cos(dec_radian))
@@ -42,7 +105,7 @@ class Query:
             return None
 
     
-    def get_pointing_coord(self,ra,dec,band='g',season=6):
+    def _get_pointing_coord(self,ra,dec,band='g',season=6):
         # Get list of unique Y? pointing of target given RA and dec in the main DES survey
         t0_Y6 = 58250
         t1_Y6 = 58615
@@ -62,19 +125,17 @@ class Query:
             return None
         
     
-    def get_image_info_pointing(self,tra,tdec,mjd_obs,band='g'):
+    def _get_image_info_pointing(self,tra,tdec,mjd_obs,band='g'):
         # Get image archive info (URL) from specific pointing and MJD (to generate templates)
-        base_url = "https://desar2.cosmology.illinois.edu/DESFiles/desarchive/"
         # Get Y1-Y6 images
         get_list = "select f.filename, f.path, f.compression, s.psf_fwhm, i.skysigma, e.mjd_obs, i.racmin, i.racmax, i.deccmin, i.deccmax from y6a1_file_archive_info f, y6a1_image i, y6a1_exposure e, y6a1_qa_summary s, y6a1_zeropoint z where i.filetype='red_immask' and f.filename=i.filename and z.imagename=i.filename and i.expnum=e.expnum and e.expnum=s.expnum and e.TRADEG=:tra and e.TDECDEG=:tdec and i.band=:band and e.mjd_obs=:mjd_obs and z.version=:version"
-        self.cur.execute(get_list,tra=tra,tdec=tdec,band=band,mjd_obs=mjd_obs,version="y6a1_v2.1")
+        self.cur.execute(get_list,tra=tra,tdec=tdec,band=band,mjd_obs=mjd_obs,version=Y6_VERSION)
         info_list = self.cur.fetchall()
         if len(info_list) > 0:
             dtype = [("filename","|S41"),("path","|S200"),("compression","|S4"),("psf_fwhm",float),("skysigma",float),("mjd_obs",float),("ramin",float),("ramax",float),("decmin",float),("decmax",float)]
             info_list = np.array(info_list,dtype=dtype)
             # Form URL and data type
-            ccd_list = [f["filename"].split('_c')[1][:2] for f in info_list]
-            url_list = [base_url+f["path"]+"/"+f["filename"]+f["compression"] for f in info_list]
+            url_list, ccd_list = image_urls(info_list)
             dtype = [("path","|S300"),("psf_fwhm",float),("skysigma",float),("mjd_obs",float),("ccd",int),("ramin",float),("ramax",float),("decmin",float),("decmax",float)]
             info_list = list(zip(url_list,info_list["psf_fwhm"],info_list["skysigma"],info_list["mjd_obs"],ccd_list,info_list["ramin"],info_list["ramax"],info_list["decmin"],info_list["decmax"]))
             info_list = np.array(info_list,dtype=dtype)
@@ -83,30 +144,28 @@ class Query:
             return None
     
     
-    def get_image_info_overlap(self,ramin,ramax,decmin,decmax,band='g'):
+    def _get_image_info_overlap(self,ramin,ramax,decmin,decmax,band='g'):
         # TODO: EDGE CASE WHEN  RACROSS0
-        base_url = "https://desar2.cosmology.illinois.edu/DESFiles/desarchive/"
         # Get image archive info (URL) at main survey telescope pointing
         # Get Y1-Y6 images
         get_list = "select f.filename, f.path, f.compression, s.psf_fwhm, i.skysigma, e.mjd_obs from y6a1_file_archive_info f, y6a1_image i, y6a1_exposure e, y6a1_qa_summary s, y6a1_zeropoint z where i.filetype='red_immask' and f.filename=i.filename and z.imagename=i.filename and i.expnum=e.expnum and e.expnum=s.expnum and \
         (i.racmin between :ramin and :ramax or i.racmax between :ramin and :ramax) and \
         (i.deccmin between :decmin and :decmax or i.deccmax between :decmin and :decmax) \
         and i.band=:band and z.version=:version and e.mjd_obs>56400"
-        self.cur.execute(get_list,ramin=ramin,ramax=ramax,decmin=decmin,decmax=decmax,band=band,version="y6a1_v2.1")
+        self.cur.execute(get_list,ramin=ramin,ramax=ramax,decmin=decmin,decmax=decmax,band=band,version=Y6_VERSION)
         info_list = self.cur.fetchall()
         # get SV images
         get_list = "select f.filename, f.path, f.compression, s.psf_fwhm, i.skysigma, e.mjd_obs from y6a1_file_archive_info f, y6a1_image i, y6a1_exposure e, y6a1_qa_summary s, y6a1_zeropoint z where i.filetype='red_immask' and f.filename=i.filename and z.imagename=i.filename and i.expnum=e.expnum and e.expnum=s.expnum and \
         (i.racmin between :ramin and :ramax or i.racmax between :ramin and :ramax) and \
         (i.deccmin between :decmin and :decmax or i.deccmax between :decmin and :decmax) \
         and i.band=:band and z.version=:version and e.mjd_obs>56400"
-        self.cur.execute(get_list,ramin=ramin,ramax=ramax,decmin=decmin,decmax=decmax,band=band,version="v2.0")
+        self.cur.execute(get_list,ramin=ramin,ramax=ramax,decmin=decmin,decmax=decmax,band=band,version=SV_VERSION)
         info_list += self.cur.fetchall()
         if len(info_list) > 0:
             dtype = [("filename","|S41"),("path","|S200"),("compression","|S4"),("psf_fwhm",float),("skysigma",float),("mjd_obs",float)]
             info_list = np.array(info_list,dtype=dtype)
             # Form URL and data type
-            ccd_list = [f["filename"].split('_c')[1][:2] for f in info_list]
-            url_list = [base_url+f["path"]+"/"+f["filename"]+f["compression"] for f in info_list]
+            url_list, ccd_list = image_urls(info_list)
             dtype = [("path","|S300"),("psf_fwhm",float),("skysigma",float),("mjd_obs",float),("ccd",int)]
             info_list = list(zip(url_list,info_list["psf_fwhm"],info_list["skysigma"],info_list["mjd_obs"],ccd_list))
             info_list = np.array(info_list,dtype=dtype)
@@ -115,39 +174,126 @@ class Query:
             return None
             
 
-    def get_image_info_field(self,field,band='g'):
-        # get image archive info (URL) from SN-field name or COSMOS
-        base_url = "https://desar2.cosmology.illinois.edu/DESFiles/desarchive/"
+    def _get_image_info_overlap_bulk(self,ramin,ramax,decmin,decmax,band='g'):
+        # Same as get_image_info_overlap, but for the total footprint of a pointing in a single query
+        # Keeps the CCD corners so images can be assigned to each template CCD with select_overlap
+        # A box crossing RA=0 (ramin > ramax, see footprint.pointing_box) is queried as two RA ranges
+        get_list = "select f.filename, f.path, f.compression, s.psf_fwhm, i.skysigma, e.mjd_obs, i.racmin, i.racmax, i.deccmin, i.deccmax from y6a1_file_archive_info f, y6a1_image i, y6a1_exposure e, y6a1_qa_summary s, y6a1_zeropoint z where i.filetype='red_immask' and f.filename=i.filename and z.imagename=i.filename and i.expnum=e.expnum and e.expnum=s.expnum and \
+        (i.racmin between :ramin and :ramax or i.racmax between :ramin and :ramax) and \
+        (i.deccmin between :decmin and :decmax or i.deccmax between :decmin and :decmax) \
+        and i.band=:band and z.version in (:version, :version_sv) and e.mjd_obs>56400"
+        ra_ranges = [(ramin,ramax)] if ramin <= ramax else [(ramin,360.),(0.,ramax)]
+        info_list = []
+        for ra0, ra1 in ra_ranges:
+            self.cur.execute(get_list,ramin=ra0,ramax=ra1,decmin=decmin,decmax=decmax,band=band,version=Y6_VERSION,version_sv=SV_VERSION)
+            info_list += self.cur.fetchall()
+        # CCDs crossing RA=0 are found by both ranges
+        info_list = list(dict([(row[0],row) for row in info_list]).values())
+        if len(info_list) > 0:
+            dtype = [("filename","|S41"),("path","|S200"),("compression","|S4"),("psf_fwhm",float),("skysigma",float),("mjd_obs",float),("ramin",float),("ramax",float),("decmin",float),("decmax",float)]
+            info_list = np.array(info_list,dtype=dtype)
+            # Form URL and data type
+            url_list, ccd_list = image_urls(info_list)
+            dtype = [("path","|S300"),("psf_fwhm",float),("skysigma",float),("mjd_obs",float),("ccd",int),("ramin",float),("ramax",float),("decmin",float),("decmax",float)]
+            info_list = list(zip(url_list,info_list["psf_fwhm"],info_list["skysigma"],info_list["mjd_obs"],ccd_list,info_list["ramin"],info_list["ramax"],info_list["decmin"],info_list["decmax"]))
+            info_list = np.array(info_list,dtype=dtype)
+            return info_list
+        else:
+            return None
+
+
+    def field_queries(self,field,band='g'):
+        # (query, parameters) for SN-field name or COSMOS, Y1-Y6 and SV images
         if field.lower() == "cosmos":
             decmin, decmax = 1.22, 3.20
             ramin, ramax = 149.03, 151.21
             # get Y1-Y6 images
             get_list = "select f.filename, f.path, f.compression, s.psf_fwhm, i.skysigma, e.mjd_obs from y6a1_file_archive_info f, y6a1_image i, y6a1_exposure e, y6a1_qa_summary s, y6a1_zeropoint z where i.filetype='red_immask' and f.filename=i.filename and z.imagename=i.filename and i.expnum=e.expnum and e.expnum=s.expnum and i.dec_cent between :decmin and :decmax and i.ra_cent between :ramin and :ramax and i.band=:band and z.version=:version and e.mjd_obs>56400"
-            self.cur.execute(get_list,decmin=decmin,decmax=decmax,ramin=ramin,ramax=ramax,band=band,version="y6a1_v2.1")
-            info_list = self.cur.fetchall()
+            queries = [(get_list,dict(decmin=decmin,decmax=decmax,ramin=ramin,ramax=ramax,band=band,version=Y6_VERSION))]
             # get SV images
             get_list = "select f.filename, f.path, f.compression, s.psf_fwhm, i.skysigma, e.mjd_obs from y4a1_file_archive_info f, y4a1_image i, y4a1_exposure e, y4a1_qa_summary s, y4a1_zeropoint z where i.filetype='red_immask' and f.filename=i.filename and z.imagename=i.filename and i.expnum=e.expnum and e.expnum=s.expnum and i.dec_cent between :decmin and :decmax and i.ra_cent between :ramin and :ramax and i.band=:band and z.version=:version and e.mjd_obs<56400"
-            self.cur.execute(get_list,decmin=decmin,decmax=decmax,ramin=ramin,ramax=ramax,band=band,version="v2.0")
-            info_list += self.cur.fetchall()
+            queries += [(get_list,dict(decmin=decmin,decmax=decmax,ramin=ramin,ramax=ramax,band=band,version=SV_VERSION))]
         else: # Should start with "SN-*"
             # get Y1-Y6 images
             get_list = "select f.filename, f.path, f.compression, s.psf_fwhm, i.skysigma, e.mjd_obs from y6a1_file_archive_info f, y6a1_image i, y6a1_exposure e, y6a1_qa_summary s, y6a1_zeropoint z where i.filetype='red_immask' and f.filename=i.filename and z.imagename=i.filename and i.expnum=e.expnum and e.expnum=s.expnum and e.field=:field and e.program='supernova' and i.band=:band and z.version=:version and e.mjd_obs>56400"
-            self.cur.execute(get_list,field=field,band=band,version="y6a1_v2.1")
-            info_list = self.cur.fetchall()
+            queries = [(get_list,dict(field=field,band=band,version=Y6_VERSION))]
             # get SV images
             get_list = "select f.filename, f.path, f.compression, s.psf_fwhm, i.skysigma, e.mjd_obs from y4a1_file_archive_info f, y4a1_image i, y4a1_exposure e, y4a1_qa_summary s, y4a1_zeropoint z where i.filetype='red_immask' and f.filename=i.filename and z.imagename=i.filename and i.expnum=e.expnum and e.expnum=s.expnum and e.field=:field and e.program='supernova' and i.band=:band and z.version=:version and e.mjd_obs<56400"
-            self.cur.execute(get_list,field=field,band=band,version="v2.0")
-            info_list += self.cur.fetchall()
+            queries += [(get_list,dict(field=field,band=band,version=SV_VERSION))]
         # TODO: Search misc fields
+        return queries
+
+
+    def _get_image_info_field(self,field,band='g'):
+        # get image archive info (URL) from SN-field name or COSMOS
+        info_list = []
+        for get_list, pars in self.field_queries(field,band):
+            self.cur.execute(get_list,**pars)
+            info_list += self.cur.fetchall()
         if len(info_list) > 0:
-            dtype = [("filename","|S41"),("path","|S200"),("compression","|S4"),("psf_fwhm",float),("skysigma",float),("mjd_obs",float)]
-            info_list = np.array(info_list,dtype=dtype)
-            # Form URL and data type
-            ccd_list = [f["filename"].split('_c')[1][:2] for f in info_list]
-            url_list = [base_url+f["path"]+"/"+f["filename"]+f["compression"] for f in info_list]
-            dtype = [("path","|S300"),("psf_fwhm",float),("skysigma",float),("mjd_obs",float),("ccd",int)]
-            info_list = list(zip(url_list,info_list["psf_fwhm"],info_list["skysigma"],info_list["mjd_obs"],ccd_list))
-            info_list = np.array(info_list,dtype=dtype)
-            return info_list
+            return format_image_info(info_list)
         else:
             return None
+
+
+    def iter_image_info_field(self,field,band='g',batch_size=500):
+        # Generator version of get_image_info_field, yields structured arrays as the cursor produces them
+        if self.cache is not None:
+            key = self.cache.make_key((field,))
+            hit, info_list = self.cache.get('field',band,key,Y6_VERSION)
+            if hit:
+                if info_list is not None: yield info_list
+                return
+        cur = self.connect()
+        info_list_all = []
+        for get_list, pars in self.field_queries(field,band):
+            cur.execute(get_list,**pars)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if len(rows) == 0: break
+                info_list = format_image_info(rows)
+                info_list_all.append(info_list)
+                yield info_list
+        # only store complete results
+        if self.cache is not None:
+            info_list = np.concatenate(info_list_all) if len(info_list_all) > 0 else None
+            self.cache.put('field',band,key,Y6_VERSION,info_list)
+
+
+def image_urls(info_list):
+    # archive URL and CCD number from filename, path and compression fields
+    url_list = [BASE_URL+f["path"].decode()+"/"+f["filename"].decode()+f["compression"].decode() for f in info_list]
+    ccd_list = [f["filename"].decode().split('_c')[1][:2] for f in info_list]
+    return url_list, ccd_list
+
+
+def format_image_info(info_list):
+    # Form URL and data type from (filename, path, compression, psf_fwhm, skysigma, mjd_obs) rows
+    dtype = [("filename","|S41"),("path","|S200"),("compression","|S4"),("psf_fwhm",float),("skysigma",float),("mjd_obs",float)]
+    info_list = np.array(list(info_list),dtype=dtype)
+    url_list, ccd_list = image_urls(info_list)
+    dtype = [("path","|S300"),("psf_fwhm",float),("skysigma",float),("mjd_obs",float),("ccd",int)]
+    info_list = list(zip(url_list,info_list["psf_fwhm"],info_list["skysigma"],info_list["mjd_obs"],ccd_list))
+    info_list = np.array(info_list,dtype=dtype)
+    return info_list
+
+
+def select_overlap(image_list,ramin,ramax,decmin,decmax):
+    # In-memory version of the overlap condition in get_image_info_overlap
+    # (image_list from get_image_info_overlap_bulk), returns the same fields
+    if image_list is None: return None
+    # CCDs crossing RA=0 (template or image) are compared as [racmax-360, racmin], and against copies shifted by one turn
+    ramin, ramax = wrap_interval([ramin],[ramax])
+    img_ramin, img_ramax = wrap_interval(image_list['ramin'],image_list['ramax'])
+    mask_ra = np.zeros(len(image_list),dtype=bool)
+    for shift in [-360.,0.,360.]:
+        lo, hi = img_ramin+shift, img_ramax+shift
+        mask_ra |= ((ramin <= lo) & (lo <= ramax)) | ((ramin <= hi) & (hi <= ramax))
+    mask_dec = ((decmin <= image_list['decmin']) & (image_list['decmin'] <= decmax)) | ((decmin <= image_list['decmax']) & (image_list['decmax'] <= decmax))
+    image_list = image_list[mask_ra & mask_dec]
+    if len(image_list) == 0: return None
+    dtype = [("path","|S300"),("psf_fwhm",float),("skysigma",float),("mjd_obs",float),("ccd",int)]
+    info_list = np.zeros(len(image_list),dtype=dtype)
+    for name in info_list.dtype.names:
+        info_list[name] = image_list[name]
+    return info_list
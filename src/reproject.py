@@ -0,0 +1,243 @@
+import os, time, threading
+import numpy as np
+import argparse
+from astropy.io import fits
+from astropy.wcs import WCS
+from scipy import ndimage
+from scipy.interpolate import RectBivariateSpline
+
+# in-process replacement for the single-image swarp alignment (etc/SN_distemp.swarp):
+# background subtraction (BACK_SIZE 128, BACK_FILTERSIZE 3), LANCZOS3 resampling onto the template grid,
+# no flux scaling (FSCALASTRO_TYPE NONE) and COPY_KEYWORDS from the input header
+BACK_SIZE = 128
+BACK_FILTERSIZE = 3
+COPY_KEYWORDS = ['OBJECT','CCDNUM','FILTER','TELRA','TELDEC','FWHM','ELLIPTIC']
+# template pixels per node of the coarse mapping grid
+MAP_STEP = 32
+# probe grid used to compare exposure WCS solutions
+NUM_PROBE = 8
+
+
+def lanczos3(x):
+    x = np.abs(x)
+    out = np.sinc(x)*np.sinc(x/3.)
+    out[x >= 3.] = 0.
+    return out
+
+
+def background(sci,weight,back_size=BACK_SIZE,filter_size=BACK_FILTERSIZE,nsigma=3.,iterations=3):
+    # SExtractor-like background map: clipped mode estimate per mesh, median filtered, spline interpolated
+    ny, nx = sci.shape
+    my, mx = int(np.ceil(ny/float(back_size))), int(np.ceil(nx/float(back_size)))
+    data = np.full((my*back_size,mx*back_size),np.nan,dtype=np.float32)
+    data[:ny,:nx] = np.where(weight > 0,sci,np.nan)
+    data = data.reshape(my,back_size,mx,back_size).transpose(0,2,1,3).reshape(my,mx,-1)
+    for i in range(iterations):
+        med = np.nanmedian(data,axis=2)
+        std = np.nanstd(data,axis=2)
+        data = np.where(np.abs(data-med[:,:,None]) > nsigma*std[:,:,None],np.nan,data)
+    med = np.nanmedian(data,axis=2)
+    mean = np.nanmean(data,axis=2)
+    std = np.nanstd(data,axis=2)
+    # mode estimate unless the distribution is too skewed
+    back = np.where(np.abs(mean-med)/np.maximum(std,1e-30) < 0.3,2.5*med-1.5*mean,med)
+    # empty meshes get the median of the others
+    bad = ~np.isfinite(back)
+    if np.all(bad):
+        return np.zeros(sci.shape,dtype=np.float32)
+    back[bad] = np.median(back[~bad])
+    if filter_size > 1:
+        back = ndimage.median_filter(back,size=filter_size,mode='nearest')
+    # mesh centers -> pixels
+    y = (np.arange(ny)+0.5)/back_size-0.5
+    x = (np.arange(nx)+0.5)/back_size-0.5
+    order = 3 if min(my,mx) > 3 else 1
+    return ndimage.map_coordinates(back,np.meshgrid(y,x,indexing='ij'),order=order,mode='nearest').astype(np.float32)
+
+
+def resample(image,x,y,chunk=1<<18):
+    # LANCZOS3 interpolation of image at (x,y) (0-based pixels), 0 outside the image
+    ny, nx = image.shape
+    out = np.zeros(x.shape,dtype=np.float32)
+    padded = np.pad(image.astype(np.float32),3,mode='constant')
+    for i in range(0,x.shape[0],chunk):
+        xc, yc = x[i:i+chunk], y[i:i+chunk]
+        ix, iy = np.floor(xc).astype(np.int64), np.floor(yc).astype(np.int64)
+        inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        ix, iy = np.clip(ix,-1,nx-1)+3, np.clip(iy,-1,ny-1)+3
+        dx, dy = xc - np.floor(xc), yc - np.floor(yc)
+        acc = np.zeros(xc.shape,dtype=np.float64)
+        norm = np.zeros(xc.shape,dtype=np.float64)
+        for ky in range(-2,4):
+            wy = lanczos3(dy-ky)
+            for kx in range(-2,4):
+                w = wy*lanczos3(dx-kx)
+                acc += w*padded[iy+ky,ix+kx]
+                norm += w
+        out[i:i+chunk] = np.where(inside,acc/norm,0.)
+    return out
+
+
+def resample_weight(weight,x,y,chunk=1<<18):
+    # variance is resampled like the image, any bad pixel among the 4 nearest neighbours masks the output
+    var = np.where(weight > 0,1./np.where(weight > 0,weight,1.),0.).astype(np.float32)
+    out_var = resample(var,x,y,chunk)
+    ny, nx = weight.shape
+    bad = np.pad(weight <= 0,1,mode='constant',constant_values=True)
+    out_bad = np.zeros(x.shape,dtype=bool)
+    for i in range(0,x.shape[0],chunk):
+        ix = np.clip(np.floor(x[i:i+chunk]).astype(np.int64),-1,nx-1)+1
+        iy = np.clip(np.floor(y[i:i+chunk]).astype(np.int64),-1,ny-1)+1
+        out_bad[i:i+chunk] = bad[iy,ix] | bad[iy,ix+1] | bad[iy+1,ix] | bad[iy+1,ix+1]
+    return np.where(out_bad | (out_var <= 0),0.,1./np.where(out_var > 0,out_var,1.)).astype(np.float32)
+
+
+class PixelMapCache:
+
+    def __init__(self,tolerance=0.01,max_maps=8):
+        # template pixel -> exposure pixel maps per template CCD
+        # a map is reused for another exposure WCS if the two solutions differ by a constant
+        # shift plus at most tolerance pixels on the probe grid
+        # at most max_maps maps are kept over all templates (least recently used are dropped)
+        self.tolerance = tolerance
+        self.max_maps = max_maps
+        self.lock = threading.Lock()
+        self.maps = {} # template filename -> [[probe x, probe y, map x, map y, last use]]
+        self.num_uses = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def probe(self,template_wcs,shape):
+        ny, nx = shape
+        x, y = np.meshgrid(np.linspace(0,nx-1,NUM_PROBE),np.linspace(0,ny-1,NUM_PROBE))
+        return template_wcs.all_pix2world(x.ravel(),y.ravel(),0)
+
+
+    def compute(self,template_wcs,exposure_wcs,shape,step=MAP_STEP):
+        # exact mapping on a coarse grid, spline interpolated to every template pixel
+        ny, nx = shape
+        xs = np.append(np.arange(0,nx-1,step),nx-1).astype(float)
+        ys = np.append(np.arange(0,ny-1,step),ny-1).astype(float)
+        gx, gy = np.meshgrid(xs,ys)
+        ra, dec = template_wcs.all_pix2world(gx.ravel(),gy.ravel(),0)
+        ex, ey = exposure_wcs.all_world2pix(ra,dec,0)
+        k = min(3,len(xs)-1,len(ys)-1)
+        map_x = RectBivariateSpline(ys,xs,ex.reshape(gx.shape),kx=k,ky=k)(np.arange(ny),np.arange(nx)).astype(np.float32)
+        map_y = RectBivariateSpline(ys,xs,ey.reshape(gx.shape),kx=k,ky=k)(np.arange(ny),np.arange(nx)).astype(np.float32)
+        return map_x, map_y
+
+
+    def get(self,template_file,template_wcs,exposure_wcs,shape):
+        # returns (map x, map y, shift x, shift y)
+        ra, dec = self.probe(template_wcs,shape)
+        px, py = exposure_wcs.all_world2pix(ra,dec,0)
+        # maps are computed under the lock, so concurrent epochs of a CCD wait and reuse them
+        with self.lock:
+            self.num_uses += 1
+            for entry in self.maps.get(template_file,[]):
+                probe_x, probe_y, map_x, map_y = entry[0:4]
+                dx, dy = px-probe_x, py-probe_y
+                if np.max(np.abs(dx-np.mean(dx))) < self.tolerance and np.max(np.abs(dy-np.mean(dy))) < self.tolerance:
+                    self.hits += 1
+                    entry[4] = self.num_uses
+                    return map_x, map_y, np.mean(dx), np.mean(dy)
+            self.misses += 1
+            map_x, map_y = self.compute(template_wcs,exposure_wcs,shape)
+            self.maps.setdefault(template_file,[]).append([px,py,map_x,map_y,self.num_uses])
+            while sum([len(m) for m in self.maps.values()]) > self.max_maps:
+                # least recently used map of any template
+                oldest = min(self.maps,key=lambda t: min([e[4] for e in self.maps[t]]))
+                entries = self.maps[oldest]
+                entries.remove(min(entries,key=lambda e: e[4]))
+                if len(entries) == 0:
+                    del self.maps[oldest]
+        return map_x, map_y, 0., 0.
+
+
+    def clear(self,template_file=None):
+        # drop the maps of a template (all maps if None), e.g. once its CCD is done
+        with self.lock:
+            if template_file is None:
+                self.maps = {}
+            else:
+                self.maps.pop(template_file,None)
+
+
+    def summary(self):
+        return "%d pixel maps computed, %d reused" % (self.misses,self.hits)
+
+
+def reproject(filename_in,template_sci,filename_out,pixel_maps=None,subtract_back=True):
+    # resample filename_in (and its .weight.fits) onto the template grid
+    if pixel_maps is None:
+        pixel_maps = PixelMapCache()
+    template_header = fits.getheader(template_sci)
+    shape = (template_header['NAXIS2'],template_header['NAXIS1'])
+    header = fits.getheader(filename_in)
+    sci = fits.getdata(filename_in).astype(np.float32)
+    weight = fits.getdata(filename_in[0:-5]+'.weight.fits').astype(np.float32)
+    map_x, map_y, shift_x, shift_y = pixel_maps.get(template_sci,WCS(template_header),WCS(header),shape)
+    if subtract_back:
+        sci = sci - background(sci,weight)
+    x, y = (map_x+shift_x).ravel(), (map_y+shift_y).ravel()
+    out_sci = resample(sci,x,y).reshape(shape)
+    out_wgt = resample_weight(weight,x,y).reshape(shape)
+    out_header = WCS(template_header).to_header(relax=True)
+    for key in COPY_KEYWORDS:
+        if key in header:
+            out_header[key] = header[key]
+    fits.PrimaryHDU(data=out_sci,header=out_header).writeto(filename_out,overwrite=True,output_verify='ignore')
+    fits.PrimaryHDU(data=out_wgt,header=out_header).writeto(filename_out[0:-5]+'.weight.fits',overwrite=True,output_verify='ignore')
+    return filename_out
+
+
+def paste_on_grid(filename,template_sci):
+    # swarp -COMBINE N writes every resampled frame (and .weight.fits) cropped to its footprint on the
+    # output grid; paste it back into a template-sized frame (0 outside, like single-image swarp)
+    template_header = fits.getheader(template_sci)
+    shape = (template_header['NAXIS2'],template_header['NAXIS1'])
+    for f in [filename,filename[0:-5]+'.weight.fits']:
+        with fits.open(f) as hdul:
+            data, header = hdul[0].data, hdul[0].header.copy()
+        if data.shape == shape and header['CRPIX1'] == template_header['CRPIX1'] and header['CRPIX2'] == template_header['CRPIX2']:
+            continue
+        # same projection, only the reference pixel moves with the crop
+        for key in ['CTYPE1','CTYPE2','CRVAL1','CRVAL2']:
+            if header.get(key) != template_header.get(key):
+                print('***%s is not on the template grid (%s)***' % (os.path.basename(f),key))
+                return False
+        x0 = template_header['CRPIX1'] - header['CRPIX1']
+        y0 = template_header['CRPIX2'] - header['CRPIX2']
+        if abs(x0-round(x0)) > 1e-6 or abs(y0-round(y0)) > 1e-6:
+            print('***%s is not on the template pixel grid***' % os.path.basename(f))
+            return False
+        x0, y0 = int(round(x0)), int(round(y0))
+        out = np.zeros(shape,dtype=data.dtype)
+        # overlap of the frame with the template grid
+        ys, xs = max(0,-y0), max(0,-x0)
+        ye, xe = min(data.shape[0],shape[0]-y0), min(data.shape[1],shape[1]-x0)
+        if ye > ys and xe > xs:
+            out[y0+ys:y0+ye,x0+xs:x0+xe] = data[ys:ye,xs:xe]
+        header['CRPIX1'], header['CRPIX2'] = template_header['CRPIX1'], template_header['CRPIX2']
+        fits.PrimaryHDU(data=out,header=header).writeto(f,overwrite=True,output_verify='ignore')
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resample images onto a template grid (in-process swarp alignment).')
+    parser.add_argument('template',type=str,help='Template image')
+    parser.add_argument('images',nargs='+',type=str,help='Images (with .weight.fits next to them)')
+    parser.add_argument('--suffix',type=str,default='_proj.fits',help='Output suffix')
+    parser.add_argument('--tolerance',type=float,default=0.01,help='Pixel map reuse tolerance [pixels]')
+    args = parser.parse_args()
+    pixel_maps = PixelMapCache(args.tolerance)
+    for filename in args.images:
+        start_time = time.time()
+        reproject(filename,args.template,filename[0:-5]+args.suffix,pixel_maps)
+        print('%s %.2f s' % (os.path.basename(filename),time.time()-start_time))
+    print(pixel_maps.summary())
+    return
+
+if __name__ == "__main__":
+    main()
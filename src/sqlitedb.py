@@ -0,0 +1,189 @@
+import os, sqlite3
+import numpy as np
+import argparse
+
+# SQLite stand-in for the parts of the DESDM schema used by query.Query
+SCHEMA = {
+    "image": "create table if not exists %s_image (filename text, filetype text, expnum integer, ccdnum integer, band text, racmin real, racmax real, deccmin real, deccmax real, ra_cent real, dec_cent real, skysigma real)",
+    "exposure": "create table if not exists %s_exposure (expnum integer, tradeg real, tdecdeg real, mjd_obs real, program text, field text, band text)",
+    "file_archive_info": "create table if not exists %s_file_archive_info (filename text, path text, compression text)",
+    "qa_summary": "create table if not exists %s_qa_summary (expnum integer, psf_fwhm real)",
+    "zeropoint": "create table if not exists %s_zeropoint (imagename text, version text)",
+    "finalcut_object": "create table if not exists %s_finalcut_object (filename text, ra real, dec real, band text, flags integer)",
+}
+INDICES = [
+    "create index if not exists %s_image_filename on %s_image (filename)",
+    "create index if not exists %s_image_expnum on %s_image (expnum)",
+    "create index if not exists %s_image_band on %s_image (band, racmin, deccmin)",
+    "create index if not exists %s_exposure_expnum on %s_exposure (expnum)",
+    "create index if not exists %s_file_archive_info_filename on %s_file_archive_info (filename)",
+    "create index if not exists %s_qa_summary_expnum on %s_qa_summary (expnum)",
+    "create index if not exists %s_zeropoint_imagename on %s_zeropoint (imagename)",
+    "create index if not exists %s_finalcut_object_radec on %s_finalcut_object (ra, dec)",
+]
+RELEASES = ["y6a1","y4a1"]
+
+# SN field centers [deg.]
+SN_FIELDS = {"SN-C1": (54.2743,-27.1116), "SN-C2": (54.2743,-29.0884), "SN-C3": (52.6484,-28.1000),
+             "SN-E1": (7.8744,-43.0096), "SN-E2": (9.5000,-43.9980), "SN-S1": (42.8200,0.0000),
+             "SN-S2": (41.1944,-0.9884), "SN-X1": (34.4757,-4.9295), "SN-X2": (35.6645,-6.4121),
+             "SN-X3": (36.4500,-4.6000)}
+# number of DECam CCDs in each focal plane row
+CCD_ROWS = [3,4,5,6,6,7,7,6,6,5,4,3]
+
+
+class SqliteCursor:
+
+    def __init__(self,con):
+        self.cur = con.cursor()
+
+
+    def execute(self,command,*args,**kwargs):
+        # Oracle-style named parameters (cur.execute(sql,ra=ra)) and 'select unique'
+        command = command.replace("select unique","select distinct")
+        if len(args) > 0:
+            return self.cur.execute(command,args[0])
+        return self.cur.execute(command,kwargs)
+
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+
+    def fetchmany(self,size):
+        return self.cur.fetchmany(size)
+
+
+class SqliteConnection:
+
+    def __init__(self,db_path):
+        # same interface as desdbi.DesDbi as far as query.Query is concerned
+        self.db_path = db_path
+        self.con = sqlite3.connect(db_path,check_same_thread=False)
+
+
+    def cursor(self):
+        return SqliteCursor(self.con)
+
+
+    def create_schema(self):
+        for release in RELEASES:
+            for table in SCHEMA.values():
+                self.con.execute(table % release)
+            for index in INDICES:
+                self.con.execute(index % (release,release))
+        self.con.commit()
+
+
+    def insert(self,table,rows):
+        if len(rows) == 0: return
+        command = "insert into %s values (%s)" % (table,",".join(["?"]*len(rows[0])))
+        self.con.executemany(command,rows)
+
+
+    def commit(self):
+        self.con.commit()
+
+
+    def close(self):
+        self.con.close()
+
+
+def ccd_layout():
+    # approximate DECam focal plane: CCD centers [deg.] relative to the boresight (2k x 4k CCDs, long axis along RA)
+    layout = []
+    ccd = 1
+    for i, num in enumerate(CCD_ROWS):
+        ddec = (i - (len(CCD_ROWS)-1)/2.) * 0.16
+        for j in range(num):
+            dra = (j - (num-1)/2.) * 0.31
+            layout.append((ccd,dra,ddec))
+            ccd += 1
+    return layout
+
+
+def make_synthetic_db(db_path,num_pointings=200,num_sn_epochs=100,bands="griz",objects_per_ccd=5,seed=1):
+    # fill a SQLite database with DESDM-like rows
+    # survey pointings come from etc/y6point.csv, SN fields are revisited num_sn_epochs times per band
+    rng = np.random.RandomState(seed)
+    top_dir = '/'.join(os.path.dirname(os.path.abspath(__file__)).split('/')[0:-1])
+    dtype = [('tra',float),('tdec',float),('mjd_obs',float)]
+    pointings = np.genfromtxt(os.path.join(top_dir,'etc/y6point.csv'),delimiter=',',skip_header=1,dtype=dtype)
+    pointings = pointings[:num_pointings]
+    con = SqliteConnection(db_path)
+    con.create_schema()
+    layout = ccd_layout()
+    # (tradeg, tdecdeg, mjd_obs, program, field)
+    exposures = []
+    # sky sources around each pointing/field (objects_per_ccd per CCD area), detected again by every visit
+    sky = []
+    def sky_sources(ra,dec):
+        num = objects_per_ccd*len(layout)
+        ddec = rng.uniform(-1.,1.,num)
+        return (np.mod(ra+rng.uniform(-1.1,1.1,num)/np.cos(np.radians(dec+ddec)),360.),dec+ddec)
+    for p in pointings:
+        # template season exposure (as in etc/y?point.csv) plus dithered visits in other seasons
+        sources = sky_sources(np.mod(p['tra'],360.),p['tdec'])
+        exposures.append((np.mod(p['tra'],360.),p['tdec'],p['mjd_obs'],'survey',''))
+        for mjd in rng.uniform(56400,58615,5):
+            exposures.append((np.mod(p['tra']+rng.normal(0,0.3),360.),p['tdec']+rng.normal(0,0.3),mjd,'survey',''))
+        sky += [sources]*6
+    for field, (ra, dec) in SN_FIELDS.items():
+        sources = sky_sources(ra,dec)
+        for mjd in rng.uniform(56200,58615,num_sn_epochs):
+            exposures.append((ra+rng.normal(0,0.01),dec+rng.normal(0,0.01),mjd,'supernova',field))
+            sky.append(sources)
+    expnum = 200000
+    for band in bands:
+        for (tra, tdec, mjd, program, field), (src_ra, src_dec) in zip(exposures,sky):
+            expnum += 1
+            # SV data is in the y4a1 tables
+            release = "y4a1" if mjd < 56400 else "y6a1"
+            version = "v2.0" if release == "y4a1" else "y6a1_v2.1"
+            con.insert("%s_exposure" % release,[(expnum,tra,tdec,mjd,program,field,band)])
+            con.insert("%s_qa_summary" % release,[(expnum,rng.uniform(0.8,1.6))])
+            image_rows = []; archive_rows = []; zp_rows = []; object_rows = []
+            for ccd, dra, ddec in layout:
+                dec_cent = tdec + ddec
+                ra_cent = np.mod(tra + dra/np.cos(np.radians(dec_cent)),360.)
+                ra_size = 0.15/np.cos(np.radians(dec_cent))
+                racmin = np.mod(ra_cent - ra_size,360.)
+                racmax = np.mod(ra_cent + ra_size,360.)
+                if racmin > racmax: # crosses RA=0
+                    racmin, racmax = racmax, racmin
+                filename = "D%08d_%s_c%02d_r4000p01_immasked.fits" % (expnum,band,ccd)
+                path = "OPS/finalcut/Y6A1/r4000/%d/D%08d/p01/red/immask" % (int(mjd),expnum)
+                image_rows.append((filename,'red_immask',expnum,ccd,band,racmin,racmax,dec_cent-0.075,dec_cent+0.075,ra_cent,dec_cent,rng.uniform(3,10)))
+                archive_rows.append((filename,path,'.fz'))
+                zp_rows.append((filename,version))
+                # sky sources on the CCD, with 0.1" position scatter
+                on_ccd = (np.abs(np.mod(src_ra-ra_cent+180.,360.)-180.) < ra_size) & (np.abs(src_dec-dec_cent) < 0.075)
+                for r, d in zip(src_ra[on_ccd],src_dec[on_ccd]):
+                    object_rows.append((filename,np.mod(r+rng.normal(0,0.1/3600.),360.),d+rng.normal(0,0.1/3600.),band,0))
+            con.insert("%s_image" % release,image_rows)
+            con.insert("%s_file_archive_info" % release,archive_rows)
+            con.insert("%s_zeropoint" % release,zp_rows)
+            con.insert("%s_finalcut_object" % release,object_rows)
+    con.commit()
+    return con
+
+
+def object_positions(con,filename,release="y6a1"):
+    # (ra, dec) of the generated finalcut objects of an image, to seed object queries
+    cur = con.cursor()
+    cur.execute("select ra, dec from %s_finalcut_object where filename=:filename" % release,filename=filename)
+    return cur.fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create a synthetic SQLite stand-in for the DESDM database.')
+    parser.add_argument('db_path',type=str,help='SQLite database file')
+    parser.add_argument('--pointings',type=int,default=200,help='Number of survey pointings')
+    parser.add_argument('--epochs',type=int,default=100,help='Number of epochs per SN field and band')
+    parser.add_argument('--bands',type=str,default='griz',help='Bands')
+    args = parser.parse_args()
+    make_synthetic_db(args.db_path,args.pointings,args.epochs,args.bands).close()
+    return
+
+if __name__ == "__main__":
+    main()
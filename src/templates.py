@@ -0,0 +1,76 @@
+import os, time, json, shutil, hashlib, socket, threading
+import argparse
+
+class TemplateStore:
+
+    def __init__(self,store_dir):
+        # persistent templates shared between work directories and grid jobs
+        # layout: store_dir/<pointing>/<band>/Y<season>/c<ccd>/<input hash>/
+        # a store without write permission (e.g. shipped to grid jobs) is used read-only
+        self.store_dir = store_dir
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+        self.read_only = not os.access(store_dir,os.W_OK)
+
+
+    def input_hash(self,filenames,config_files):
+        # hash of the selected input exposures (in order, the first one sets the geometry)
+        # and of the swarp/sextractor configuration
+        h = hashlib.sha1()
+        for f in filenames:
+            h.update(os.path.basename(f).encode())
+        for f in config_files:
+            with open(f,'rb') as cfg:
+                h.update(cfg.read())
+        return h.hexdigest()[:16]
+
+
+    def entry_dir(self,pointing,ccd,band,season,input_hash):
+        return os.path.join(self.store_dir,str(pointing),band,'Y%d' % season,'c%d' % ccd,input_hash)
+
+
+    def link(self,entry_dir,files):
+        # link template, weight and catalog of an entry to files, returns False on a miss
+        if not os.path.exists(os.path.join(entry_dir,'provenance.json')):
+            return False
+        for f in files:
+            if os.path.lexists(f):
+                os.remove(f)
+            os.symlink(os.path.join(entry_dir,os.path.basename(f)),f)
+        return True
+
+
+    def put(self,entry_dir,files,provenance):
+        # move files into the store and replace them by links
+        if self.read_only or os.path.exists(entry_dir):
+            return False
+        tmp_dir = "%s.tmp%d_%d" % (entry_dir,os.getpid(),threading.current_thread().ident)
+        os.makedirs(tmp_dir)
+        for f in files:
+            shutil.copy(f,os.path.join(tmp_dir,os.path.basename(f)))
+        provenance = dict(provenance)
+        provenance.update({'files': [os.path.basename(f) for f in files], 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': socket.gethostname()})
+        with open(os.path.join(tmp_dir,'provenance.json'),'w') as f:
+            json.dump(provenance,f,indent=1)
+        try:
+            os.rename(tmp_dir,entry_dir)
+        except OSError:
+            # stored by another job in the meantime
+            shutil.rmtree(tmp_dir)
+            return False
+        return self.link(entry_dir,files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List templates in a template store.')
+    parser.add_argument('store_dir',type=str,help='Template store directory')
+    args = parser.parse_args()
+    for root, dirs, files in os.walk(args.store_dir):
+        if 'provenance.json' in files:
+            with open(os.path.join(root,'provenance.json')) as f:
+                p = json.load(f)
+            print('%s  %d inputs  %s' % (os.path.relpath(root,args.store_dir),len(p['inputs']),p['created']))
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import os, time
+import numpy as np
+import argparse
+from multiprocessing import Pool
+from scipy.stats import chi2 as chi2_dist
+from lcstore import LightCurveStore, DTYPE
+from varstats import myvarlc_batch
+
+# per-source variability statistics of light curve stores (or old cat_c?.dat text outputs),
+# one CCD per worker process, written to one summary table sorted by significance of the extra variance:
+#   nobs              measurements with finite flux and positive error (4" aperture)
+#   mean, chi2, prob  weighted mean, reduced chi^2 against it and its probability
+#   nxs, nxs_err      normalized excess variance and its error (Vaughan et al. 2003)
+#   avg, rms, sigavg, sigrms, snr   myvarlc mean, extra rms, their errors and rms/sigrms
+#   ap_corr           correlation of the 3" and 5" aperture fluxes (1 for a varying point source)
+summary_dtype = [('store',np.int32),('ccd',np.int32),('num',np.int64),('ra',np.float64),('dec',np.float64),('nobs',np.int64),
+                 ('mean',np.float64),('chi2',np.float64),('prob',np.float64),('nxs',np.float64),('nxs_err',np.float64),
+                 ('avg',np.float64),('rms',np.float64),('sigavg',np.float64),('sigrms',np.float64),('snr',np.float64),('ap_corr',np.float64)]
+CHUNK = 2000 # sources per myvarlc_batch call
+
+
+def read_text(filename):
+    # old cat_c?.dat outputs (num mjd_obs ra dec flux3 flux4 flux5 fluxerr3 fluxerr4 fluxerr5)
+    dat = np.loadtxt(filename,ndmin=2)
+    data = np.zeros(len(dat),dtype=DTYPE)
+    for i, (name, dtype) in enumerate(DTYPE):
+        data[name] = dat[:,i]
+    return data[np.lexsort((data['mjd_obs'],data['num']))]
+
+
+def padded(column,start,count):
+    # [sources, max epochs] copy of a column sorted by source, NaN padded
+    out = np.full((len(start),np.max(count) if len(count) > 0 else 0),np.nan)
+    row = np.repeat(np.arange(len(start)),count)
+    col = np.arange(np.sum(count)) - np.repeat(np.cumsum(count)-count,count)
+    out[row,col] = column[np.repeat(start,count)+col]
+    return out
+
+
+def source_stats(f3,f4,f5,e4):
+    # statistics of padded light curves (NaN where there is no measurement)
+    out = np.zeros(len(f4),dtype=summary_dtype)
+    mask = np.isfinite(f4) & np.isfinite(e4) & (e4 > 0)
+    n = np.sum(mask,axis=1)
+    out['nobs'] = n
+    with np.errstate(divide='ignore',invalid='ignore'):
+        w = np.where(mask,1./np.where(mask,e4,1.)**2,0.)
+        f = np.where(mask,f4,0.)
+        mean = np.sum(w*f,axis=1)/np.sum(w,axis=1)
+        out['mean'] = mean
+        chi2 = np.sum(w*(f-mean[:,None])**2,axis=1)
+        out['chi2'] = chi2/(n-1)
+        out['prob'] = chi2_dist.sf(chi2,n-1)
+        # normalized excess variance
+        m = np.sum(f,axis=1)/n
+        s2 = np.sum(np.where(mask,(f-m[:,None])**2,0.),axis=1)/(n-1)
+        e2 = np.sum(np.where(mask,e4,0.)**2,axis=1)/n
+        out['nxs'] = (s2-e2)/m**2
+        out['nxs_err'] = np.sqrt(2./n)*e2/m**2
+        # aperture consistency
+        both = mask & np.isfinite(f3) & np.isfinite(f5)
+        nb = np.sum(both,axis=1)
+        d3 = np.where(both,f3-np.sum(np.where(both,f3,0.),axis=1)[:,None]/nb[:,None],0.)
+        d5 = np.where(both,f5-np.sum(np.where(both,f5,0.),axis=1)[:,None]/nb[:,None],0.)
+        out['ap_corr'] = np.sum(d3*d5,axis=1)/np.sqrt(np.sum(d3*d3,axis=1)*np.sum(d5*d5,axis=1))
+    for i in range(0,len(f4),CHUNK):
+        good, avg, rms, sigavg, sigrms = myvarlc_batch(f4[i:i+CHUNK],e4[i:i+CHUNK],mask[i:i+CHUNK])
+        out['avg'][i:i+CHUNK], out['rms'][i:i+CHUNK] = avg, rms
+        out['sigavg'][i:i+CHUNK], out['sigrms'][i:i+CHUNK] = sigavg, sigrms
+        with np.errstate(divide='ignore',invalid='ignore'):
+            out['snr'][i:i+CHUNK] = np.where(good == 1,rms/sigrms,np.nan)
+    return out
+
+
+def ccd_stats(job):
+    # statistics of all sources of one CCD (memory mapped store columns or a text catalog)
+    store, source, ccd = job
+    if os.path.isdir(source):
+        lcstore = LightCurveStore(source)
+        index = lcstore.index(ccd)
+        cols = lcstore.columns(ccd)
+        num, start, count = index['num'], index['start'], index['count']
+    else:
+        cols = read_text(source)
+        num, start, count = np.unique(cols['num'],return_index=True,return_counts=True)
+    out = source_stats(*[padded(cols[name],start,count) for name in ['flux3','flux4','flux5','fluxerr4']])
+    out['store'], out['ccd'], out['num'] = store, ccd, num
+    out['ra'], out['dec'] = cols['ra'][start], cols['dec'][start]
+    return out
+
+
+def variability(sources,out_file,num_threads=1):
+    # sources: light curve stores and/or cat_c?.dat files; returns the summary table
+    start_time = time.time()
+    jobs = []
+    for i, source in enumerate(sources):
+        if os.path.isdir(source):
+            jobs += [(i,source,ccd) for ccd in LightCurveStore(source).ccds()]
+        else:
+            ccd = os.path.basename(source).split('.')[0].split('_c')[-1]
+            jobs.append((i,source,int(ccd) if ccd.isdigit() else 0))
+    if len(jobs) == 0:
+        print('***No light curves found***')
+        return None
+    pool = Pool(num_threads) if num_threads > 1 else None
+    imap = pool.imap_unordered if pool is not None else map
+    summary = []
+    for out in imap(ccd_stats,jobs):
+        summary.append(out)
+    if pool is not None:
+        pool.close()
+    summary = np.concatenate(summary)
+    summary = summary[np.argsort(-np.where(np.isfinite(summary['snr']),summary['snr'],-np.inf),kind='mergesort')]
+    if out_file.endswith('.npy'):
+        np.save(out_file,summary)
+    else:
+        np.savetxt(out_file,summary,fmt=['%d','%d','%d','%.7f','%+.7f','%d']+['%.6g']*11,header=' '.join([name for name, dtype in summary_dtype]))
+    print('Variability statistics of %d sources in %d CCDs saved as %s (%.2f s).' % (len(summary),len(jobs),out_file,time.time()-start_time))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Variability statistics of light curves.')
+    parser.add_argument('sources',nargs='+',type=str,help='Light curve stores (<tile_dir>/lightcurves) and/or cat_c?.dat files')
+    parser.add_argument('-o','--out',type=str,default='variability.npy',help='Summary table (.npy, or text for any other extension)')
+    parser.add_argument('-n','--threads',type=int,default=1,help='Number of processes')
+    parser.add_argument('--top',type=int,default=10,help='Print the most significant sources')
+    args = parser.parse_args()
+    summary = variability(args.sources,args.out,args.threads)
+    if summary is not None:
+        print('%6s %4s %8s %12s %12s %6s %10s %8s %8s' % ('store','ccd','num','ra','dec','nobs','chi2','snr','ap_corr'))
+        for s in summary[:args.top]:
+            print('%6d %4d %8d %12.7f %+12.7f %6d %10.3f %8.2f %8.3f' % (s['store'],s['ccd'],s['num'],s['ra'],s['dec'],s['nobs'],s['chi2'],s['snr'],s['ap_corr']))
+    return
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import numpy as np
+
+# maximum-likelihood mean and extra variance of light curves (myvarlc, used by offset.py)
+# and a batched version over all sources of a CCD at once
+
+# Check for variability: 
+def myvarlc(fluxin,sigin):
+    n = np.shape(fluxin)[0]
+    #convergence threshold    tiny = 2.e-5
+    tiny = 2.e-5
+    #lower limit for extra variance
+    #vmin = tiny * v0
+    #trap no data
+    good = 0.
+    avg = 0.
+    rms = 0.
+    sigavg = -1.
+    sigrms = -1.
+    
+    if( n <= 0 ):
+        print('flux,sig arrays empty, no data',n)
+        return(good, avg, rms, sigavg, sigrms)
+    
+    #only use data with non zero error bar
+    idinc = np.where(sigin > 0)[0]
+    flux = fluxin[idinc]
+    flux2 = flux * flux
+    sig  = sigin[idinc]
+    sig2 = sig*sig
+    ng = np.shape(sig)[0]
+    
+    #trap no valid data
+    if( ng <= 0 ):
+        print('** ERROR in avgrmsx. n', n, ' ng', ng)
+        return(good, avg, rms, sigavg, sigrms)
+    
+    #average positive error bars
+    e1 = np.mean(sig)
+    #KDH : V1 MAY VANISH IF E1 TOO SMALL
+    v1 = e1 * e1
+    #initial estimate
+    x = e1/sig
+    x2 = x*x
+    sum1 = np.sum(flux*x2)
+    sum2 = np.sum(x2)
+    varguess = np.std(flux) 
+    #optimal average and its variance
+    avg = sum1 / sum2
+    sigavg = e1 / np.sqrt( sum2 )
+    v0 = e1 * ( sigavg / sum2 )
+    #scale factor ( makes <1/sig^2>=1 )
+    v1 = ng * e1 * ( e1 / sum2 )
+    e1 = np.sqrt( v1 )
+    v0 = v0 / v1
+    #convergence threshold
+    tiny = 2.e-5
+    #lower limit for extra variance
+    vmin = tiny * v0
+    #initial parameter guesses
+    #avg = 10.0#np.mean(flux)
+    #rms = 0.1#np.std(flux)
+    var = rms*rms
+    #max-likelihood estimate of mean and extra varian
+    nloop = 1000
+    for loop in range(nloop):
+        #stow for convergence test
+        oldavg = avg
+        oldrms = rms
+        oldvar = var
+        #rescale
+        d = flux/e1
+        d2=d*d
+        e = sig/e1
+        #e2 = e*e
+        a = avg/e1
+        #weight
+        w = 1./(v0 + e*e)
+        #"goodness" of the data 
+        g = v0 * w
+        x = g * (d - a)
+        xx = x*x
+        sum1 = np.sum(g*d)
+        sumg = np.sum(g)
+        sum  = np.sum(g*g)
+        sum2 = np.sum(xx)
+        sum3 = np.sum(g*xx)  
+        sum4 = np.sum(x*g)
+        a = sum1 / sumg
+        v0 = sum2 / sumg
+        v0 = max( vmin, v0 )
+        va = v0 / sumg
+        #new avg and rms
+        avg = a
+        rms = np.sqrt( v0 )
+        #hessian matrix
+        Hmm = sumg/v0
+        Hmv = sum4/v0/v0
+        Hvv = sum3/v0/v0/v0 - 0.5*sum/v0/v0
+        #correction for covariance
+        c = 1. - Hmv*Hmv/Hmm/Hvv
+        #error bars on avg and rms
+        sigavg = np.sqrt( 1./Hmm/c )#np.sqrt( va )
+        if ((1./Hvv/c) < 0.0): 
+            print('Negative argument in sigv0')
+            good = np.nan
+            avg = np.nan
+            rms = np.nan
+            sigavg = np.nan
+            sigrms = np.nan
+            return good, avg, rms, sigavg, sigrms
+        sigv0  = np.sqrt( 1./Hvv/c )
+        #g = 2.0 * ( 2.0 * sum3 / sum2 * sumg - sum )
+        sigrms = rms
+        if( Hvv > 0.0 ): 
+            sigrms = 1./2 / rms * sigv0 #combination of error formula for x^1/3
+        #restore scaling
+        avg = a * e1
+        rms = rms * e1
+        sigavg = sigavg * e1
+        sigrms = sigrms * e1
+        #"good" data points ( e.g. with sig < rms )
+        if( sumg < 0.0 ):
+            print('** ERROR in AVGRMSX. NON-POSITIVE SUM(G)=', gsum)
+            print('** loop', loop, ' ndat', n, ' ngood', ng)
+            print('** dat(:)', flux[:])
+            print('** sig(:)', sig[:])
+            good = 0
+            return(good, avg, rms, sigavg, sigrms)
+        #converge when test < 1
+        if( loop > 10 ):
+            safe = 0.9
+            avg = oldavg * ( 1. - safe ) + safe * avg
+            rms = oldrms * ( 1. - safe ) + safe * rms
+            chiavg = ( avg - oldavg ) / sigavg
+            chirms = ( rms - oldrms ) / sigrms
+            test = max( abs( chiavg ), abs( chirms ) ) / tiny
+            #report on last 5 iterations
+            if( loop > nloop - 3 ):
+                print('Loop', loop, ' of', nloop, ' in AVGRMSX')
+                print('Ndat', n, ' Ngood', good, ' Neff', g)
+                print(' avg', avg, ' rms', rms)
+                print(' +/-', sigavg, ' +/-', sigrms)
+                print(' chiavg', chiavg, ' chirms', chirms, ' test', test)
+            #if( test < 1. ):
+            #    print('** CONVERGED ** :))')
+            #converged
+            if( test < 1. ):
+                good = 1
+                return(good, avg, rms, sigavg, sigrms)
+        #quit if v0 vanishes
+        if( v0 <= 0. ): 
+            print('no variance var <=0',var)
+            return(good, avg, rms, sigavg, sigrms)
+        #next loop
+    #failed to converge
+    print('** AVGRMSX FAILED TO CONVERGE :(((((')
+    return(good, avg, rms, sigavg, sigrms)
+
+
+def myvarlc_batch(fluxin,sigin,mask=None,nloop=1000):
+    # myvarlc of every row of padded [sources, epochs] arrays (mask marks the measurements to use),
+    # all rows are iterated together and frozen once converged (or failed);
+    # returns arrays good, avg, rms, sigavg, sigrms (good is nan where myvarlc gives up with nan)
+    fluxin = np.atleast_2d(np.asarray(fluxin,dtype=float))
+    sigin = np.atleast_2d(np.asarray(sigin,dtype=float))
+    if mask is None:
+        mask = np.ones(fluxin.shape,dtype=bool)
+    #only use data with non zero error bar
+    mask = np.asarray(mask,dtype=bool) & (sigin > 0)
+    ns = fluxin.shape[0]
+    good = np.zeros(ns)
+    avg = np.zeros(ns)
+    rms = np.zeros(ns)
+    sigavg = np.full(ns,-1.)
+    sigrms = np.full(ns,-1.)
+    ng = np.sum(mask,axis=1)
+    #trap no valid data
+    act = np.where(ng > 0)[0]
+    if len(act) == 0:
+        return good, avg, rms, sigavg, sigrms
+    flux = np.where(mask,fluxin,0.)[act]
+    sig = np.where(mask,sigin,1.)[act]
+    m = mask[act]
+    ng = ng[act]
+    #average positive error bars, initial estimate
+    e1 = np.sum(np.where(m,sig,0.),axis=1)/ng
+    x2 = np.where(m,(e1[:,None]/sig)**2,0.)
+    sum1 = np.sum(flux*x2,axis=1)
+    sum2 = np.sum(x2,axis=1)
+    a_avg = sum1/sum2
+    a_sigavg = e1/np.sqrt(sum2)
+    v0 = e1*(a_sigavg/sum2)
+    #scale factor ( makes <1/sig^2>=1 )
+    v1 = ng*e1*(e1/sum2)
+    e1 = np.sqrt(v1)
+    v0 = v0/v1
+    #lower limit for extra variance
+    tiny = 2.e-5
+    vmin = tiny*v0
+    a_rms = np.zeros(len(act))
+    a_sigrms = np.zeros(len(act))
+    d = flux/e1[:,None]
+    e = sig/e1[:,None]
+    e2 = e*e
+    for loop in range(nloop):
+        oldavg = a_avg
+        oldrms = a_rms
+        a = a_avg/e1
+        #weight and "goodness" of the data
+        g = np.where(m,v0[:,None]/(v0[:,None]+e2),0.)
+        x = g*(d-a[:,None])
+        xx = x*x
+        sum1 = np.sum(g*d,axis=1)
+        sumg = np.sum(g,axis=1)
+        sumgg = np.sum(g*g,axis=1)
+        sum2 = np.sum(xx,axis=1)
+        sum3 = np.sum(g*xx,axis=1)
+        sum4 = np.sum(x*g,axis=1)
+        a = sum1/sumg
+        v0 = np.maximum(vmin,sum2/sumg)
+        r = np.sqrt(v0)
+        #hessian matrix and correction for covariance
+        Hmm = sumg/v0
+        Hmv = sum4/v0/v0
+        Hvv = sum3/v0/v0/v0 - 0.5*sumgg/v0/v0
+        with np.errstate(divide='ignore',invalid='ignore'):
+            c = 1. - Hmv*Hmv/Hmm/Hvv
+            s_avg = np.sqrt(1./Hmm/c)
+            neg = (1./Hvv/c) < 0.0
+            sigv0 = np.sqrt(1./Hvv/c)
+        s_rms = np.where(Hvv > 0.0,1./2/r*sigv0,r)
+        #restore scaling
+        a_avg = a*e1
+        a_rms = r*e1
+        a_sigavg = s_avg*e1
+        a_sigrms = s_rms*e1
+        done = neg.copy()
+        conv = np.zeros(len(act),dtype=bool)
+        if loop > 10:
+            safe = 0.9
+            a_avg = oldavg*(1.-safe) + safe*a_avg
+            a_rms = oldrms*(1.-safe) + safe*a_rms
+            with np.errstate(divide='ignore',invalid='ignore'):
+                test = np.maximum(np.abs((a_avg-oldavg)/a_sigavg),np.abs((a_rms-oldrms)/a_sigrms))/tiny
+            conv = ~neg & (test < 1.)
+            done |= conv
+        #quit if v0 vanishes
+        done |= ~neg & ~conv & (v0 <= 0.)
+        # freeze finished rows
+        if np.any(done):
+            fin = act[done]
+            good[fin] = np.where(neg[done],np.nan,np.where(conv[done],1.,0.))
+            avg[fin] = np.where(neg[done],np.nan,a_avg[done])
+            rms[fin] = np.where(neg[done],np.nan,a_rms[done])
+            sigavg[fin] = np.where(neg[done],np.nan,a_sigavg[done])
+            sigrms[fin] = np.where(neg[done],np.nan,a_sigrms[done])
+            keep = ~done
+            act, m, d, e2, e1, v0, vmin = act[keep], m[keep], d[keep], e2[keep], e1[keep], v0[keep], vmin[keep]
+            a_avg, a_rms, a_sigavg, a_sigrms = a_avg[keep], a_rms[keep], a_sigavg[keep], a_sigrms[keep]
+            if len(act) == 0: break
+    #failed to converge
+    if len(act) > 0:
+        good[act] = 0.
+        avg[act], rms[act], sigavg[act], sigrms[act] = a_avg, a_rms, a_sigavg, a_sigrms
+    return good, avg, rms, sigavg, sigrms